@@ -183,6 +183,63 @@ INCIDENT_CREATOR_PERMISSION = 'incidents.view_incidents'
 # If you can see an event/incident, you can comment it!
 INCIDENT_VIEWER_CAN_COMMENT = False
 
+# Django cache alias used to keep the business lines granted to users across requests, shared by all processes,
+# None to compute them once per request only
+AUTHORIZATION_CACHE = None
+# Seconds after which cached business lines are read again, even if no change invalidated them
+AUTHORIZATION_CACHE_TIMEOUT = 3600
+# 'exists' to filter authorized objects with EXISTS subqueries on their business lines,
+# 'join' to join them and remove the duplicate rows with DISTINCT,
+# 'closure' to select incidents from the table of their business lines and ancestors, which must be
+# filled first with the rebuild_business_line_closure command
+AUTHORIZATION_QUERY_MODE = 'exists'
+
+# Django cache alias used to share the artifact blacklist between processes, None for a process-local copy only
+ARTIFACTS_BLACKLIST_CACHE = None
+# Seconds after which the process-local copy of the blacklist is read again, to see the changes made by
+# other processes (web workers, celery workers) when ARTIFACTS_BLACKLIST_CACHE is None
+ARTIFACTS_BLACKLIST_CACHE_TIMEOUT = 60
+
+# Extract artifacts from descriptions, comments and nuggets in a fir_celery task instead of during the request
+ARTIFACTS_ASYNC_EXTRACTION = False
+# Django cache alias used to track pending artifact extractions, required by ARTIFACTS_ASYNC_EXTRACTION:
+# it must be shared with the celery workers (e.g. redis or memcached, not the local-memory or dummy caches)
+ARTIFACTS_ASYNC_CACHE = None
+
+# Uploaded files larger than this many bytes are hashed by a fir_celery task instead of during the request
+FILES_ASYNC_HASHING_SIZE = None
+
+# Alias of the STORAGES setting used for evidence files (uploaded files, blobs and upload chunks),
+# e.g. an fir_artifacts.storage.S3Storage shared by several web and worker nodes
+FILES_STORAGE = 'default'
+
+# Store the content of uploaded files once per sha256 digest, shared by all the files holding it
+FILE_STORAGE_DEDUPLICATION = False
+
+# Scan uploaded text files for artifacts in a fir_celery task, and link the artifacts found to the incident
+FILES_ARTIFACT_SCAN = False
+# Budget of a file scan: bytes read from the file and seconds, None for no limit
+FILES_SCAN_MAX_SIZE = 50 * 1024 * 1024
+FILES_SCAN_TIME_LIMIT = 60
+
+# Compression level of incident file archives, from 0 (stored, for already compressed samples) to 9
+FILES_ARCHIVE_COMPRESSION_LEVEL = 6
+
+# How file downloads are sent once permissions are checked:
+# 'python' streams them from Django (with HTTP Range support), 'x-accel-redirect' (nginx) and
+# 'x-sendfile' (Apache, lighttpd) let the front-end server send them
+FILES_DOWNLOAD_BACKEND = 'python'
+# Internal nginx location serving MEDIA_ROOT, used by the 'x-accel-redirect' backend
+FILES_DOWNLOAD_ACCEL_PREFIX = '/protected-uploads/'
+
+# Largest chunk accepted by the chunked upload API, in bytes, also the default chunk size of an upload
+FILES_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Smallest chunk size an upload can choose, in bytes (the last chunk of a file may be shorter)
+FILES_UPLOAD_MIN_CHUNK_SIZE = 64 * 1024
+# Largest file accepted by the chunked upload API, in bytes, and most chunks it can be split in
+FILES_UPLOAD_MAX_SIZE = 10 * 1024 * 1024 * 1024
+FILES_UPLOAD_MAX_CHUNKS = 10000
+
 # Escape HTML when displaying markdown
 MARKDOWN_SAFE_MODE = True
 
@@ -51,6 +51,28 @@ REDIS_DB = env.int('REDIS_DB', 0)
 
 STATIC_ROOT = '/var/www/static'
 
+# FILE DOWNLOADS
+# Set to 'x-accel-redirect' to let nginx send files (see docker/nginx.conf)
+FILES_DOWNLOAD_BACKEND = env.str('FILES_DOWNLOAD_BACKEND', 'python')
+
+# EVIDENCE STORAGE
+# Set FILES_S3_BUCKET to store uploaded files in an S3 compatible bucket instead of MEDIA_ROOT (requires boto3)
+if env.str('FILES_S3_BUCKET', ''):
+    STORAGES = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+        'evidence': {
+            'BACKEND': 'fir_artifacts.storage.S3Storage',
+            'OPTIONS': {
+                'bucket': env.str('FILES_S3_BUCKET'),
+                'prefix': env.str('FILES_S3_PREFIX', ''),
+                'endpoint_url': env.str('FILES_S3_ENDPOINT_URL', None),
+                'region_name': env.str('FILES_S3_REGION', None),
+            },
+        },
+    }
+    FILES_STORAGE = 'evidence'
+
 ################################################################
 
 # False if not in os.environ
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
 from incidents.models import Incident, Artifact, Label, File, IncidentCategory, BusinessLine, Comments, Attribute
+from fir_artifacts.models import FileUpload
 from fir_nuggets.models import Nugget
 
 
@@ -44,6 +46,55 @@ class FileSerializer(serializers.ModelSerializer):
         extra_kwargs = {'url': {'view_name': 'api:file-download'}}
         depth = 2
 
+
+class FileUploadSerializer(serializers.ModelSerializer):
+    incident = serializers.PrimaryKeyRelatedField(queryset=Incident.objects.all(), write_only=True)
+    chunk_size = serializers.IntegerField(min_value=1, required=False)
+    chunk_count = serializers.IntegerField(read_only=True)
+    missing_chunks = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+    missing_ranges = serializers.ListField(child=serializers.ListField(child=serializers.IntegerField()),
+                                           read_only=True)
+
+    class Meta:
+        model = FileUpload
+        fields = ('id', 'incident', 'filename', 'description', 'size', 'chunk_size', 'sha256', 'chunk_count',
+                  'missing_chunks', 'missing_ranges')
+        read_only_fields = ('id',)
+        extra_kwargs = {'size': {'min_value': 0}}
+
+    def validate_size(self, value):
+        max_size = getattr(settings, 'FILES_UPLOAD_MAX_SIZE', 10 * 1024 * 1024 * 1024)
+        if value > max_size:
+            raise serializers.ValidationError("Files can not be larger than %d bytes" % max_size)
+        return value
+
+    def validate_chunk_size(self, value):
+        max_chunk_size = getattr(settings, 'FILES_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024)
+        min_chunk_size = getattr(settings, 'FILES_UPLOAD_MIN_CHUNK_SIZE', 64 * 1024)
+        if value > max_chunk_size:
+            raise serializers.ValidationError("Chunks can not be larger than %d bytes" % max_chunk_size)
+        if value < min_chunk_size:
+            raise serializers.ValidationError("Chunks can not be smaller than %d bytes" % min_chunk_size)
+        return value
+
+    def validate(self, attrs):
+        chunk_size = attrs.get('chunk_size', getattr(settings, 'FILES_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+        max_chunks = getattr(settings, 'FILES_UPLOAD_MAX_CHUNKS', 10000)
+        if -(-attrs['size'] // chunk_size) > max_chunks:
+            raise serializers.ValidationError({'chunk_size': "Uploads can not be split in more than %d chunks, "
+                                                             "the chunks must be larger" % max_chunks})
+        return attrs
+
+    def validate_sha256(self, value):
+        if value and (len(value) != 64 or any(c not in '0123456789abcdef' for c in value.lower())):
+            raise serializers.ValidationError("Not a sha256 hex digest")
+        return value.lower()
+
+    def create(self, validated_data):
+        incident = validated_data.pop('incident')
+        validated_data.setdefault('chunk_size', getattr(settings, 'FILES_UPLOAD_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+        return FileUpload.objects.create(content_object=incident, **validated_data)
+
 # FIR Comment Model
 
 class CommentsSerializer(serializers.ModelSerializer):
@@ -70,11 +121,12 @@ class IncidentSerializer(serializers.ModelSerializer):
     plan = serializers.PrimaryKeyRelatedField(queryset=Label.objects.filter(group__name='plan'))
     file_set = AttachedFileSerializer(many=True, read_only=True)
     comments_set = CommentsSerializer(many=True, read_only=True)
+    artifacts_pending = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Incident
         exclude = ['main_business_lines', 'artifacts']
-        read_only_fields = ('id', 'opened_by', 'main_business_lines', 'file_set')
+        read_only_fields = ('id', 'opened_by', 'main_business_lines', 'file_set', 'artifacts_pending')
 
 
 # FIR attribute model
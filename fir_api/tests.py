@@ -0,0 +1,45 @@
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from incidents import models
+from fir_api.views import FileUploadViewSet
+from fir_artifacts.models import FileUpload
+
+
+class FileUploadTestCase(TestCase):
+    fixtures = ['incidents/fixtures/01_seed_data.json']
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.incident = models.Incident.objects.create(
+            subject='Incident', description='Incident', severity=1, opened_by=self.user,
+            category=models.IncidentCategory.objects.first(),
+            detection=models.Label.objects.filter(group__name='detection').first())
+
+    def create(self, **data):
+        data.setdefault('incident', self.incident.pk)
+        data.setdefault('filename', 'sample.bin')
+        data.setdefault('description', 'Sample')
+        request = APIRequestFactory().post('/api/uploads', data, format='json')
+        force_authenticate(request, user=self.user)
+        return FileUploadViewSet.as_view({'post': 'create'})(request)
+
+    def test_create(self):
+        response = self.create(size=20 * 1024 * 1024, chunk_size=4 * 1024 * 1024)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['chunk_count'], 5)
+        self.assertEqual(response.data['missing_chunks'], [0, 1, 2, 3, 4])
+        self.assertEqual(response.data['missing_ranges'], [[0, 4]])
+
+    @override_settings(FILES_UPLOAD_MAX_SIZE=1024 * 1024 * 1024, FILES_UPLOAD_MAX_CHUNKS=100)
+    def test_limits(self):
+        for data in [{'size': 10 ** 15, 'chunk_size': 1}, {'size': 10 ** 15}, {'size': 1024, 'chunk_size': 1},
+                     {'size': 1024 * 1024 * 1024, 'chunk_size': 1024 * 1024},
+                     {'size': 1024, 'chunk_size': 1024 * 1024 * 1024}]:
+            response = self.create(**data)
+            self.assertEqual(response.status_code, 400, data)
+        self.assertFalse(FileUpload.objects.exists())
+        response = self.create(size=512 * 1024 * 1024)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['chunk_count'], 64)
@@ -14,6 +14,7 @@ router.register(r'users', views.UserViewSet)
 router.register(r'incidents', views.IncidentViewSet)
 router.register(r'artifacts', views.ArtifactViewSet)
 router.register(r'files', views.FileViewSet)
+router.register(r'uploads', views.FileUploadViewSet)
 router.register(r'comments', views.CommentViewSet)
 router.register(r'labels', views.LabelViewSet)
 router.register(r'attributes', views.AttributeViewSet)
@@ -11,16 +11,20 @@ from django.contrib.auth.models import User
 from django.db.models import Q
 
 from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.authtoken.models import Token
-from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
+from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, CreateModelMixin, DestroyModelMixin
 from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework import renderers
 
-from fir_api.serializers import UserSerializer, IncidentSerializer, ArtifactSerializer, FileSerializer, CommentsSerializer, LabelSerializer, AttributeSerializer, BusinessLineSerializer, IncidentCategoriesSerializer, NuggetSerializer
+from fir_api.serializers import UserSerializer, IncidentSerializer, ArtifactSerializer, FileSerializer, CommentsSerializer, LabelSerializer, AttributeSerializer, BusinessLineSerializer, IncidentCategoriesSerializer, NuggetSerializer, FileUploadSerializer
 from fir_api.permissions import IsIncidentHandler
-from fir_artifacts.files import handle_uploaded_file, do_download
+from fir_artifacts.files import handle_uploaded_files, do_download, store_chunk, finalize_upload, ChunkedUploadError, \
+    ChunkedUploadConflict
+from fir_artifacts.models import FileUpload
 from incidents.models import Incident, Artifact, Comments, File, Label, Attribute, BusinessLine, IncidentCategory
 from fir_nuggets.models import Nugget
 
@@ -92,11 +96,11 @@ class ArtifactViewSet(ListModelMixin, RetrieveModelMixin, viewsets.GenericViewSe
          q = Q()
          if id is not None:
             q = q & Q(id__exact=id)
-         if value is not None:
-            q = q & Q(value__contains=value)
          if incidents is not None:
             q = q & Q(incidents__exact=incidents)
          queryset = queryset.filter(q)
+         if value is not None:
+            queryset = queryset.lookup(value)
          return queryset
 
 
@@ -150,17 +154,63 @@ class FileViewSet(ListModelMixin, RetrieveModelMixin, viewsets.GenericViewSet):
     def upload(self, request, pk):
         files = request.data['files']
         incident = get_object_or_404(Incident, pk=pk)
-        files_added = []
+        uploads = []
         for i, file in enumerate(files):
             file_obj = FileWrapper(io.StringIO(file['content']))
             file_obj.name = file['filename']
-            description = file['description']
-            f = handle_uploaded_file(file_obj, description, incident)
-            files_added.append(f)
+            uploads.append((file_obj, file['description']))
+        files_added = handle_uploaded_files(uploads, incident)
         resp_data = FileSerializer(files_added, many=True, context={'request': request}).data
         return HttpResponse(JSONRenderer().render(resp_data), content_type='application/json')
 
 
+class FileUploadViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Chunked, resumable file uploads
+
+    Create an upload with the incident, filename, description and size of the file, then PUT its chunks
+    (chunk_size bytes each, the last one excepted) in any order to chunks/<index>, with their sha256 hex digest
+    in the X-Chunk-SHA256 header. missing_chunks lists the chunks still to send. POST to finalize to attach
+    the file to the incident.
+    """
+    queryset = FileUpload.objects.all()
+    serializer_class = FileUploadSerializer
+    permission_classes = (IsAuthenticated, IsIncidentHandler)
+
+    def get_queryset(self):
+        return FileUpload.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        if not self.request.user.has_perm('incidents.handle_incidents', obj=serializer.validated_data['incident']):
+            raise PermissionDenied()
+        serializer.save(user=self.request.user)
+
+    @action(detail=True, methods=["PUT"], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk, index):
+        upload = self.get_object()
+        sha256 = request.META.get('HTTP_X_CHUNK_SHA256', '')
+        if len(sha256) != 64:
+            raise ValidationError({'X-Chunk-SHA256': "The sha256 hex digest of the chunk is required"})
+        try:
+            store_chunk(upload, int(index), request.stream or io.BytesIO(), sha256)
+        except ChunkedUploadConflict as e:
+            return Response({'detail': str(e)}, status=409)
+        except ChunkedUploadError as e:
+            raise ValidationError(str(e))
+        return Response(self.get_serializer(upload).data)
+
+    @action(detail=True, methods=["POST"])
+    def finalize(self, request, pk):
+        upload = self.get_object()
+        try:
+            f = finalize_upload(upload)
+        except ChunkedUploadConflict as e:
+            return Response({'detail': str(e)}, status=409)
+        except ChunkedUploadError as e:
+            raise ValidationError(str(e))
+        return Response(FileSerializer(f, context={'request': request}).data, status=201)
+
+
 class AttributeViewSet(viewsets.ModelViewSet):
     queryset = Attribute.objects.all()
     serializer_class = AttributeSerializer
@@ -201,12 +251,12 @@ class NuggetViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         instance = serializer.save(found_by=self.request.user)
         e = get_object_or_404(Incident.authorization.for_user(self.request.user, 'incidents.handle_incidents'), pk=instance.incident_id)
-        e.refresh_artifacts(instance.raw_data)
+        e.refresh_artifacts(instance.raw_data, source=instance)
 
     def perform_update(self, serializer):
         instance = serializer.save()
         e = get_object_or_404(Incident.authorization.for_user(self.request.user, 'incidents.handle_incidents'), pk=instance.incident_id)
-        e.refresh_artifacts(instance.raw_data)
+        e.refresh_artifacts(instance.raw_data, source=instance)
 
     def perform_destroy(self, serializer):
         serializer.delete()
@@ -1,6 +1,15 @@
+import codecs
 import re
+import time
+import uuid
 
 from django import template
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.template.loader import get_template
 from django.template import RequestContext
 
@@ -9,33 +18,271 @@ register = template.Library()
 INSTALLED_ARTIFACTS = dict()
 
 
+class ArtifactExtractor(object):
+    """
+    Compiled extraction engine for all installed artifact types
+
+    Patterns are compiled once, when an artifact class is installed. The data is split
+    on whitespace once, and artifact types declared as ``tokenizable`` only run their
+    regex over the tokens that can hold one of their values (long enough and containing
+    their required literal) instead of over the whole text.
+    """
+    def __init__(self):
+        self._artifact_classes = []
+
+    def add(self, artifact_class):
+        artifact_class.compile()
+        self._artifact_classes = [c for c in self._artifact_classes if c.key != artifact_class.key]
+        self._artifact_classes.append(artifact_class)
+
+    def signature(self):
+        return sorted(artifact_class.key for artifact_class in self._artifact_classes)
+
+    def extract(self, data):
+        result = dict()
+        tokens = None
+        for artifact_class in self._artifact_classes:
+            required = artifact_class.requires
+            if required is not None and required not in data:
+                result[artifact_class.key] = []
+                continue
+            if not artifact_class.tokenizable:
+                result[artifact_class.key] = artifact_class.find(data)
+                continue
+            if tokens is None:
+                tokens = data.split()
+            min_length = artifact_class.min_length
+            candidates = [t for t in tokens if len(t) >= min_length and (required is None or required in t)]
+            if candidates:
+                result[artifact_class.key] = artifact_class.find("\n".join(candidates))
+            else:
+                result[artifact_class.key] = []
+        return result
+
+
+extractor = ArtifactExtractor()
+
+
+class ArtifactBlacklist(object):
+    """
+    Process-local store of blacklisted values, as one set per artifact type
+
+    Values are loaded once and reloaded after ArtifactBlacklistItem changes. When the
+    ARTIFACTS_BLACKLIST_CACHE setting names a Django cache, the sets and their version
+    are shared through it, so that a change made by one process invalidates all of them.
+    Otherwise, the changes made by other processes are seen once the process copy expires,
+    after ARTIFACTS_BLACKLIST_CACHE_TIMEOUT seconds.
+    """
+    version_key = 'fir_artifacts:blacklist:version'
+    values_key = 'fir_artifacts:blacklist:{}'
+
+    def __init__(self):
+        self._values = None
+        self._version = None
+        self._expires = None
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'ARTIFACTS_BLACKLIST_CACHE_TIMEOUT', 60)
+
+    @property
+    def shared_cache(self):
+        alias = getattr(settings, 'ARTIFACTS_BLACKLIST_CACHE', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    def load(self):
+        from fir_artifacts.models import ArtifactBlacklistItem
+
+        values = dict()
+        for artifact_type, value in ArtifactBlacklistItem.objects.values_list('type', 'value'):
+            values.setdefault(artifact_type, set()).add(value)
+        return dict((artifact_type, frozenset(v)) for artifact_type, v in values.items())
+
+    def values(self):
+        cache = self.shared_cache
+        if cache is None:
+            now = time.monotonic()
+            if self._values is None or (self._expires is not None and self._expires <= now):
+                self._values = self.load()
+                timeout = self.timeout
+                self._expires = now + timeout if timeout is not None else None
+            return self._values
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        if self._values is None or self._version != version:
+            values = cache.get(self.values_key.format(version))
+            if values is None:
+                values = self.load()
+                cache.set(self.values_key.format(version), values, None)
+            self._values = values
+            self._version = version
+        return self._values
+
+    def get(self, artifact_type):
+        return self.values().get(artifact_type, frozenset())
+
+    def invalidate(self):
+        self._values = None
+        cache = self.shared_cache
+        if cache is not None:
+            cache.set(self.version_key, uuid.uuid4().hex, None)
+
+    def invalidate_on_commit(self):
+        # Reloading before the change is committed would cache the old values under the new version
+        transaction.on_commit(self.invalidate)
+
+
+blacklist = ArtifactBlacklist()
+
+
+class ArtifactRefreshQueue(object):
+    """
+    Schedules artifact refreshes as fir_celery tasks when ARTIFACTS_ASYNC_EXTRACTION is enabled
+
+    Objects are only queued once the current transaction commits, and an object is not queued
+    again while its refresh is pending. The pending state is kept in the ARTIFACTS_ASYNC_CACHE
+    cache, which must be shared between the web processes and the celery workers: with a
+    process-local cache, the workers could never clear the pending state set by the web processes.
+    """
+    pending_key = 'fir_artifacts:pending:{}:{}'
+    # Forget about a pending refresh whose task was lost
+    pending_timeout = 3600
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ARTIFACTS_ASYNC_EXTRACTION', False)
+
+    @property
+    def cache(self):
+        alias = getattr(settings, 'ARTIFACTS_ASYNC_CACHE', None)
+        if alias is None:
+            raise ImproperlyConfigured("ARTIFACTS_ASYNC_EXTRACTION requires ARTIFACTS_ASYNC_CACHE, "
+                                       "the alias of a cache shared with the celery workers")
+        cache = caches[alias]
+        if isinstance(cache, (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured("ARTIFACTS_ASYNC_CACHE '%s' is not shared between processes" % alias)
+        return cache
+
+    def key(self, content_type_id, object_id):
+        return self.pending_key.format(content_type_id, object_id)
+
+    def schedule(self, obj):
+        from django.contrib.contenttypes.models import ContentType
+        from fir_artifacts.tasks import refresh_artifacts
+
+        # Checked before the transaction commits, a misconfiguration fails the request
+        cache = self.cache
+        content_type_id = ContentType.objects.get_for_model(obj).pk
+        object_id = obj.pk
+
+        def enqueue():
+            if cache.add(self.key(content_type_id, object_id), True, self.pending_timeout):
+                refresh_artifacts.delay(content_type_id, object_id)
+
+        transaction.on_commit(enqueue)
+
+    def pending(self, obj):
+        from django.contrib.contenttypes.models import ContentType
+
+        if not self.enabled:
+            return False
+        return self.cache.get(self.key(ContentType.objects.get_for_model(obj).pk, obj.pk)) is not None
+
+    def started(self, content_type_id, object_id):
+        # Changes committed from now on are not seen by the running refresh and must queue a new one
+        self.cache.delete(self.key(content_type_id, object_id))
+
+
+refresh_queue = ArtifactRefreshQueue()
+
+
 def install(artifact_class):
     INSTALLED_ARTIFACTS[artifact_class.key] = artifact_class
+    extractor.add(artifact_class)
 
 
-def find(data):
-    from fir_artifacts.models import ArtifactBlacklistItem
+def extract(data):
+    """
+    Returns all artifact values found in data, by type, without blacklist filtering
+    """
+    return extractor.extract(data)
 
+
+def find(data):
     result = dict()
-    for key in INSTALLED_ARTIFACTS:
-        blacklist = ArtifactBlacklistItem.objects.filter(type=key).values_list('value', flat=True)
-        values = INSTALLED_ARTIFACTS[key].find(data)
-        values = [v for v in values if v not in blacklist]
+    found = extract(data)
+    for key in found:
+        blacklisted = blacklist.get(key)
+        values = [v for v in found[key] if v not in blacklisted]
         result[key] = values
 
     return result
 
 
+# Streams are decoded and scanned by windows of this many characters
+SCAN_WINDOW_SIZE = 1024 * 1024
+# Characters of the previous window scanned again, as context for the patterns looking around their match
+SCAN_OVERLAP = 1024
+WHITESPACE = ' \t\n\r\x0b\x0c'
+
+
+def scan(stream, max_size=None, time_limit=None, encoding='utf-8'):
+    """
+    Returns the artifact values found in a binary stream, by type, and whether it was scanned up to its end
+
+    The stream is read by windows, so that memory usage does not depend on its size. Windows end on
+    whitespace, so that values are not truncated at window borders, and start with the end of the previous
+    window. Scanning stops after max_size bytes or time_limit seconds. Blacklisted values are filtered out.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    deadline = time.monotonic() + time_limit if time_limit is not None else None
+    found = dict()
+    carry = ''
+    read = 0
+    complete = True
+    while True:
+        size = SCAN_WINDOW_SIZE if max_size is None else min(SCAN_WINDOW_SIZE, max_size - read)
+        data = stream.read(size) if size > 0 else b''
+        read += len(data)
+        final = not data
+        if final and max_size is not None and read >= max_size and stream.read(1):
+            complete = False
+        text = carry + decoder.decode(data, final=final)
+        if final:
+            window, carry = text, ''
+        else:
+            cut = max(text.rfind(c) for c in WHITESPACE) + 1
+            # Values longer than a whole window are cut anyway
+            if cut <= 0 or len(text) - cut > SCAN_WINDOW_SIZE:
+                cut = len(text)
+            starts = [i for i in (text.find(c, max(cut - SCAN_OVERLAP, 0), cut) for c in WHITESPACE) if i >= 0]
+            window, carry = text[:cut], text[min(starts) + 1 if starts else cut:]
+        for key, values in find(window).items():
+            found.setdefault(key, set()).update(values)
+        if final:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            complete = False
+            break
+    return dict((key, sorted(values)) for key, values in found.items()), complete
+
+
 def after_save(type, value, event):
     return INSTALLED_ARTIFACTS[type].after_save(value, event)
 
 def incs_for_art(art_string):
+    """
+    Returns the ids of the incidents linked to artifacts matching art_string, as a subquery
+
+    See ArtifactQuerySet.lookup for the supported patterns.
+    """
     from fir_artifacts.models import Artifact
-    artifacts = Artifact.objects.filter(value__contains=art_string)
-    incs = []
-    for a in artifacts:
-        incs.extend(a.relations.all())
-    return incs
+    return Artifact.incidents.through.objects.filter(
+        artifact__in=Artifact.objects.lookup(art_string)).values('incident_id')
 
 
 def all_for_object(obj, raw=False, user=None):
@@ -46,10 +293,19 @@ def all_for_object(obj, raw=False, user=None):
     if not hasattr(obj, "artifacts"):
         return (result, total_count, correlated_count)
 
+    from fir_artifacts.models import Artifact
+    values = dict((artifact, []) for artifact in INSTALLED_ARTIFACTS)
+    all_values = list(obj.artifacts.all())
+    for value in all_values:
+        if value.type in values:
+            values[value.type].append(value)
+    correlation_counts = Artifact.objects.filter(
+        pk__in=[value.pk for value in all_values]).correlation_counts(user)
+
     for artifact in INSTALLED_ARTIFACTS:
-        values = obj.artifacts.filter(type=artifact)
-        artifact_collection = INSTALLED_ARTIFACTS[artifact](values, obj, user=user)
-        total_count += values.count()
+        artifact_collection = INSTALLED_ARTIFACTS[artifact](values[artifact], obj, user=user,
+                                                            correlation_counts=correlation_counts)
+        total_count += len(values[artifact])
         correlated_count += artifact_collection.correlated_count()
         result.append(artifact_collection)
 
@@ -59,11 +315,30 @@ def all_for_object(obj, raw=False, user=None):
 class AbstractArtifact:
     case_sensitive = False
     template = 'fir_artifacts/default.html'
+    regex_flags = 0
+    # Literal that every artifact value contains, used to skip data that cannot match
+    requires = None
+    # Values never contain whitespace and the regex does not look at surrounding characters
+    tokenizable = False
+    min_length = 0
+
+    @classmethod
+    def compile(cls):
+        cls._compiled_regex = re.compile(cls.regex, cls.regex_flags)
+        return cls._compiled_regex
+
+    @classmethod
+    def get_regex(cls):
+        # Only trust a pattern compiled for this very class, not one inherited from a parent
+        compiled = cls.__dict__.get('_compiled_regex', None)
+        if compiled is None:
+            compiled = cls.compile()
+        return compiled
 
     @classmethod
     def find(cls, data):
         results = []
-        for i in re.finditer(cls.regex, data):
+        for i in cls.get_regex().finditer(data):
             if cls.case_sensitive:
                 results.append(i.group('search'))
             else:
@@ -76,11 +351,11 @@ class AbstractArtifact:
         # Do nothing, allows for specific callback in subclasses
         pass
 
-    def __init__(self, artifacts, event, user=None):
+    def __init__(self, artifacts, event, user=None, correlation_counts=None):
         class ArtifactDisplay(object):
-            def __init__(self, artifact, user):
+            def __init__(self, artifact, correlation_count):
                 self.artifact = artifact
-                self.correlation_count = self.artifact.relations_for_user(user).count()
+                self.correlation_count = correlation_count
 
             @property
             def value(self):
@@ -98,7 +373,12 @@ class AbstractArtifact:
             def pk(self):
                 return self.artifact.pk
 
-        self._artifacts = [ArtifactDisplay(artifact, user) for artifact in artifacts]
+        if correlation_counts is None:
+            from fir_artifacts.models import Artifact
+            artifacts = list(artifacts)
+            correlation_counts = Artifact.objects.filter(
+                pk__in=[artifact.pk for artifact in artifacts]).correlation_counts(user)
+        self._artifacts = [ArtifactDisplay(artifact, correlation_counts.get(artifact.pk, 0)) for artifact in artifacts]
         self._event = event
 
         self._correlated = []
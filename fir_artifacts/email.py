@@ -4,4 +4,6 @@ from fir_artifacts.artifacts import AbstractArtifact
 class Email(AbstractArtifact):
     key = 'email'
     display_name = 'Emails'
+    requires = '@'
+    tokenizable = True
     regex = r"(?P<search>[\w\-\.\_]+@(([\w\-]+\.)+)([a-zA-Z]{2,6}))\.?"
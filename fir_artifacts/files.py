@@ -1,17 +1,21 @@
+import hashlib
 import mimetypes
-import os
+import re
+import threading
 import zipfile
-from io import BytesIO
+from urllib.parse import quote
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, Http404, HttpResponseRedirect
-from django.shortcuts import get_object_or_404
 from django.core.files import File as FileWrapper
+from django.http import FileResponse, HttpResponse, Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 
-from fir_artifacts import Hash
-from fir_artifacts.models import File, Artifact
+from fir_artifacts import Hash, artifacts
+from fir_artifacts.models import File, FileBlob, FileUpload, FileUploadChunk, Artifact, HASH_CHUNK_SIZE
 
 
 def do_upload_file(request, content_type, object_id):
@@ -24,71 +28,511 @@ def do_upload_file(request, content_type, object_id):
         descriptions = request.POST.getlist('description')
         files = request.FILES.getlist('file')
         if len(descriptions) == len(files):  # consider this as a valid upload form?
-            for i, file in enumerate(files):
-                handle_uploaded_file(file, descriptions[i], obj)
+            handle_uploaded_files(zip(files, descriptions), obj)
 
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
 def handle_uploaded_file(file, description, obj):
+    return handle_uploaded_files([(file, description)], obj)[0]
+
+
+def handle_uploaded_files(uploads, obj):
+    """
+    Stores (file, description) pairs as Files attached to obj, and links all their hashes at once
+
+    Returns the created Files. Files larger than FILES_ASYNC_HASHING_SIZE are hashed by a fir_celery task.
+    """
+    created = []
+    hashed = []
+    deferred = []
+    deduplication = getattr(settings, 'FILE_STORAGE_DEDUPLICATION', False)
+    threshold = getattr(settings, 'FILES_ASYNC_HASHING_SIZE', None)
+    for file, description in uploads:
+        f = File()
+        f.description = description
+        f.content_object = obj
+        if deduplication:
+            # The upload is hashed once to find its blob, known content is neither written nor hashed again
+            f.set_blob(FileBlob.objects.store(file), file.name)
+            f.save()
+            hashed.append((f, f.blob.get_hashes()))
+        else:
+            f.file = file
+            f.save()
+            if threshold is not None and f.file.size > threshold:
+                deferred.append(f.pk)
+            else:
+                hashed.append((f, f.get_hashes()))
+        created.append(f)
+
+    link_hashes_many(hashed)
+    if deferred:
+        from fir_artifacts.tasks import hash_file
+        transaction.on_commit(lambda: [hash_file.delay(file_id) for file_id in deferred])
+    schedule_scan(created)
+    return created
+
+
+def link_hashes(f, hashes=None):
+    """
+    Hashes the file and links the hash artifacts to it and to its related object
+
+    hashes are the digests returned by f.get_hashes(), when they are already known.
+    """
+    if hashes is None:
+        hashes = f.get_hashes()
+    link_hashes_many([(f, hashes)])
+    return f
+
+
+def link_hashes_many(hashed):
+    """
+    Links the hash artifacts of (file, hashes) pairs to the files and to their related objects
+
+    The artifacts are resolved with one bulk operation, and linked with one insert per relation table.
+    """
+    if not hashed:
+        return
+    with transaction.atomic(savepoint=False):
+        artifacts = dict((a.value, a) for a in Artifact.objects.resolve(
+            (Hash.key, value) for f, hashes in hashed for value in hashes.values()))
+        related = dict()
+        file_links = []
+        for f, hashes in hashed:
+            obj = f.get_related()
+            file_artifacts = [artifacts[value] for value in set(hashes.values())]
+            related.setdefault(type(obj), []).extend((obj.pk, a) for a in file_artifacts)
+            file_links.extend(File.hashes.through(file_id=f.pk, artifact_id=a.pk) for a in file_artifacts)
+        for model, links in related.items():
+            Artifact.objects.link_many(model, links)
+        File.hashes.through.objects.bulk_create(file_links, ignore_conflicts=True)
+
+
+class ChunkedUploadError(Exception):
+    pass
+
+
+class ChunkedUploadConflict(ChunkedUploadError):
+    """
+    The upload was changed by a concurrent request, e.g. the same chunk sent twice at once
+    """
+    pass
+
+
+class HashingReader(object):
+    """
+    Reads at most limit bytes from stream, computing the digests of what is read
+    """
+    def __init__(self, stream, limit=None, algorithms=('md5', 'sha1', 'sha256'), hashes=None):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+        # hashes continues the digests of what was read before, by algorithm
+        self.hashes = hashes if hashes is not None else dict((k, hashlib.new(k)) for k in algorithms)
+
+    def read(self, size=-1):
+        if self.limit is not None:
+            left = self.limit - self.size
+            size = left if size is None or size < 0 else min(size, left)
+            if size <= 0:
+                return b''
+        data = self.stream.read(size)
+        self.size += len(data)
+        for digest in self.hashes.values():
+            digest.update(data)
+        return data
+
+    def hexdigests(self):
+        return dict((k, digest.hexdigest()) for k, digest in self.hashes.items())
+
+
+class UploadChunksReader(object):
+    """
+    Reads the stored chunks of a FileUpload in order, as a single file
+    """
+    def __init__(self, upload):
+        self.chunks = list(upload.chunks.order_by('index'))
+        self.seek(0)
+
+    def _pieces(self):
+        for chunk in self.chunks:
+            with chunk.content.storage.open(chunk.content.name, 'rb') as content:
+                while True:
+                    data = content.read(HASH_CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+
+    def seek(self, position):
+        if position != 0:
+            raise ValueError("Uploaded chunks can only be read again from the start")
+        self._iterator = self._pieces()
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = None
+        parts = []
+        while size is None or size > 0:
+            if self._offset >= len(self._buffer):
+                self._buffer, self._offset = next(self._iterator, b''), 0
+                if not self._buffer:
+                    break
+            end = len(self._buffer) if size is None else self._offset + size
+            data = self._buffer[self._offset:end]
+            self._offset += len(data)
+            if size is not None:
+                size -= len(data)
+            parts.append(data)
+        return b''.join(parts)
+
+    def close(self):
+        self._iterator.close()
+
+
+class RunningHashes(object):
+    """
+    Digests of the uploads whose chunks this process received in order, so that finalizing them needs no hashing
+
+    hashlib states can not be stored between requests: a process only follows the uploads it received every chunk
+    of, from the first one and in order, and the other uploads are hashed when their chunks are assembled.
+    """
+    # Number of uploads followed by the process, they are all forgotten when it grows past it
+    size = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._uploads = dict()
+
+    def start(self, upload_id, index):
+        """
+        Returns copies of the digests to continue with chunk index of the upload, None when it is not the next one
+        """
+        with self._lock:
+            chunks, hashes = self._uploads.get(upload_id, ((), None))
+            if not chunks and index == 0:
+                return dict((k, hashlib.new(k)) for k in ('md5', 'sha1', 'sha256'))
+            if hashes is None or len(chunks) != index:
+                return None
+            return dict((k, digest.copy()) for k, digest in hashes.items())
+
+    def add(self, upload_id, chunk, hashes):
+        """
+        Records a stored chunk, with the digests continued by its content (None when it was not the next chunk)
+        """
+        with self._lock:
+            chunks, current = self._uploads.get(upload_id, ((), None))
+            if chunk.index < len(chunks):
+                # A chunk sent again leaves the digests valid when its content did not change
+                if chunks[chunk.index][1] == chunk.sha256:
+                    chunks = chunks[:chunk.index] + ((chunk.pk, chunk.sha256),) + chunks[chunk.index + 1:]
+                    self._uploads[upload_id] = (chunks, current)
+                else:
+                    del self._uploads[upload_id]
+            elif hashes is not None and chunk.index == len(chunks):
+                if len(self._uploads) >= self.size:
+                    self._uploads = dict()
+                self._uploads[upload_id] = (chunks + ((chunk.pk, chunk.sha256),), hashes)
+
+    def pop(self, upload_id, chunks):
+        """
+        Returns the digests of the upload made of chunks, None unless this process received all of them in order
+
+        Chunks are compared by primary key and digest, as the ids of deleted rows may be reused.
+        """
+        with self._lock:
+            received, hashes = self._uploads.pop(upload_id, ((), None))
+        if hashes is None or list(received) != [(chunk.pk, chunk.sha256) for chunk in chunks]:
+            return None
+        return dict((k, digest.hexdigest()) for k, digest in hashes.items())
+
+
+running_hashes = RunningHashes()
+
+
+def store_chunk(upload, index, stream, sha256):
+    """
+    Writes chunk index of upload from stream to the storage, checking its size and sha256 digest
+
+    The chunk replaces any previous copy, so that a failed chunk can be sent again. Chunks received in order also
+    update the digests of the whole file.
+    """
+    if not 0 <= index < upload.chunk_count:
+        raise ChunkedUploadError("Chunk index out of range")
+    expected_size = upload.expected_chunk_size(index)
+    # One more byte than expected is read, to detect oversized chunks without reading them whole
+    chunk_reader = HashingReader(stream, limit=expected_size + 1, algorithms=('sha256',))
+    file_hashes = running_hashes.start(upload.pk, index)
+    reader = chunk_reader if file_hashes is None else HashingReader(chunk_reader, hashes=file_hashes)
+    chunk = FileUploadChunk(upload=upload, index=index, sha256=sha256.lower())
+    chunk.content.save(str(index), FileWrapper(reader), save=False)
+    chunk.size = chunk_reader.size
+    if chunk.size != expected_size:
+        chunk.content.delete(save=False)
+        raise ChunkedUploadError("Chunk %d must be %d bytes long, got %d" % (index, expected_size, chunk.size))
+    if chunk_reader.hexdigests()['sha256'] != chunk.sha256:
+        chunk.content.delete(save=False)
+        raise ChunkedUploadError("Checksum mismatch for chunk %d" % index)
+    try:
+        with transaction.atomic():
+            # Locks the upload, serializing the requests sending the same chunk and the finalization of the
+            # upload, and records the activity so that the garbage collector keeps it
+            if not FileUpload.objects.filter(pk=upload.pk).update(updated=timezone.now()):
+                raise ChunkedUploadConflict("The upload was finalized or deleted")
+            for previous in FileUploadChunk.objects.filter(upload=upload, index=index):
+                previous.delete()
+            chunk.save()
+    except IntegrityError:
+        chunk.content.delete(save=False)
+        raise ChunkedUploadConflict("Chunk %d was sent again by another request" % index)
+    except ChunkedUploadConflict:
+        chunk.content.delete(save=False)
+        raise
+    running_hashes.add(upload.pk, chunk, file_hashes)
+    return chunk
+
+
+def finalize_upload(upload):
+    """
+    Assembles the chunks of upload into a File attached to its object, and deletes the upload
+
+    The file is written to the storage before the upload is locked, only to create the File and delete the
+    upload, and its digests are those computed as the chunks were received when this process got them all
+    in order. Otherwise the chunks are still read once: the file is hashed while it is written (or, with
+    FILE_STORAGE_DEDUPLICATION, hashed to find its blob and only written when the content is new).
+    """
+    missing = upload.missing_ranges()
+    if missing:
+        raise ChunkedUploadError("Missing chunks: %s" % ", ".join(
+            str(first) if first == last else "%d-%d" % (first, last) for first, last in missing))
 
     f = File()
-    f.description = description
-    f.file = file
-    f.content_object = obj
-    f.save()
-
-    hashes = f.get_hashes()
-    for h in hashes:
-        try:
-            a = Artifact.objects.get(value=hashes[h])
-            a.save()
-        except Exception:
-            a = Artifact()
-            a.type = Hash.key
-            a.value = hashes[h]
-            a.save()
-
-        a.relations.add(obj)
-        f.hashes.add(a)
-    f.save()
+    f.description = upload.description
+    f.content_object = upload.content_object
+    chunks = UploadChunksReader(upload)
+    chunk_ids = [chunk.pk for chunk in chunks.chunks]
+    hashes = running_hashes.pop(upload.pk, chunks.chunks)
+    if getattr(settings, 'FILE_STORAGE_DEDUPLICATION', False):
+        if hashes is None:
+            reader = HashingReader(chunks)
+            while reader.read(HASH_CHUNK_SIZE):
+                pass
+            hashes = reader.hexdigests()
+            chunks.seek(0)
+        if upload.sha256 and hashes['sha256'] != upload.sha256.lower():
+            raise ChunkedUploadError("Checksum mismatch for the assembled file")
+        content = FileWrapper(chunks, name=upload.filename)
+        content.size = upload.size
+        f.set_blob(FileBlob.objects.store(content, hashes=hashes), upload.filename)
+    else:
+        reader = HashingReader(chunks) if hashes is None else chunks
+        f.file.save(upload.filename, FileWrapper(reader), save=False)
+        if hashes is None:
+            hashes = reader.hexdigests()
+        if upload.sha256 and hashes['sha256'] != upload.sha256.lower():
+            f.file.delete(save=False)
+            raise ChunkedUploadError("Checksum mismatch for the assembled file")
 
+    try:
+        with transaction.atomic():
+            upload = FileUpload.objects.select_for_update().filter(pk=upload.pk).first()
+            if upload is None:
+                raise ChunkedUploadConflict("The upload was finalized or deleted")
+            if list(upload.chunks.order_by('index').values_list('pk', flat=True)) != chunk_ids:
+                raise ChunkedUploadConflict("Chunks of the upload were sent again during its finalization")
+            f.save()
+            link_hashes(f, hashes)
+            upload.delete()
+    except Exception:
+        if f.blob_id is not None:
+            FileBlob.objects.release(f.blob_id)
+        else:
+            f.file.delete(save=False)
+        raise
+    schedule_scan([f])
     return f
 
 
+# Files holding a NUL byte in their first bytes are considered binary and are not scanned
+SCAN_SNIFF_SIZE = 8192
+
+
+def schedule_scan(files):
+    """
+    Queues the artifact scan of files as fir_celery tasks, when FILES_ARTIFACT_SCAN is enabled
+    """
+    if not files or not getattr(settings, 'FILES_ARTIFACT_SCAN', False):
+        return
+    from fir_artifacts.tasks import scan_file
+    file_ids = [f.pk for f in files]
+    transaction.on_commit(lambda: [scan_file.delay(file_id) for file_id in file_ids])
+
+
+def scan_file(f):
+    """
+    Links the artifacts found in a text file to its related object
+
+    At most FILES_SCAN_MAX_SIZE bytes are scanned, for at most FILES_SCAN_TIME_LIMIT seconds.
+    Returns the values found by type and whether the whole file was scanned, None for binary files.
+    """
+    with f.file.storage.open(f.file.name, 'rb') as content:
+        if b'\0' in content.read(SCAN_SNIFF_SIZE):
+            return None
+        content.seek(0)
+        found, complete = artifacts.scan(content, max_size=getattr(settings, 'FILES_SCAN_MAX_SIZE', None),
+                                         time_limit=getattr(settings, 'FILES_SCAN_TIME_LIMIT', None))
+
+    obj = f.get_related()
+    artifact_list = set((key, value) for key, values in found.items() for value in values)
+    with transaction.atomic(savepoint=False):
+        Artifact.objects.link(obj, Artifact.objects.resolve(artifact_list))
+    for key, value in artifact_list:
+        artifacts.after_save(key, value, obj)
+    return found, complete
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def read_range(content, length, chunk_size=64 * 1024):
+    try:
+        while length > 0:
+            data = content.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        content.close()
+
+
+def ranged_file_response(request, field_file, content_type):
+    """
+    Streams a stored file, or the single byte range requested by a Range header
+    """
+    storage = field_file.storage
+    size = storage.size(field_file.name)
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    if match is None or not (match.group(1) or match.group(2)) or \
+            (match.group(1) and match.group(2) and int(match.group(2)) < int(match.group(1))):
+        # No range, a multiple range request or an invalid range (RFC 9110 ignores it): the whole file is sent
+        response = FileResponse(storage.open(field_file.name, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            start = max(size - int(match.group(2)), 0)
+            end = size - 1
+        # Valid but unsatisfiable: it starts past the end of the file, or is an empty suffix
+        if start > end or start >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        content = storage.open(field_file.name, 'rb')
+        content.seek(start)
+        response = StreamingHttpResponse(read_range(content, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def local_path(field_file):
+    """
+    Returns the filesystem path of a stored file, None when its storage is not a local filesystem
+    """
+    try:
+        return field_file.path
+    except NotImplementedError:
+        return None
+
+
 def do_download(request, file_id):
     f = get_object_or_404(File, pk=file_id)
     if not request.user.has_perm('incidents.view_incidents', obj=f.get_related()):
         raise PermissionDenied()
-    wrapper = FileWrapper(f.file)
-    content_type = mimetypes.guess_type(f.file.name)
-    response = HttpResponse(wrapper, content_type=content_type)
+    content_type = mimetypes.guess_type(f.getfilename())[0] or 'application/octet-stream'
+    backend = getattr(settings, 'FILES_DOWNLOAD_BACKEND', 'python')
+    path = local_path(f.file)
+    # The front-end server sends the file once the permission is checked, when it is stored on a local disk
+    if backend == 'x-accel-redirect' and path is not None:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(getattr(settings, 'FILES_DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/') +
+                                             f.file.name)
+    elif backend == 'x-sendfile' and path is not None:
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        response = ranged_file_response(request, f.file, content_type)
     response['Content-Disposition'] = 'attachment; filename=%s' % (f.getfilename())
-    response['Content-Length'] = os.path.getsize(str(f.file.file))
 
     return response
 
 
+class ArchiveBuffer(object):
+    """
+    Unseekable file-like object collecting what zipfile writes, until it is sent
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_chunks(files, compression_level):
+    """
+    Yields a ZIP archive of files as it is built, holding at most one chunk of a file in memory
+    """
+    buffer = ArchiveBuffer()
+    if compression_level == 0:
+        compression, compression_level = zipfile.ZIP_STORED, None
+    else:
+        compression = zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(buffer, 'w', compression, compresslevel=compression_level) as archive:
+        for f in files:
+            # Sizes are unknown when the entry header is written
+            with archive.open(f.getfilename(), 'w', force_zip64=True) as entry:
+                with f.file.storage.open(f.file.name, 'rb') as content:
+                    for chunk in content.chunks():
+                        entry.write(chunk)
+                        yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+
 def do_download_archive(request, content_type, object_id):
     object_type = ContentType.objects.get(pk=content_type)
     obj = get_object_or_404(object_type.model_class(), pk=object_id)
     if not request.user.has_perm('incidents.view_incidents', obj=obj):
         raise PermissionDenied()
-    if obj.file_set.count() == 0:
+    if not obj.file_set.exists():
         raise Http404
-    temp = BytesIO()
-    with zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED) as archive:
-        media_root = settings.MEDIA_ROOT
-        for file in obj.file_set.all():
-            path = os.path.join(media_root, file.file.path)
-            archive.write(path, os.path.basename(path))
-    file_size = temp.tell()
-    temp.seek(0)
-    wrapper = FileWrapper(temp)
-
-    response = HttpResponse(wrapper, content_type='application/zip')
+    compression_level = getattr(settings, 'FILES_ARCHIVE_COMPRESSION_LEVEL', 6)
+    if request.GET.get('compression', '') in [str(level) for level in range(10)]:
+        compression_level = int(request.GET['compression'])
+
+    response = StreamingHttpResponse(archive_chunks(obj.file_set.all(), compression_level),
+                                     content_type='application/zip')
     response['Content-Disposition'] = 'attachment; filename=archive_%s_%s.zip' % (object_type.model, object_id)
-    response['Content-Length'] = file_size
     return response
 
 
@@ -97,6 +541,8 @@ def do_remove_file(request, file_id):
         f = get_object_or_404(File, pk=file_id)
         if not request.user.has_perm('incidents.handle_incidents', obj=f.get_related()):
             raise PermissionDenied()
-        f.file.delete()
+        # Shared blobs are released when their last File is deleted
+        if f.blob_id is None:
+            f.file.delete()
         f.delete()
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
@@ -0,0 +1,165 @@
+import re
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from fir_artifacts.models import Artifact, File, FileBlob, FileUpload, FileUploadChunk, ScannedContent
+from fir_artifacts.storage import evidence_storage
+
+# Storage directories written by FIR: blobs, upload chunks and the "<model>_<id>" directories of File
+STORAGE_DIRECTORY_RE = re.compile(r'^(blobs|chunks|[a-z0-9]+_\d+)$')
+
+
+class GarbageCollector(object):
+    """
+    Deletes what is left behind by deleted objects: files of deleted objects, expired chunked uploads,
+    unreferenced blobs, artifacts linked to nothing, digests of deleted objects and, optionally,
+    stored files referenced by no row
+
+    Candidates are found with anti-join queries and deleted by batches of batch_size rows, each in its own
+    transaction where the condition is checked again. With dry_run, they are only counted.
+    Stored files younger than min_age are kept, they may belong to a transaction in progress. Chunked uploads
+    are deleted once they received no chunk for upload_expiry, so that a large upload can be resumed for as long
+    as chunks keep arriving.
+    """
+    def __init__(self, batch_size=1000, dry_run=False, min_age=timedelta(days=1), storage=False, log=None,
+                 upload_expiry=timedelta(days=1)):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.min_age = min_age
+        self.upload_expiry = upload_expiry
+        self.storage = storage
+        self.log = log
+        self.report = dict()
+        self.actions = dict()
+
+    def write(self, name, count, action='deleted'):
+        self.report[name] = self.report.get(name, 0) + count
+        self.actions[name] = action
+        if self.log is not None and count:
+            self.log(u"{}: {} {}".format(name, count, "found" if self.dry_run else action))
+
+    def delete_batches(self, name, candidates, delete=None):
+        """
+        Deletes the rows of the candidates queryset by batches, in primary key order
+
+        delete is called with the queryset of a batch inside its transaction, and defaults to a plain delete.
+        """
+        if self.dry_run:
+            self.write(name, candidates.count())
+            return
+        last_pk = None
+        while True:
+            batch = candidates.order_by('pk')
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            ids = list(batch.values_list('pk', flat=True)[:self.batch_size])
+            if not ids:
+                return
+            last_pk = ids[-1]
+            with transaction.atomic():
+                # The candidates condition is evaluated again by the deletion
+                rows = candidates.filter(pk__in=ids)
+                deleted = delete(rows) if delete is not None else rows.delete()[1].get(rows.model._meta.label, 0)
+            self.write(name, deleted)
+
+    def delete_files(self, rows):
+        deleted = 0
+        for f in rows.select_for_update():
+            # Shared blobs are released when their last File is deleted
+            if f.blob_id is None and f.file.name:
+                name, storage = f.file.name, f.file.storage
+                transaction.on_commit(lambda name=name, storage=storage: storage.delete(name))
+            f.delete()
+            deleted += 1
+        return deleted
+
+    def delete_blobs(self, rows):
+        deleted = 0
+        for blob in rows.select_for_update():
+            name, storage = blob.content.name, blob.content.storage
+            blob.delete()
+            transaction.on_commit(lambda name=name, storage=storage: storage.delete(name))
+            deleted += 1
+        return deleted
+
+    def delete_artifacts(self, rows):
+        # Locked, then checked again by a new query: the artifacts that Artifact.objects.resolve locked
+        # in a transaction in progress are only checked once the links it adds are committed
+        ids = list(rows.select_for_update().values_list('pk', flat=True))
+        return Artifact.objects.unlinked().filter(pk__in=ids).delete()[1].get(Artifact._meta.label, 0)
+
+    def recount_blobs(self):
+        """
+        Sets the reference count of blobs to their number of files
+
+        A blob whose count drops to 0 is only deleted by the next collection, after the File
+        referencing a blob being stored had time to be saved.
+        """
+        counts = File.objects.filter(blob=models.OuterRef('pk')).order_by().values('blob').annotate(
+            count=models.Count('pk')).values('count')
+        wrong = FileBlob.objects.annotate(actual=Coalesce(models.Subquery(counts), 0)).exclude(
+            reference_count=models.F('actual'))
+        if self.dry_run:
+            self.write('blob reference counts', wrong.count(), 'fixed')
+            return
+        fixed = 0
+        for blob_id in list(wrong.values_list('pk', flat=True)):
+            # Counted again by the update, the blob may have been stored or released in the meantime
+            fixed += FileBlob.objects.filter(pk=blob_id).update(reference_count=Coalesce(models.Subquery(counts), 0))
+        self.write('blob reference counts', fixed, 'fixed')
+
+    def walk(self, storage, path=''):
+        directories, names = storage.listdir(path)
+        for name in names:
+            yield '{}/{}'.format(path, name) if path else name
+        for directory in directories:
+            if path or STORAGE_DIRECTORY_RE.match(directory):
+                for name in self.walk(storage, '{}/{}'.format(path, directory) if path else directory):
+                    yield name
+
+    def unreferenced_names(self, storage, names):
+        referenced = set(File.objects.filter(file__in=names).values_list('file', flat=True))
+        referenced.update(FileBlob.objects.filter(content__in=names).values_list('content', flat=True))
+        referenced.update(FileUploadChunk.objects.filter(content__in=names).values_list('content', flat=True))
+        limit = timezone.now() - self.min_age
+        return [name for name in names if name not in referenced and storage.get_modified_time(name) < limit]
+
+    def sweep_storage(self):
+        """
+        Deletes the stored files under the FIR directories of the storage that no row references
+        """
+        storage = evidence_storage()
+        batch = []
+        for name in self.walk(storage):
+            batch.append(name)
+            if len(batch) >= self.batch_size:
+                self.sweep_names(storage, batch)
+                batch = []
+        if batch:
+            self.sweep_names(storage, batch)
+
+    def sweep_names(self, storage, names):
+        unreferenced = self.unreferenced_names(storage, names)
+        if not self.dry_run:
+            for name in unreferenced:
+                storage.delete(name)
+        self.write('stored files', len(unreferenced))
+
+    def collect(self):
+        """
+        Runs all the collections and returns the number of rows found or deleted, by kind
+        """
+        self.delete_batches('files of deleted objects', File.objects.orphaned(), self.delete_files)
+        self.delete_batches('expired uploads',
+                            FileUpload.objects.filter(updated__lt=timezone.now() - self.upload_expiry))
+        self.delete_batches('unreferenced blobs', FileBlob.objects.unreferenced().filter(reference_count__lte=0),
+                            self.delete_blobs)
+        self.recount_blobs()
+        self.delete_batches('unlinked artifacts', Artifact.objects.unlinked(), self.delete_artifacts)
+        self.delete_batches('stale scanned contents', ScannedContent.objects.stale())
+        if self.storage:
+            self.sweep_storage()
+        return self.report
@@ -5,3 +5,5 @@ class Hash(AbstractArtifact):
     key = 'hash'
     display_name = 'Hashes'
     regex = r"(?P<search>[a-fA-F0-9]{32,64})"
+    tokenizable = True
+    min_length = 32
@@ -0,0 +1,65 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fir_artifacts import artifacts
+
+
+class Command(BaseCommand):
+    help = "Compares the compiled extraction engine with the per-class artifact find loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help="Text file to extract artifacts from (default: generated sample)")
+        parser.add_argument('--size', type=int, default=20000, help="Number of words in the generated sample")
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def sample(self, size, seed):
+        rand = random.Random(seed)
+        words = []
+        for i in range(size):
+            r = rand.random()
+            if r < 0.05:
+                words.append("http://evil{}.example.com/path/{}?id={}".format(i, i, i))
+            elif r < 0.10:
+                words.append("10.{}.{}.{}".format(i % 255, i % 200, i % 100))
+            elif r < 0.13:
+                words.append("%032x" % rand.getrandbits(128))
+            elif r < 0.16:
+                words.append("user{}@corp{}.com".format(i, i))
+            elif r < 0.25:
+                words.append("host{}.corp.example.net".format(i))
+            else:
+                words.append("lorem{}".format(i))
+        return " ".join(words)
+
+    def handle(self, *args, **options):
+        if options['file']:
+            try:
+                with open(options['file'], encoding='utf-8', errors='replace') as f:
+                    data = f.read()
+            except IOError as e:
+                raise CommandError(u"Cannot read '{}': {}".format(options['file'], e))
+        else:
+            data = self.sample(options['size'], options['seed'])
+
+        def per_class_loop():
+            return dict((key, artifact_class.find(data))
+                        for key, artifact_class in artifacts.INSTALLED_ARTIFACTS.items())
+
+        def engine():
+            return artifacts.extract(data)
+
+        if per_class_loop() != engine():
+            raise CommandError(u"Extraction engine and per-class loop results differ")
+
+        iterations = options['iterations']
+        self.stdout.write(u"{} characters, {} artifact types, {} iterations".format(
+            len(data), len(artifacts.INSTALLED_ARTIFACTS), iterations))
+        loop_time = min(timeit.repeat(per_class_loop, number=1, repeat=iterations))
+        engine_time = min(timeit.repeat(engine, number=1, repeat=iterations))
+        self.stdout.write(u"per-class loop: {:.4f}s".format(loop_time))
+        self.stdout.write(u"engine:         {:.4f}s".format(engine_time))
+        if engine_time:
+            self.stdout.write(u"speedup:        {:.2f}x".format(loop_time / engine_time))
@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from fir_artifacts.garbage import GarbageCollector
+
+
+class Command(BaseCommand):
+    help = "Deletes artifacts linked to nothing, unreferenced blobs and files, and other leftovers of deleted objects"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of rows deleted per transaction")
+        parser.add_argument('--min-age', type=float, default=24,
+                            help="Age in hours under which stored files are kept")
+        parser.add_argument('--upload-expiry', type=float, default=24,
+                            help="Hours without a received chunk after which unfinished uploads are deleted")
+        parser.add_argument('--storage', action='store_true',
+                            help="Also delete the stored files that no file, blob or upload references "
+                                 "(lists the whole storage)")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['min_age'] < 0 or options['upload_expiry'] < 0:
+            raise CommandError(u"--batch-size must be positive, --min-age and --upload-expiry can not be negative")
+        collector = GarbageCollector(batch_size=options['batch_size'], dry_run=options['dry_run'],
+                                     min_age=timedelta(hours=options['min_age']), storage=options['storage'],
+                                     log=self.stdout.write,
+                                     upload_expiry=timedelta(hours=options['upload_expiry']))
+        report = collector.collect()
+        for name, count in report.items():
+            action = collector.actions[name]
+            self.stdout.write(u"{:<28} {:>10} {}".format(
+                name, count, "would be " + action if options['dry_run'] else action))
+        self.stdout.write(self.style.SUCCESS(u"Done{}".format(" (dry run)" if options['dry_run'] else "")))
@@ -0,0 +1,61 @@
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def set_value_hashes(apps, schema_editor):
+    Artifact = apps.get_model('fir_artifacts', 'Artifact')
+    batch = []
+    for artifact in Artifact.objects.only('id', 'value').iterator(chunk_size=2000):
+        artifact.value_hash = hashlib.sha1(artifact.value.encode('utf-8')).hexdigest()
+        batch.append(artifact)
+        if len(batch) >= 2000:
+            Artifact.objects.bulk_update(batch, ['value_hash'])
+            batch = []
+    if batch:
+        Artifact.objects.bulk_update(batch, ['value_hash'])
+
+
+def merge_duplicates(apps, schema_editor):
+    Artifact = apps.get_model('fir_artifacts', 'Artifact')
+    duplicates = Artifact.objects.values('type', 'value_hash').annotate(
+        count=Count('id'), keep=Min('id')).filter(count__gt=1)
+    for duplicate in duplicates:
+        duplicate_ids = list(Artifact.objects.filter(
+            type=duplicate['type'], value_hash=duplicate['value_hash']).exclude(
+            pk=duplicate['keep']).values_list('pk', flat=True))
+        for relation in Artifact._meta.related_objects:
+            if relation.many_to_many:
+                field = relation.field
+                through = field.remote_field.through
+                source = '{}_id'.format(field.m2m_field_name())
+                target = '{}_id'.format(field.m2m_reverse_field_name())
+                linked = set(through.objects.filter(**{target: duplicate['keep']}).values_list(source, flat=True))
+                moved = set(through.objects.filter(**{target + '__in': duplicate_ids}).values_list(source, flat=True))
+                through.objects.bulk_create([through(**{source: linked_id, target: duplicate['keep']})
+                                             for linked_id in moved - linked])
+                through.objects.filter(**{target + '__in': duplicate_ids}).delete()
+            elif relation.one_to_many:
+                relation.related_model.objects.filter(
+                    **{relation.field.name + '__in': duplicate_ids}).update(**{relation.field.name: duplicate['keep']})
+        Artifact.objects.filter(pk__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0006_auto_20170110_1415'),
+        ('incidents', '0002_link_incidents_to_artifacts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artifact',
+            name='value_hash',
+            field=models.CharField(default='', editable=False, max_length=40),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_value_hashes, migrations.RunPython.noop),
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # Kept apart from 0007 so that PostgreSQL does not alter the table in the transaction
+    # that deleted the duplicate rows
+
+    dependencies = [
+        ('fir_artifacts', '0007_artifact_value_hash'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='artifact',
+            unique_together={('value_hash', 'type')},
+        ),
+    ]
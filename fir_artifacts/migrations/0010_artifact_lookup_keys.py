@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+LOOKUP_KEY_LENGTH = 100
+
+
+def set_lookup_keys(apps, schema_editor):
+    Artifact = apps.get_model('fir_artifacts', 'Artifact')
+    batch = []
+    for artifact in Artifact.objects.only('id', 'value').iterator(chunk_size=2000):
+        normalized = artifact.value.lower()
+        artifact.value_prefix = normalized[:LOOKUP_KEY_LENGTH]
+        artifact.value_suffix = normalized[::-1][:LOOKUP_KEY_LENGTH]
+        batch.append(artifact)
+        if len(batch) >= 2000:
+            Artifact.objects.bulk_update(batch, ['value_prefix', 'value_suffix'])
+            batch = []
+    if batch:
+        Artifact.objects.bulk_update(batch, ['value_prefix', 'value_suffix'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0009_scannedcontent'),
+    ]
+
+    # Keys are filled before being indexed, the indexes are created in the next migration
+    operations = [
+        migrations.AddField(
+            model_name='artifact',
+            name='value_prefix',
+            field=models.CharField(default='', editable=False, max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='artifact',
+            name='value_suffix',
+            field=models.CharField(default='', editable=False, max_length=100),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_lookup_keys, migrations.RunPython.noop),
+    ]
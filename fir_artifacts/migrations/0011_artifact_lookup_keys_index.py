@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0010_artifact_lookup_keys'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='artifact',
+            name='value_prefix',
+            field=models.CharField(db_index=True, editable=False, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='artifact',
+            name='value_suffix',
+            field=models.CharField(db_index=True, editable=False, max_length=100),
+        ),
+    ]
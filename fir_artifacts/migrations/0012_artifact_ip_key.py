@@ -0,0 +1,37 @@
+import ipaddress
+
+from django.db import migrations, models
+
+
+def set_ip_keys(apps, schema_editor):
+    Artifact = apps.get_model('fir_artifacts', 'Artifact')
+    batch = []
+    for artifact in Artifact.objects.only('id', 'value').iterator(chunk_size=2000):
+        try:
+            address = ipaddress.ip_address(artifact.value)
+        except ValueError:
+            continue
+        artifact.ip_key = u"{}{:0{}x}".format(address.version, int(address), address.max_prefixlen // 4)
+        batch.append(artifact)
+        if len(batch) >= 2000:
+            Artifact.objects.bulk_update(batch, ['ip_key'])
+            batch = []
+    if batch:
+        Artifact.objects.bulk_update(batch, ['ip_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0011_artifact_lookup_keys_index'),
+    ]
+
+    # The key is filled before being indexed, the index is created in the next migration
+    operations = [
+        migrations.AddField(
+            model_name='artifact',
+            name='ip_key',
+            field=models.CharField(editable=False, max_length=33, null=True),
+        ),
+        migrations.RunPython(set_ip_keys, migrations.RunPython.noop),
+    ]
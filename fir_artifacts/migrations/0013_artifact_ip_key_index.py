@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0012_artifact_ip_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='artifact',
+            name='ip_key',
+            field=models.CharField(db_index=True, editable=False, max_length=33, null=True),
+        ),
+    ]
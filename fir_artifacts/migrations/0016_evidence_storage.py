@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:51
+
+import fir_artifacts.models
+import fir_artifacts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0015_fileupload'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='file',
+            field=models.FileField(storage=fir_artifacts.storage.evidence_storage, upload_to=fir_artifacts.models.upload_path),
+        ),
+        migrations.AlterField(
+            model_name='fileblob',
+            name='content',
+            field=models.FileField(max_length=255, storage=fir_artifacts.storage.evidence_storage, upload_to=fir_artifacts.models.blob_path),
+        ),
+        migrations.AlterField(
+            model_name='fileuploadchunk',
+            name='content',
+            field=models.FileField(max_length=255, storage=fir_artifacts.storage.evidence_storage, upload_to=fir_artifacts.models.upload_chunk_path),
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def copy_dates(apps, schema_editor):
+    FileUpload = apps.get_model('fir_artifacts', 'FileUpload')
+    FileUpload.objects.update(updated=models.F('date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fir_artifacts', '0016_evidence_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupload',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_dates, migrations.RunPython.noop),
+    ]
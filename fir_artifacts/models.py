@@ -1,6 +1,15 @@
 import hashlib
+import ipaddress
 import os
-from django.db import models
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, router, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from fir_artifacts import artifacts
+from fir_artifacts.storage import evidence_storage
 from fir_plugins.models import ManyLinkableModel, OneLinkableModel
 
 
@@ -12,39 +21,522 @@ class ArtifactBlacklistItem(models.Model):
         return self.value
 
 
+@receiver(post_save, sender=ArtifactBlacklistItem)
+@receiver(post_delete, sender=ArtifactBlacklistItem)
+def invalidate_blacklist(sender, **kwargs):
+    artifacts.blacklist.invalidate_on_commit()
+
+
+def artifact_value_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+# Length of the indexed lookup keys, short enough for MySQL/MariaDB index size limits
+LOOKUP_KEY_LENGTH = 100
+
+
+def artifact_lookup_keys(value):
+    """
+    Returns the indexed (prefix, suffix) lookup keys of a value: its lowercased start and reversed end
+    """
+    normalized = value.lower()
+    return normalized[:LOOKUP_KEY_LENGTH], normalized[::-1][:LOOKUP_KEY_LENGTH]
+
+
+def ip_address_key(address):
+    """
+    Returns the indexed key of an ipaddress address: its version and its value as fixed width hexadecimal
+
+    Keys of the same version sort like the addresses, so that networks are key ranges.
+    """
+    return u"{}{:0{}x}".format(address.version, int(address), address.max_prefixlen // 4)
+
+
+def artifact_ip_key(value):
+    try:
+        return ip_address_key(ipaddress.ip_address(value))
+    except ValueError:
+        return None
+
+
+class ArtifactQuerySet(models.QuerySet):
+    def lookup(self, query):
+        """
+        Filters artifacts whose value matches query, case insensitively
+
+        "value" is an exact match, "value*" a prefix match and "*value" a suffix match (e.g. "*.evil.com"),
+        which all use the indexed lookup keys. "*value*" falls back to an unindexed substring match.
+        A CIDR network (e.g. "10.20.0.0/16" or "2001:db8::/32") matches the IP addresses it contains.
+        """
+        if '/' in query:
+            try:
+                network = ipaddress.ip_network(query, strict=False)
+            except ValueError:
+                pass
+            else:
+                return self.filter(ip_key__gte=ip_address_key(network.network_address),
+                                   ip_key__lte=ip_address_key(network.broadcast_address))
+        if query.startswith('*') and query.endswith('*'):
+            query = query.strip('*')
+            if not query:
+                return self.none()
+            return self.filter(value__icontains=query)
+        if query.startswith('*'):
+            query = query.lstrip('*')
+            key = artifact_lookup_keys(query)[1]
+            result = self.filter(value_suffix__startswith=key)
+            if len(query) > LOOKUP_KEY_LENGTH:
+                result = result.filter(value__iendswith=query)
+            return result
+        if query.endswith('*'):
+            query = query.rstrip('*')
+            key = artifact_lookup_keys(query)[0]
+            result = self.filter(value_prefix__startswith=key)
+            if len(query) > LOOKUP_KEY_LENGTH:
+                result = result.filter(value__istartswith=query)
+            return result
+        key = artifact_lookup_keys(query)[0]
+        if len(query) < LOOKUP_KEY_LENGTH:
+            return self.filter(value_prefix=key)
+        return self.filter(value_prefix=key, value__iexact=query)
+
+    def resolve(self, values):
+        """
+        Returns the artifacts for an iterable of (type, value) pairs
+
+        Existing artifacts are fetched with a single query and the missing ones are
+        created with a single bulk insert, in (type, value hash) order so that concurrent
+        calls lock the same keys in the same order and can not deadlock. When another
+        transaction created some of them in the meantime, the insert is rolled back, those
+        are read and the others inserted again: post_save is only sent for the rows inserted here.
+        The artifacts are locked until the transaction ends, so that the garbage collector does
+        not delete them before they are linked: call it and link them in the same transaction.
+        """
+        wanted = dict(((artifact_type, artifact_value_hash(value)), (artifact_type, value))
+                      for artifact_type, value in set(values))
+        if not wanted:
+            return []
+        hashes = set(value_hash for artifact_type, value_hash in wanted)
+        found = dict(((a.type, a.value_hash), a)
+                     for a in self.filter(value_hash__in=hashes).select_for_update().order_by('pk')
+                     if (a.type, a.value_hash) in wanted)
+        missing = sorted(key for key in wanted if key not in found)
+        while missing:
+            new_artifacts = [Artifact(type=wanted[key][0], value=wanted[key][1]) for key in missing]
+            for artifact in new_artifacts:
+                artifact.update_keys()
+            try:
+                with transaction.atomic(using=self.db):
+                    self.bulk_create(new_artifacts)
+            except IntegrityError:
+                rows = self.filter(value_hash__in=set(key[1] for key in missing)).select_for_update().order_by('pk')
+                created = dict(((a.type, a.value_hash), a) for a in rows if (a.type, a.value_hash) in missing)
+                if not created:
+                    raise
+                found.update(created)
+                missing = [key for key in missing if key not in found]
+                continue
+            if any(artifact.pk is None for artifact in new_artifacts):
+                # The database does not return the ids of inserted rows
+                ids = dict(((a.type, a.value_hash), a.pk) for a in self.filter(
+                    value_hash__in=set(key[1] for key in missing)).only('pk', 'type', 'value_hash'))
+                for artifact in new_artifacts:
+                    artifact.pk = ids[(artifact.type, artifact.value_hash)]
+            # bulk_create does not send post_save, plugins rely on it to process new artifacts
+            using = router.db_for_write(Artifact)
+            for artifact in new_artifacts:
+                post_save.send(sender=Artifact, instance=artifact, created=True, update_fields=None,
+                               raw=False, using=using)
+                found[(artifact.type, artifact.value_hash)] = artifact
+            missing = []
+        return list(found.values())
+
+    def link(self, obj, artifacts):
+        """
+        Links artifacts to obj with a single insert in the relation table
+        """
+        return self.link_many(type(obj), [(obj.pk, a) for a in artifacts])
+
+    def link_many(self, model, links):
+        """
+        Links artifacts to instances of model from (object id, artifact) pairs with a single insert
+        """
+        for link_name, linked_model in Artifact._LINKS.items():
+            if issubclass(model, linked_model.model):
+                through, source, target = link_table(linked_model)
+                through.objects.bulk_create([through(**{source: object_id, target: a.pk}) for object_id, a in links],
+                                            ignore_conflicts=True)
+                return
+        raise Artifact.LinkedModelDoesNotExist()
+
+    def unlinked(self):
+        """
+        Filters artifacts linked to no object and held by no file, with one anti-join per relation table
+        """
+        result = self
+        for relation in Artifact._meta.related_objects:
+            if relation.many_to_many:
+                field = relation.field
+                through = field.remote_field.through
+                target = '{}_id'.format(field.m2m_reverse_field_name())
+                result = result.filter(~models.Exists(through.objects.filter(**{target: models.OuterRef('pk')})))
+        return result
+
+    def correlation_counts(self, user=None, permission='incidents.view_incidents'):
+        """
+        Returns the number of objects linked to each artifact, as a dict of artifact id: count
+
+        Only the objects user has permission on are counted, like in relations_for_user(user).count(),
+        with one grouped query per link type instead of one count per artifact.
+        """
+        counts = dict()
+        artifact_ids = self.values('pk')
+        for link_name, linked_model in Artifact._LINKS.items():
+            through, source, target = link_table(linked_model)
+            links = through.objects.filter(**{target + '__in': artifact_ids})
+            if hasattr(linked_model.model, 'authorization') and user is not None:
+                allowed = linked_model.model.authorization.for_user(user, permission).order_by().values('pk')
+                links = links.filter(**{source + '__in': allowed})
+            for artifact_id, count in links.order_by().values_list(target).annotate(count=models.Count(source)):
+                counts[artifact_id] = counts.get(artifact_id, 0) + count
+        return counts
+
+
+def without_object(queryset):
+    """
+    Filters the rows of queryset whose content_type and object_id point to no object
+
+    Uses one anti-join per content type, rows of an uninstalled model or without content type are included.
+    """
+    query = models.Q(content_type__isnull=True)
+    for content_type_id in queryset.order_by().values_list('content_type_id', flat=True).distinct():
+        if content_type_id is None:
+            continue
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is None:
+            query |= models.Q(content_type_id=content_type_id)
+        else:
+            query |= models.Q(content_type_id=content_type_id) & ~models.Exists(
+                model._default_manager.filter(pk=models.OuterRef('object_id')))
+    return queryset.filter(query)
+
+
+def link_table(linked_model):
+    """
+    Returns the relation model of an Artifact link and its (object id, artifact id) column names
+    """
+    field = linked_model.model._meta.get_field(linked_model.reverse_link_name)
+    through = field.remote_field.through
+    return through, '{}_id'.format(field.m2m_field_name()), '{}_id'.format(field.m2m_reverse_field_name())
+
+
 class Artifact(ManyLinkableModel):
     type = models.CharField(max_length=20)
     value = models.TextField()
+    value_hash = models.CharField(max_length=40, editable=False)
+    value_prefix = models.CharField(max_length=LOOKUP_KEY_LENGTH, db_index=True, editable=False)
+    value_suffix = models.CharField(max_length=LOOKUP_KEY_LENGTH, db_index=True, editable=False)
+    ip_key = models.CharField(max_length=33, null=True, db_index=True, editable=False)
+
+    objects = ArtifactQuerySet.as_manager()
+
+    class Meta:
+        # value_hash comes first so that the unique index also serves lookups by value only
+        unique_together = (('value_hash', 'type'),)
+
+    def update_keys(self):
+        self.value_hash = artifact_value_hash(self.value)
+        self.value_prefix, self.value_suffix = artifact_lookup_keys(self.value)
+        self.ip_key = artifact_ip_key(self.value)
+
+    def save(self, *args, **kwargs):
+        self.update_keys()
+        super(Artifact, self).save(*args, **kwargs)
 
     def __str__(self):
         display = self.value
-        if self.relations.count() > 1:
-            display += " (%s)" % self.relations.count()
+        count = self.relations.count()
+        if count > 1:
+            display += " (%s)" % count
         return display
 
 
+def content_digest(text):
+    # The installed artifact types are part of the digest, so that installing a new type rescans everything
+    signature = u",".join(artifacts.extractor.signature())
+    return hashlib.sha1(u"{}\n{}".format(signature, text).encode('utf-8')).hexdigest()
+
+
+class ScannedContentQuerySet(models.QuerySet):
+    def for_objects(self, ids):
+        """
+        Filters on a dict of content type id: object ids
+        """
+        query = models.Q()
+        for content_type_id, object_ids in ids.items():
+            query |= models.Q(content_type_id=content_type_id, object_id__in=object_ids)
+        return self.filter(query)
+
+    def changed(self, sources):
+        """
+        Returns the (object, text, digest) triples of sources whose text was not scanned yet
+
+        sources is an iterable of (object, text) pairs, their stored digests are fetched with a single query.
+        """
+        sources = [(obj, text, content_digest(text)) for obj, text in sources]
+        if not sources:
+            return []
+        ids = dict()
+        for obj, text, digest in sources:
+            ids.setdefault(ContentType.objects.get_for_model(obj).pk, set()).add(obj.pk)
+        stored = set(self.for_objects(ids).values_list('content_type_id', 'object_id', 'digest'))
+        return [(obj, text, digest) for obj, text, digest in sources
+                if (ContentType.objects.get_for_model(obj).pk, obj.pk, digest) not in stored]
+
+    def stale(self):
+        """
+        Filters the digests of deleted objects
+        """
+        return without_object(self)
+
+    def record(self, scanned):
+        """
+        Stores the digests of (object, text, digest) triples returned by changed() once they are scanned
+        """
+        rows = dict(((ContentType.objects.get_for_model(obj).pk, obj.pk), digest) for obj, text, digest in scanned)
+        if not rows:
+            return
+        ids = dict()
+        for content_type_id, object_id in rows:
+            ids.setdefault(content_type_id, set()).add(object_id)
+        with transaction.atomic(using=self.db):
+            self.for_objects(ids).delete()
+            self.bulk_create([ScannedContent(content_type_id=content_type_id, object_id=object_id, digest=digest)
+                              for (content_type_id, object_id), digest in rows.items()], ignore_conflicts=True)
+
+
+class ScannedContent(models.Model):
+    """
+    Digest of the last text scanned for artifacts in an object (incident description, comment, nugget...)
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    digest = models.CharField(max_length=40)
+
+    objects = ScannedContentQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    def __str__(self):
+        return u"{} #{}: {}".format(self.content_type, self.object_id, self.digest)
+
+
+# Files are hashed by chunks of this size, memory usage does not depend on the file size
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def compute_hashes(content):
+    """
+    Returns the md5, sha1 and sha256 digests of a Django File, read once by chunks
+    """
+    hashes = dict((k, hashlib.new(k)) for k in ['md5', 'sha1', 'sha256'])
+    for chunk in content.chunks(HASH_CHUNK_SIZE):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        for digest in hashes.values():
+            digest.update(chunk)
+    return dict((k, digest.hexdigest()) for k, digest in hashes.items())
+
+
 def upload_path(instance, filename):
     return "%s_%s/%s" % (instance.content_type.model, instance.object_id, filename)
 
 
+def blob_path(instance, filename):
+    return "blobs/%s/%s/%s" % (instance.sha256[:2], instance.sha256[2:4], instance.sha256)
+
+
+class FileBlobManager(models.Manager):
+    def store(self, content, hashes=None):
+        """
+        Returns the blob holding content, and adds a reference to it
+
+        Known content is not written again, new content is written once, under its sha256 digest.
+        hashes are the digests returned by compute_hashes(content), when they are already known.
+        """
+        if hashes is None:
+            hashes = compute_hashes(content)
+        while True:
+            with transaction.atomic(using=self.db):
+                blob, created = self.get_or_create(sha256=hashes['sha256'], defaults={
+                    'md5': hashes['md5'], 'sha1': hashes['sha1'], 'size': content.size, 'reference_count': 1})
+                if created:
+                    blob.content.save(hashes['sha256'], content)
+                    return blob
+                # The blob may have been released by its last file in the meantime
+                if self.filter(pk=blob.pk).update(reference_count=models.F('reference_count') + 1):
+                    return blob
+
+    def unreferenced(self):
+        return self.filter(~models.Exists(File.objects.filter(blob=models.OuterRef('pk'))))
+
+    def release(self, blob_id):
+        """
+        Removes a reference to a blob, and deletes it when it was the last one
+        """
+        with transaction.atomic(using=self.db):
+            self.filter(pk=blob_id).update(reference_count=models.F('reference_count') - 1)
+            blob = self.filter(pk=blob_id, reference_count__lte=0).first()
+            if blob is not None:
+                name = blob.content.name
+                storage = blob.content.storage
+                blob.delete()
+                # Only delete the content once nothing can roll the deletion back
+                transaction.on_commit(lambda: storage.delete(name), using=self.db)
+
+
+class FileBlob(models.Model):
+    """
+    Content of uploaded files, stored once per sha256 digest and shared by all the File objects holding it
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    sha1 = models.CharField(max_length=40)
+    md5 = models.CharField(max_length=32)
+    size = models.BigIntegerField()
+    content = models.FileField(upload_to=blob_path, max_length=255, storage=evidence_storage)
+    reference_count = models.PositiveIntegerField(default=0)
+
+    objects = FileBlobManager()
+
+    def __str__(self):
+        return self.sha256
+
+    def get_hashes(self):
+        return {'md5': self.md5, 'sha1': self.sha1, 'sha256': self.sha256}
+
+
+class FileQuerySet(models.QuerySet):
+    def orphaned(self):
+        """
+        Filters files whose related object was deleted
+        """
+        return without_object(self)
+
+
 class File(OneLinkableModel):
 
     hashes = models.ManyToManyField('fir_artifacts.Artifact', blank=True)
     description = models.CharField(max_length=256)
-    file = models.FileField(upload_to=upload_path)
+    file = models.FileField(upload_to=upload_path, storage=evidence_storage)
     date = models.DateTimeField(auto_now_add=True)
+    # With FILE_STORAGE_DEDUPLICATION, file points to the content of blob and filename holds the uploaded name
+    blob = models.ForeignKey(FileBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='files')
+    filename = models.CharField(max_length=255, blank=True)
+
+    objects = FileQuerySet.as_manager()
 
     def __str__(self):
         return self.file.name
 
     def getfilename(self):
+        if self.filename:
+            return self.filename
         return os.path.basename(self.file.name)
 
     def get_hashes(self):
-        hashes = dict((k, None) for k in ['md5', 'sha1', 'sha256'])
-        content = self.file.read()
-        for algo in hashes:
-            m = hashlib.new(algo)
-            m.update(content)
-            hashes[algo] = m.hexdigest()
-        return hashes
+        """
+        Returns the md5, sha1 and sha256 digests of the stored file, read once by chunks
+        """
+        if self.blob_id is not None:
+            return self.blob.get_hashes()
+        with self.file.storage.open(self.file.name, 'rb') as content:
+            return compute_hashes(content)
+
+    def set_blob(self, blob, filename):
+        self.blob = blob
+        self.file.name = blob.content.name
+        self.filename = os.path.basename(filename)
+
+
+@receiver(post_delete, sender=File)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        FileBlob.objects.release(instance.blob_id)
+
+
+def upload_chunk_path(instance, filename):
+    return "chunks/%s/%s" % (instance.upload_id, instance.index)
+
+
+class FileUpload(models.Model):
+    """
+    Chunked upload in progress, assembled into a File attached to content_object once all its chunks are received
+
+    Chunk i holds the bytes from i * chunk_size, all chunks but the last one are chunk_size bytes long.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    filename = models.CharField(max_length=255)
+    description = models.CharField(max_length=256)
+    size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    # Expected sha256 digest of the whole file, checked when the upload is finalized
+    sha256 = models.CharField(max_length=64, blank=True)
+    date = models.DateTimeField(auto_now_add=True)
+    # Time of the last chunk received, the garbage collector deletes the uploads left idle
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    def expected_chunk_size(self, index):
+        if index < self.chunk_count - 1:
+            return self.chunk_size
+        return self.size - self.chunk_size * (self.chunk_count - 1)
+
+    def missing_ranges(self):
+        """
+        Returns the [first, last] indexes of the runs of chunks still to receive, from the received chunks only
+        """
+        ranges = []
+        start = 0
+        for index in self.chunks.order_by('index').values_list('index', flat=True):
+            if index > start:
+                ranges.append([start, index - 1])
+            start = index + 1
+        if start < self.chunk_count:
+            ranges.append([start, self.chunk_count - 1])
+        return ranges
+
+    def missing_chunks(self):
+        return [index for first, last in self.missing_ranges() for index in range(first, last + 1)]
+
+
+class FileUploadChunk(models.Model):
+    upload = models.ForeignKey(FileUpload, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    content = models.FileField(upload_to=upload_chunk_path, max_length=255, storage=evidence_storage)
+
+    class Meta:
+        unique_together = (('upload', 'index'),)
+        ordering = ('index',)
+
+    def __str__(self):
+        return u"{} #{}".format(self.upload_id, self.index)
+
+
+@receiver(post_delete, sender=FileUploadChunk)
+def delete_chunk_content(sender, instance, using, **kwargs):
+    name = instance.content.name
+    storage = instance.content.storage
+    if name:
+        transaction.on_commit(lambda: storage.delete(name), using=using)
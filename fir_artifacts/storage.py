@@ -0,0 +1,346 @@
+import io
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+from django.core.files.storage import Storage, storages
+from django.utils.deconstruct import deconstructible
+
+
+def evidence_storage():
+    """
+    Returns the storage of evidence files (File, FileBlob and FileUploadChunk contents)
+
+    This is the FILES_STORAGE alias of the STORAGES setting, the default storage unless configured.
+    """
+    return storages[getattr(settings, 'FILES_STORAGE', 'default')]
+
+
+def not_found(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3File(File):
+    """
+    Object of an S3 bucket opened for reading
+
+    Reads are streamed by a single GET request from the current position, seeking elsewhere starts
+    a new ranged GET request, so that byte ranges are read without downloading the whole object.
+    """
+    def __init__(self, storage, name):
+        self._storage = storage
+        self.name = name
+        self.mode = 'rb'
+        self._position = 0
+        self._body = None
+        self._size = None
+        self._closed = False
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self._storage.size(self.name)
+        return self._size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def read(self, size=-1):
+        if self._body is None:
+            response = self._storage.get_object(self.name, self._position)
+            if response is None:
+                return b''
+            self._body = response['Body']
+        data = self._body.read() if size is None or size < 0 else self._body.read(size)
+        self._position += len(data)
+        return data
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def open(self, mode=None):
+        self.seek(0)
+        self._closed = False
+        return self
+
+    def close(self):
+        self._close_body()
+        self._closed = True
+
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Stores files as objects of an S3 compatible bucket, through boto3
+
+    Files are written with multipart uploads of part_size bytes, so that they are never held in memory
+    whole, and read with (ranged) streaming GET requests. The client options (endpoint_url, region_name,
+    aws_access_key_id...) are passed to boto3.client, client='memory' uses the in-process InMemoryS3Client.
+    """
+    # S3 refuses multipart upload parts smaller than 5 MiB, the last one excepted
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, bucket, prefix='', part_size=8 * 1024 * 1024, url_expiry=300, client=None, **client_options):
+        if part_size < self.min_part_size:
+            raise ImproperlyConfigured("S3Storage part_size must be at least %d bytes" % self.min_part_size)
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = part_size
+        self.url_expiry = url_expiry
+        self._client = in_memory_client if client == 'memory' else client
+        self._client_options = client_options
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImproperlyConfigured("S3Storage requires boto3")
+            self._client = boto3.client('s3', **self._client_options)
+        return self._client
+
+    def key(self, name):
+        name = name.replace('\\', '/').lstrip('/')
+        if self.prefix:
+            return '%s/%s' % (self.prefix, name)
+        return name
+
+    def get_object(self, name, position=0):
+        """
+        Returns the GET response of an object from position, None when position is past its end
+        """
+        kwargs = {'Bucket': self.bucket, 'Key': self.key(name)}
+        if position:
+            kwargs['Range'] = 'bytes=%d-' % position
+        try:
+            return self.client.get_object(**kwargs)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'InvalidRange':
+                return None
+            if not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def _open(self, name, mode='rb'):
+        if any(c in mode for c in 'wax+'):
+            raise ValueError("S3Storage files can only be opened for reading")
+        return S3File(self, name)
+
+    def _save(self, name, content):
+        key = self.key(name)
+        upload_id = None
+        parts = []
+        buffer = bytearray()
+
+        def upload_part(data):
+            response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                               PartNumber=len(parts) + 1, Body=data)
+            parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+
+        try:
+            for chunk in content.chunks(self.part_size):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                buffer += chunk
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+                    upload_part(bytes(buffer[:self.part_size]))
+                    del buffer[:self.part_size]
+            if upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+            else:
+                if buffer:
+                    upload_part(bytes(buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                      MultipartUpload={'Parts': parts})
+        except Exception:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return name
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def _head(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+
+    def exists(self, name):
+        try:
+            self._head(name)
+        except Exception as e:
+            if not_found(e):
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        try:
+            return self._head(name)['ContentLength']
+        except Exception as e:
+            if not_found(e):
+                raise FileNotFoundError(name)
+            raise
+
+    def get_modified_time(self, name):
+        return self._head(name)['LastModified']
+
+    def listdir(self, path):
+        prefix = self.key(path).rstrip('/')
+        prefix = prefix + '/' if prefix else ''
+        directories, files = [], []
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix, 'Delimiter': '/'}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            directories.extend(p['Prefix'][len(prefix):].rstrip('/') for p in response.get('CommonPrefixes', []))
+            files.extend(o['Key'][len(prefix):] for o in response.get('Contents', []))
+            if not response.get('IsTruncated'):
+                return directories, files
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def url(self, name):
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)},
+                                                  ExpiresIn=self.url_expiry)
+
+
+class InMemoryS3Error(Exception):
+    def __init__(self, code, message=''):
+        super(InMemoryS3Error, self).__init__(message or code)
+        self.response = {'Error': {'Code': code, 'Message': message or code}}
+
+
+class InMemoryS3Client(object):
+    """
+    In-process stand-in for the part of the boto3 S3 client used by S3Storage, for tests and development
+
+    The names of the called operations are recorded in calls.
+    """
+    def __init__(self):
+        self.objects = dict()
+        self.uploads = dict()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _get(self, Bucket, Key):
+        try:
+            return self.objects[(Bucket, Key)]
+        except KeyError:
+            raise InMemoryS3Error('NoSuchKey')
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append('put_object')
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            self.objects[(Bucket, Key)] = (data, datetime.now(timezone.utc))
+        return {'ETag': '"%s"' % uuid.uuid4().hex}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.calls.append('get_object')
+        data, modified = self._get(Bucket, Key)
+        if Range is not None:
+            start, end = Range[len('bytes='):].split('-')
+            start = int(start)
+            end = int(end) + 1 if end else len(data)
+            if start >= len(data):
+                raise InMemoryS3Error('InvalidRange')
+            data = data[start:end]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'LastModified': modified}
+
+    def head_object(self, Bucket, Key):
+        self.calls.append('head_object')
+        try:
+            data, modified = self._get(Bucket, Key)
+        except InMemoryS3Error:
+            raise InMemoryS3Error('404')
+        return {'ContentLength': len(data), 'LastModified': modified}
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append('delete_object')
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append('create_multipart_upload')
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = (Bucket, Key, dict())
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append('upload_part')
+        etag = '"%s"' % uuid.uuid4().hex
+        self.uploads[UploadId][2][PartNumber] = (etag, Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append('complete_multipart_upload')
+        stored = self.uploads[UploadId][2]
+        parts = [stored[part['PartNumber']] for part in MultipartUpload['Parts']]
+        if any(etag != part['ETag'] for (etag, data), part in zip(parts, MultipartUpload['Parts'])):
+            raise InMemoryS3Error('InvalidPart')
+        if any(len(data) < S3Storage.min_part_size for etag, data in parts[:-1]):
+            raise InMemoryS3Error('EntityTooSmall')
+        with self._lock:
+            del self.uploads[UploadId]
+            self.objects[(Bucket, Key)] = (b''.join(data for etag, data in parts), datetime.now(timezone.utc))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None):
+        self.calls.append('list_objects_v2')
+        contents, prefixes = [], set()
+        for bucket, key in sorted(self.objects):
+            if bucket != Bucket or not key.startswith(Prefix):
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+            else:
+                contents.append({'Key': key, 'Size': len(self.objects[(bucket, key)][0])})
+        return {'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in sorted(prefixes)],
+                'IsTruncated': False}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return 'memory://%s/%s?expires=%d' % (Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+# Shared by the S3Storage instances configured with client='memory'
+in_memory_client = InMemoryS3Client()
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+
+from fir_artifacts import artifacts
+from fir_artifacts.models import File
+from fir_celery.celeryconf import celery_app
+
+
+@celery_app.task
+def refresh_artifacts(content_type_id, object_id):
+    artifacts.refresh_queue.started(content_type_id, object_id)
+    model = ContentType.objects.get_for_id(content_type_id).model_class()
+    try:
+        obj = model.objects.get(pk=object_id)
+    except model.DoesNotExist:
+        return
+    obj.refresh_artifacts(asynchronous=False)
+
+
+@celery_app.task
+def hash_file(file_id):
+    from fir_artifacts.files import link_hashes
+
+    try:
+        f = File.objects.get(pk=file_id)
+    except File.DoesNotExist:
+        return
+    link_hashes(f)
+
+
+@celery_app.task
+def scan_file(file_id):
+    from fir_artifacts.files import scan_file
+
+    try:
+        f = File.objects.get(pk=file_id)
+    except File.DoesNotExist:
+        return
+    scan_file(f)
+
+
+@celery_app.task
+def collect_garbage(dry_run=False, min_age_hours=24, storage=False, upload_expiry_hours=24):
+    from fir_artifacts.garbage import GarbageCollector
+
+    return GarbageCollector(dry_run=dry_run, min_age=timedelta(hours=min_age_hours), storage=storage,
+                            upload_expiry=timedelta(hours=upload_expiry_hours)).collect()
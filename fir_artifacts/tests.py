@@ -0,0 +1,971 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from fir_artifacts import artifacts, files
+from fir_artifacts import models as artifacts_models
+from fir_artifacts.models import Artifact, ArtifactBlacklistItem
+from fir_artifacts.garbage import GarbageCollector
+from fir_artifacts.storage import InMemoryS3Client, S3Storage
+from incidents import models as incidents_models
+
+
+SAMPLE = """
+Phishing campaign reported by user@example.com, see https://login.evil-bank.com/account/verify?id=42
+and http://203.0.113.7:8080/payload.exe (sha256 9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08).
+Callback to c2.bad-domain.net and 198.51.100.23 1.2.3.4 5.6.7.8, md5: d41d8cd98f00b204e9800998ecf8427e.
+Not a hostname: file.unknowntld
+"""
+
+
+class ArtifactExtractorTestCase(TestCase):
+    def tearDown(self):
+        artifacts.blacklist.invalidate()
+
+    def per_class_find(self, data):
+        return dict((key, artifact_class.find(data))
+                    for key, artifact_class in artifacts.INSTALLED_ARTIFACTS.items())
+
+    def test_same_results_as_per_class_find(self):
+        self.assertEqual(artifacts.extract(SAMPLE), self.per_class_find(SAMPLE))
+
+    def test_all_installed_types(self):
+        self.assertEqual(sorted(artifacts.extract("").keys()), sorted(artifacts.INSTALLED_ARTIFACTS.keys()))
+
+    def test_values(self):
+        found = artifacts.extract(SAMPLE)
+        self.assertIn('user@example.com', found['email'])
+        self.assertIn('https://login.evil-bank.com/account/verify?id=42', found['url'])
+        self.assertIn('c2.bad-domain.net', found['hostname'])
+        self.assertNotIn('file.unknowntld', found['hostname'])
+        self.assertIn('d41d8cd98f00b204e9800998ecf8427e', found['hash'])
+        self.assertIn('198.51.100.23', found['ip'])
+
+    def scan(self, data, **kwargs):
+        with mock.patch.object(artifacts, 'SCAN_WINDOW_SIZE', 64), mock.patch.object(artifacts, 'SCAN_OVERLAP', 16):
+            return artifacts.scan(io.BytesIO(data.encode('utf-8')), **kwargs)
+
+    def test_scan(self):
+        # Small windows put many values and multibyte characters across window borders
+        data = (u"\u00e9t\u00e9 " + SAMPLE) * 5
+        found, complete = self.scan(data)
+        self.assertTrue(complete)
+        expected = artifacts.find(data)
+        self.assertEqual(sorted(found), sorted(expected))
+        for key in expected:
+            self.assertTrue(set(expected[key]) <= set(found[key]))
+            # The ip pattern consumes the delimiters around its match, so that in a single pass it misses
+            # an address following another one, which a window starting with it catches
+            self.assertTrue(set(found[key]) - set(expected[key]) <= {'1.2.3.4'})
+        self.assertIn('https://login.evil-bank.com/account/verify?id=42', found['url'])
+
+    def test_scan_budget(self):
+        data = u"198.51.100.23 " + u"lorem ipsum " * 100 + u"203.0.113.7"
+        found, complete = self.scan(data, max_size=100)
+        self.assertFalse(complete)
+        self.assertEqual(found['ip'], ['198.51.100.23'])
+        self.assertEqual(self.scan(data, max_size=len(data))[1], True)
+        found, complete = self.scan(data, time_limit=0)
+        self.assertFalse(complete)
+        self.assertNotIn('203.0.113.7', found['ip'])
+
+    def test_blacklist(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ArtifactBlacklistItem.objects.create(type='hostname', value='c2.bad-domain.net')
+        found = artifacts.find(SAMPLE)
+        self.assertNotIn('c2.bad-domain.net', found['hostname'])
+        self.assertIn('c2.bad-domain.net', artifacts.extract(SAMPLE)['hostname'])
+
+
+class ArtifactBlacklistTestCase(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item = ArtifactBlacklistItem.objects.create(type='ip', value='10.0.0.1')
+
+    def tearDown(self):
+        artifacts.blacklist.invalidate()
+
+    def test_no_queries_once_loaded(self):
+        artifacts.blacklist.values()
+        with self.assertNumQueries(0):
+            self.assertIn('10.0.0.1', artifacts.blacklist.get('ip'))
+            self.assertEqual(artifacts.blacklist.get('email'), frozenset())
+            artifacts.find(SAMPLE)
+
+    def test_invalidated_on_save(self):
+        self.assertNotIn('10.0.0.2', artifacts.blacklist.get('ip'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ArtifactBlacklistItem.objects.create(type='ip', value='10.0.0.2')
+        self.assertIn('10.0.0.2', artifacts.blacklist.get('ip'))
+
+    def test_invalidated_on_delete(self):
+        self.assertIn('10.0.0.1', artifacts.blacklist.get('ip'))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.item.delete()
+        self.assertNotIn('10.0.0.1', artifacts.blacklist.get('ip'))
+
+    def test_timeout(self):
+        other_process = artifacts.ArtifactBlacklist()
+        self.assertIn('10.0.0.1', other_process.get('ip'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ArtifactBlacklistItem.objects.create(type='ip', value='10.0.0.4')
+        # The change only invalidated the copy of this process
+        self.assertNotIn('10.0.0.4', other_process.get('ip'))
+        now = time.monotonic()
+        with mock.patch.object(time, 'monotonic', return_value=now + 61):
+            self.assertIn('10.0.0.4', other_process.get('ip'))
+
+    @override_settings(ARTIFACTS_BLACKLIST_CACHE='default')
+    def test_shared_cache(self):
+        other_process = artifacts.ArtifactBlacklist()
+        self.assertIn('10.0.0.1', other_process.get('ip'))
+        with self.captureOnCommitCallbacks(execute=True):
+            ArtifactBlacklistItem.objects.create(type='ip', value='10.0.0.3')
+        self.assertIn('10.0.0.3', other_process.get('ip'))
+
+
+class IncidentsMixin(object):
+    fixtures = ['incidents/fixtures/01_seed_data.json', ]
+
+    def setUp(self):
+        self.user = user = User.objects.create_user('user1', 'user1@example.com', 'password')
+        bale, created = incidents_models.BaleCategory.objects.get_or_create(name="Bale category", category_number=1)
+        detections, created = incidents_models.LabelGroup.objects.get_or_create(name='detection')
+        detection, created = incidents_models.Label.objects.get_or_create(name='detection 1', group=detections)
+        category, created = incidents_models.IncidentCategory.objects.get_or_create(name="Incident category",
+                                                                                    bale_subcategory=bale)
+        self.incident_1 = incidents_models.Incident.objects.create(subject="Incident 1", description=SAMPLE,
+                                                                   opened_by=user, category=category,
+                                                                   detection=detection, severity=1)
+        self.incident_2 = incidents_models.Incident.objects.create(subject="Incident 2", description="Test",
+                                                                   opened_by=user, category=category,
+                                                                   detection=detection, severity=1)
+
+    def tearDown(self):
+        artifacts.blacklist.invalidate()
+
+
+class IncidentArtifactsTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        super(IncidentArtifactsTestCase, self).setUp()
+        self.incident_1.refresh_artifacts()
+
+    def test_refresh(self):
+        found = artifacts.find(SAMPLE)
+        expected = set((key, value) for key in found for value in found[key])
+        self.assertEqual(set(self.incident_1.artifacts.values_list('type', 'value')), expected)
+
+    def test_no_duplicates(self):
+        count = Artifact.objects.count()
+        self.incident_2.refresh_artifacts(SAMPLE)
+        self.incident_1.refresh_artifacts(SAMPLE)
+        self.assertEqual(Artifact.objects.count(), count)
+        self.assertEqual(set(self.incident_2.artifacts.all()), set(self.incident_1.artifacts.all()))
+        artifact = Artifact.objects.get(type='email', value='user@example.com')
+        self.assertEqual(set(artifact.incidents.all()), {self.incident_1, self.incident_2})
+
+    def test_bulk_queries(self):
+        artifacts.blacklist.values()
+        # Fetch existing artifacts, link them to the incident
+        with self.assertNumQueries(2):
+            self.incident_2.refresh_artifacts(SAMPLE)
+        # Fetch existing artifacts, insert the new one in a savepoint, link them to the incident
+        with self.assertNumQueries(5):
+            self.incident_2.refresh_artifacts(SAMPLE + " new.example.com")
+
+    def test_post_save_sent_for_new_artifacts(self):
+        created_artifacts = []
+
+        def receiver(sender, instance, created=False, **kwargs):
+            if created:
+                created_artifacts.append((instance.type, instance.value))
+
+        post_save.connect(receiver, sender=Artifact)
+        try:
+            self.incident_2.refresh_artifacts("c2.bad-domain.net other.example.com")
+        finally:
+            post_save.disconnect(receiver, sender=Artifact)
+        self.assertEqual(created_artifacts, [('hostname', 'other.example.com')])
+
+    def test_concurrent_creation(self):
+        created_artifacts = []
+
+        def receiver(sender, instance, created=False, **kwargs):
+            if created:
+                created_artifacts.append((instance.type, instance.value))
+
+        queryset_class = type(Artifact.objects.all())
+        bulk_create = queryset_class.bulk_create
+        inserts = []
+
+        def concurrent_bulk_create(queryset, objs, *args, **kwargs):
+            inserts.append([(a.type, a.value_hash) for a in objs])
+            if len(inserts) == 1:
+                # Another transaction inserted one of the artifacts first, and commits once this insert failed
+                raise IntegrityError()
+            return bulk_create(queryset, objs, *args, **kwargs)
+
+        select_for_update = queryset_class.select_for_update
+
+        def concurrent_select_for_update(queryset, *args, **kwargs):
+            if len(inserts) == 1 and not Artifact.objects.filter(value='b.example.com').exists():
+                other = Artifact(type='hostname', value='b.example.com')
+                other.update_keys()
+                bulk_create(Artifact.objects.all(), [other])
+            return select_for_update(queryset, *args, **kwargs)
+
+        post_save.connect(receiver, sender=Artifact)
+        try:
+            with mock.patch.object(queryset_class, 'bulk_create', concurrent_bulk_create), \
+                    mock.patch.object(queryset_class, 'select_for_update', concurrent_select_for_update):
+                resolved = Artifact.objects.resolve([('hostname', 'c.example.com'), ('hostname', 'a.example.com'),
+                                                     ('hostname', 'b.example.com'), ('email', 'user@example.com')])
+        finally:
+            post_save.disconnect(receiver, sender=Artifact)
+        self.assertEqual(sorted(a.value for a in resolved),
+                         ['a.example.com', 'b.example.com', 'c.example.com', 'user@example.com'])
+        self.assertTrue(all(a.pk for a in resolved))
+        self.assertEqual(sorted(created_artifacts), [('hostname', 'a.example.com'), ('hostname', 'c.example.com')])
+        # Inserted in key order, the conflicting insert is rolled back and sent again without the existing row
+        self.assertEqual(inserts[0], sorted(inserts[0]))
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(inserts[1], sorted(inserts[1]))
+        self.assertEqual(len(inserts[1]), len(inserts[0]) - 1)
+
+    def test_unchanged_sources_skipped(self):
+        with mock.patch.object(artifacts, 'find') as find:
+            self.incident_1.refresh_artifacts()
+            self.incident_1.refresh_artifacts(self.incident_1.description, source=self.incident_1)
+        find.assert_not_called()
+
+    def test_only_changed_sources_scanned(self):
+        comment = incidents_models.Comments.objects.create(comment="Seen on new.example.com", incident=self.incident_1,
+                                                           opened_by=self.user,
+                                                           action=incidents_models.Label.objects.get(name='Opened'))
+        with mock.patch.object(artifacts, 'find', wraps=artifacts.find) as find:
+            self.incident_1.refresh_artifacts()
+        find.assert_called_once_with(comment.comment)
+        self.assertTrue(self.incident_1.artifacts.filter(type='hostname', value='new.example.com').exists())
+
+        with mock.patch.object(artifacts, 'find', wraps=artifacts.find) as find:
+            self.incident_1.refresh_artifacts(comment.comment, source=comment)
+            comment.comment = "Seen on other.example.com"
+            self.incident_1.refresh_artifacts(comment.comment, source=comment)
+        find.assert_called_once_with(comment.comment)
+        self.assertTrue(self.incident_1.artifacts.filter(type='hostname', value='other.example.com').exists())
+
+    def test_incs_for_art(self):
+        incidents = incidents_models.Incident.objects.filter(id__in=artifacts.incs_for_art('*.evil-bank.com'))
+        with self.assertNumQueries(1):
+            self.assertEqual(list(incidents), [self.incident_1])
+        self.assertFalse(incidents_models.Incident.objects.filter(id__in=artifacts.incs_for_art('evil-bank.com')).exists())
+
+
+class ArtifactLookupTestCase(TestCase):
+    def setUp(self):
+        self.long_value = 'http://example.com/' + 'a' * 200 + '/end'
+        for artifact_type, value in [('hostname', 'login.evil.com'), ('hostname', 'evil.com'),
+                                     ('hostname', 'notevil.com.example.org'), ('url', self.long_value),
+                                     ('email', 'User@Example.com')]:
+            Artifact.objects.create(type=artifact_type, value=value)
+
+    def values(self, query):
+        return set(Artifact.objects.lookup(query).values_list('value', flat=True))
+
+    def test_exact(self):
+        self.assertEqual(self.values('evil.com'), {'evil.com'})
+        self.assertEqual(self.values('EVIL.com'), {'evil.com'})
+        self.assertEqual(self.values('user@example.com'), {'User@Example.com'})
+        self.assertEqual(self.values(self.long_value), {self.long_value})
+        self.assertEqual(self.values(self.long_value[:150]), set())
+
+    def test_prefix(self):
+        self.assertEqual(self.values('login.*'), {'login.evil.com'})
+        self.assertEqual(self.values('http://example.com/*'), {self.long_value})
+        self.assertEqual(self.values(self.long_value[:150] + '*'), {self.long_value})
+        self.assertEqual(self.values(self.long_value[:150] + 'b*'), set())
+
+    def test_suffix(self):
+        self.assertEqual(self.values('*.evil.com'), {'login.evil.com'})
+        self.assertEqual(self.values('*evil.com'), {'login.evil.com', 'evil.com'})
+        self.assertEqual(self.values('*' + self.long_value[-150:]), {self.long_value})
+
+    def test_contains(self):
+        self.assertEqual(self.values('*evil*'), {'login.evil.com', 'evil.com', 'notevil.com.example.org'})
+        self.assertEqual(self.values('**'), set())
+
+    def test_cidr(self):
+        for artifact_type, value in [('ip', '10.20.0.1'), ('ip', '10.20.255.255'), ('ip', '10.21.0.0'),
+                                     ('ip', '9.255.255.255'), ('ip', '2001:db8::1'), ('ip', '2001:db9::1')]:
+            Artifact.objects.create(type=artifact_type, value=value)
+        Artifact.objects.resolve([('ip', '10.20.3.4')])
+        self.assertEqual(self.values('10.20.0.0/16'), {'10.20.0.1', '10.20.255.255', '10.20.3.4'})
+        self.assertEqual(self.values('10.0.0.0/8'), {'10.20.0.1', '10.20.255.255', '10.21.0.0', '10.20.3.4'})
+        self.assertEqual(self.values('10.20.0.1/32'), {'10.20.0.1'})
+        self.assertEqual(self.values('2001:db8::/32'), {'2001:db8::1'})
+        self.assertEqual(self.values('0.0.0.0/0'), {'10.20.0.1', '10.20.255.255', '10.21.0.0', '10.20.3.4',
+                                                    '9.255.255.255'})
+        self.assertEqual(self.values('10.20.0.1'), {'10.20.0.1'})
+        self.assertEqual(self.values('http://example.com/*'), {self.long_value})
+
+    def test_bulk_created_keys(self):
+        artifact, = Artifact.objects.resolve([('hostname', 'Bulk.Example.net')])
+        self.assertEqual(self.values('*.example.NET'), {'Bulk.Example.net'})
+
+
+class CorrelationCountTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        super(CorrelationCountTestCase, self).setUp()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        root_1 = incidents_models.BusinessLine.add_root(name='Root 1')
+        child_11 = root_1.add_child(name='Child 11')
+        root_2 = incidents_models.BusinessLine.add_root(name='Root 2')
+        viewer, created = Group.objects.get_or_create(name='Viewer')
+        viewer.permissions.add(Permission.objects.get(codename='view_incidents', content_type__app_label='incidents'))
+        incidents_models.AccessControlEntry.objects.create(user=self.user, business_line=root_1, role=viewer)
+        self.incident_3 = incidents_models.Incident.objects.create(
+            subject="Incident 3", description="Test", opened_by=self.admin, category=self.incident_1.category,
+            detection=self.incident_1.detection, severity=1)
+        for incident, business_lines in [(self.incident_1, [root_1]), (self.incident_2, [root_2]),
+                                         (self.incident_3, [child_11, root_2])]:
+            incident.opened_by = self.admin
+            incident.save()
+            incident.concerned_business_lines.set(business_lines)
+        for incident, text in [(self.incident_1, "a.example.com b.example.com"),
+                               (self.incident_2, "a.example.com b.example.com"),
+                               (self.incident_3, "a.example.com c.example.com")]:
+            incident.refresh_artifacts(text)
+
+    def test_same_as_relations_count(self):
+        for user in [None, self.admin, self.user]:
+            counts = Artifact.objects.all().correlation_counts(user)
+            for artifact in Artifact.objects.all():
+                self.assertEqual(counts.get(artifact.pk, 0), artifact.relations_for_user(user).count())
+        counts = self.incident_1.artifacts.correlation_counts(self.user)
+        self.assertEqual(counts[Artifact.objects.get(value='a.example.com').pk], 2)
+        self.assertEqual(counts[Artifact.objects.get(value='b.example.com').pk], 1)
+
+    def test_display_queries(self):
+        values = list(self.incident_1.artifacts.all())
+        with self.assertNumQueries(1):
+            collection = artifacts.INSTALLED_ARTIFACTS['hostname'](values, self.incident_1, user=self.admin)
+        self.assertEqual(collection.correlated_count(), 2)
+
+    def test_all_for_object(self):
+        # Artifacts and their correlation counts, whatever the number of artifacts and types
+        with self.assertNumQueries(2):
+            artifacts.all_for_object(self.incident_1)
+        result, total_count, correlated_count = artifacts.all_for_object(self.incident_1, user=self.user)
+        self.assertEqual(total_count, 2)
+        self.assertEqual(correlated_count, 1)
+        self.assertEqual(len(result), len(artifacts.INSTALLED_ARTIFACTS))
+        hostnames, = [collection for collection in result if isinstance(collection, artifacts.INSTALLED_ARTIFACTS['hostname'])]
+        self.assertEqual(sorted(a.value for a in hostnames._artifacts), ['a.example.com', 'b.example.com'])
+
+
+class ReextractArtifactsTestCase(IncidentsMixin, TestCase):
+    def reextract(self, **options):
+        output = StringIO()
+        call_command('reextract_artifacts', stdout=output, **options)
+        return output.getvalue()
+
+    def test_reextract(self):
+        self.assertFalse(Artifact.objects.exists())
+        self.reextract(processes=1, chunk_size=1)
+        found = artifacts.find(SAMPLE)
+        expected = set((key, value) for key in found for value in found[key])
+        self.assertEqual(set(self.incident_1.artifacts.values_list('type', 'value')), expected)
+        with mock.patch.object(artifacts, 'find') as find:
+            self.incident_1.refresh_artifacts()
+        find.assert_not_called()
+
+    def test_process_pool(self):
+        self.reextract(processes=2)
+        self.assertTrue(self.incident_1.artifacts.filter(type='email', value='user@example.com').exists())
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint')
+            with open(checkpoint, 'w') as f:
+                f.write('{"last_id": %d}' % self.incident_1.pk)
+            self.incident_2.description = "Seen on new.example.com"
+            self.incident_2.save()
+            output = self.reextract(processes=1, checkpoint=checkpoint)
+            self.assertIn("Resuming after incident {}".format(self.incident_1.pk), output)
+            self.assertFalse(self.incident_1.artifacts.exists())
+            self.assertTrue(self.incident_2.artifacts.filter(type='hostname', value='new.example.com').exists())
+            with open(checkpoint) as f:
+                self.assertIn(str(self.incident_2.pk), f.read())
+            self.reextract(processes=1, checkpoint=checkpoint, restart=True)
+            self.assertTrue(self.incident_1.artifacts.exists())
+
+
+class FileTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        super(FileTestCase, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.content = os.urandom(100000)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super(FileTestCase, self).tearDown()
+
+    def upload(self, content=None, name='sample.bin', incident=None):
+        return files.handle_uploaded_file(ContentFile(content or self.content, name=name), "Sample",
+                                          incident or self.incident_1)
+
+    def expected_hashes(self, content=None):
+        return set(hashlib.new(algorithm, content or self.content).hexdigest()
+                   for algorithm in ['md5', 'sha1', 'sha256'])
+
+    def test_hashes(self):
+        with mock.patch.object(artifacts_models, 'HASH_CHUNK_SIZE', 4096):
+            f = self.upload()
+        self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+        self.assertEqual(set(self.incident_1.artifacts.values_list('value', flat=True)), self.expected_hashes())
+
+    def test_batched_upload(self):
+        def artifact_queries(count):
+            contents = [os.urandom(1000) for i in range(count)] + [self.content, self.content]
+            with CaptureQueriesContext(connection) as queries:
+                uploaded = files.handle_uploaded_files(
+                    [(ContentFile(content, name='sample%d.bin' % i), "Sample") for i, content in enumerate(contents)],
+                    self.incident_1)
+            for f, content in zip(uploaded, contents):
+                self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes(content))
+            return len([q for q in queries if 'fir_artifacts_artifact' in q['sql']])
+
+        self.assertEqual(artifact_queries(1), artifact_queries(5))
+        # Both batches hold self.content twice
+        self.assertEqual(self.incident_1.artifacts.count(), 3 * 7)
+        self.assertEqual(Artifact.objects.filter(value=hashlib.sha256(self.content).hexdigest()).count(), 1)
+
+    @override_settings(FILES_ARTIFACT_SCAN=True)
+    def test_scan_file(self):
+        from fir_artifacts.tasks import scan_file
+
+        with mock.patch.object(scan_file, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                f, binary = files.handle_uploaded_files([
+                    (ContentFile(SAMPLE.encode('utf-8'), name='mail.eml'), "Mail"),
+                    (ContentFile(b'\0' + b'198.51.100.23', name='sample.bin'), "Sample")], self.incident_2)
+        self.assertEqual(delay.call_args_list, [mock.call(f.pk), mock.call(binary.pk)])
+        self.assertIsNone(files.scan_file(binary))
+        self.assertFalse(self.incident_2.artifacts.filter(type='ip').exists())
+        scan_file(f.pk)
+        values = set(self.incident_2.artifacts.values_list('value', flat=True))
+        self.assertTrue({'198.51.100.23', 'c2.bad-domain.net', 'user@example.com'} <= values)
+
+    @override_settings(FILES_ASYNC_HASHING_SIZE=1000)
+    def test_async_hashing(self):
+        from fir_artifacts.tasks import hash_file
+
+        with mock.patch.object(hash_file, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                small = self.upload(content=b'small')
+                f = self.upload()
+        delay.assert_called_once_with(f.pk)
+        self.assertEqual(set(small.hashes.values_list('value', flat=True)), self.expected_hashes(b'small'))
+        self.assertFalse(f.hashes.exists())
+        hash_file(f.pk)
+        self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+
+    def stored_files(self):
+        return [os.path.join(root, name) for root, dirs, names in os.walk(self.media_root) for name in names]
+
+    @override_settings(FILE_STORAGE_DEDUPLICATION=True)
+    def test_deduplication(self):
+        first = self.upload(name='first.bin')
+        with mock.patch.object(artifacts_models, 'compute_hashes', wraps=artifacts_models.compute_hashes) as hashes:
+            second = self.upload(name='second.bin', incident=self.incident_2)
+        # Only the upload itself is hashed to find its blob
+        self.assertEqual(hashes.call_count, 1)
+        self.assertEqual(first.blob, second.blob)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual(second.getfilename(), 'second.bin')
+        self.assertEqual(len(self.stored_files()), 1)
+        second.blob.refresh_from_db()
+        self.assertEqual(second.blob.reference_count, 2)
+        self.assertEqual(set(second.hashes.values_list('value', flat=True)), self.expected_hashes())
+        self.assertEqual(set(self.incident_2.artifacts.values_list('value', flat=True)), self.expected_hashes())
+        with second.file.open('rb') as content:
+            self.assertEqual(content.read(), self.content)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(len(self.stored_files()), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.incident_2.delete()
+        self.assertFalse(artifacts_models.FileBlob.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+
+    def download_archive(self, **params):
+        url = reverse('artifacts:download_archive', args=[ContentType.objects.get_for_model(self.incident_1).pk,
+                                                          self.incident_1.pk])
+        return self.client.get(url, params)
+
+    def test_download_archive(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.upload(name='first.bin')
+        self.upload(content=b'second file', name='second.txt')
+        for params, compression in [({}, zipfile.ZIP_DEFLATED), ({'compression': '0'}, zipfile.ZIP_STORED)]:
+            response = self.download_archive(**params)
+            self.assertTrue(response.streaming)
+            chunks = list(response.streaming_content)
+            self.assertGreater(len(chunks), 2)
+            with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+                self.assertIsNone(archive.testzip())
+                self.assertEqual(archive.read('first.bin'), self.content)
+                self.assertEqual(archive.read('second.txt'), b'second file')
+                self.assertEqual(set(info.compress_type for info in archive.infolist()), {compression})
+
+    def download(self, f, **headers):
+        return self.client.get(reverse('artifacts:download_file', args=[f.pk]), **headers)
+
+    def test_download_ranges(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        f = self.upload()
+        size = len(self.content)
+        response = self.download(f)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(int(response['Content-Length']), size)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=sample.bin')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        for header, start, end in [('bytes=10-19', 10, 19), ('bytes=-5', size - 5, size - 1),
+                                   ('bytes=99990-', 99990, size - 1), ('bytes=99990-200000', 99990, size - 1)]:
+            response = self.download(f, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (start, end, size))
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+            self.assertEqual(b''.join(response.streaming_content), self.content[start:end + 1])
+
+        response = self.download(f, HTTP_RANGE='bytes=%d-' % size)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % size)
+        response = self.download(f, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+        # An invalid range, ending before its start, is ignored
+        response = self.download(f, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['Content-Length']), size)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_download_front_end_server(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        f = self.upload(name='sample report.txt')
+        with self.settings(FILES_DOWNLOAD_BACKEND='x-accel-redirect'):
+            response = self.download(f)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-uploads/' + f.file.name.replace(' ', '%20'))
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(response.content, b'')
+        with self.settings(FILES_DOWNLOAD_BACKEND='x-sendfile'):
+            response = self.download(f)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media_root, f.file.name))
+
+    def test_download_permission(self):
+        f = self.upload()
+        self.client.force_login(User.objects.create_user('other', 'other@example.com', 'other'))
+        with self.settings(FILES_DOWNLOAD_BACKEND='x-accel-redirect'):
+            response = self.download(f)
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def chunked_upload(self, chunk_size=30000, **kwargs):
+        return artifacts_models.FileUpload.objects.create(
+            user=self.user, content_object=self.incident_1, filename='sample.bin', description="Sample",
+            size=len(self.content), chunk_size=chunk_size, **kwargs)
+
+    def send_chunks(self, upload, indexes=None):
+        for index in indexes if indexes is not None else range(upload.chunk_count):
+            data = self.content[index * upload.chunk_size:(index + 1) * upload.chunk_size]
+            files.store_chunk(upload, index, io.BytesIO(data), hashlib.sha256(data).hexdigest())
+
+    def test_chunked_upload(self):
+        upload = self.chunked_upload(sha256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(upload.chunk_count, 4)
+        self.send_chunks(upload, [3, 1])
+        self.assertEqual(upload.missing_chunks(), [0, 2])
+        self.assertEqual(upload.missing_ranges(), [[0, 0], [2, 2]])
+        with self.assertRaises(files.ChunkedUploadError):
+            files.finalize_upload(upload)
+        # Chunks can be sent again, e.g. after a network error
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send_chunks(upload, [0, 2, 1])
+        self.assertEqual(upload.chunks.count(), 4)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'chunks', str(upload.pk)))), 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            f = files.finalize_upload(upload)
+        with f.file.open('rb') as content:
+            self.assertEqual(content.read(), self.content)
+        self.assertEqual(f.getfilename(), 'sample.bin')
+        self.assertEqual(f.get_related(), self.incident_1)
+        self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+        self.assertFalse(artifacts_models.FileUpload.objects.exists())
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'chunks', str(upload.pk))))
+
+    def test_chunk_checks(self):
+        upload = self.chunked_upload()
+        data = self.content[:30000]
+        with self.assertRaises(files.ChunkedUploadError):
+            files.store_chunk(upload, 0, io.BytesIO(data), hashlib.sha256(b'other').hexdigest())
+        with self.assertRaises(files.ChunkedUploadError):
+            files.store_chunk(upload, 0, io.BytesIO(data[:100]), hashlib.sha256(data[:100]).hexdigest())
+        with self.assertRaises(files.ChunkedUploadError):
+            files.store_chunk(upload, 0, io.BytesIO(data + b'x'), hashlib.sha256(data + b'x').hexdigest())
+        with self.assertRaises(files.ChunkedUploadError):
+            files.store_chunk(upload, 4, io.BytesIO(data), hashlib.sha256(data).hexdigest())
+        self.assertFalse(upload.chunks.exists())
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'chunks', str(upload.pk))))
+
+        upload = self.chunked_upload(sha256=hashlib.sha256(b'other').hexdigest())
+        self.send_chunks(upload)
+        with self.assertRaises(files.ChunkedUploadError):
+            files.finalize_upload(upload)
+        self.assertFalse(incidents_models.File.objects.exists())
+        self.assertEqual(upload.missing_chunks(), [])
+
+    def test_chunked_upload_running_hashes(self):
+        upload = self.chunked_upload()
+        self.send_chunks(upload, [0, 1, 2, 1, 3])
+        # Chunks received in order were hashed as they arrived
+        with mock.patch.object(files, 'HashingReader', side_effect=AssertionError):
+            f = files.finalize_upload(upload)
+        with f.file.open('rb') as content:
+            self.assertEqual(content.read(), self.content)
+        self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+
+        # Chunks received out of order, or changed once hashed, are hashed while the file is written
+        for indexes in [[0, 2, 1, 3], [0, 1, 2, 3, 1]]:
+            upload = self.chunked_upload()
+            self.send_chunks(upload, indexes[:4])
+            if indexes[4:]:
+                self.content = self.content[:30000] + os.urandom(30000) + self.content[60000:]
+                self.send_chunks(upload, indexes[4:])
+            with mock.patch.object(files, 'HashingReader', wraps=files.HashingReader) as reader:
+                f = files.finalize_upload(upload)
+            reader.assert_called_once()
+            with f.file.open('rb') as content:
+                self.assertEqual(content.read(), self.content)
+            self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+
+    def test_chunked_upload_conflicts(self):
+        upload = self.chunked_upload()
+        self.send_chunks(upload)
+        # A chunk sent again while the file is written, before the upload is locked
+        with mock.patch.object(files.running_hashes, 'pop', side_effect=lambda *args: self.send_chunks(upload, [1])):
+            with self.assertRaises(files.ChunkedUploadConflict), self.captureOnCommitCallbacks(execute=True):
+                files.finalize_upload(upload)
+        self.assertFalse(incidents_models.File.objects.exists())
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'incident_%d' % self.incident_1.pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            f = files.finalize_upload(upload)
+        with f.file.open('rb') as content:
+            self.assertEqual(content.read(), self.content)
+
+        with self.assertRaises(files.ChunkedUploadConflict):
+            self.send_chunks(upload, [0])
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'chunks', str(upload.pk))))
+
+        upload = self.chunked_upload()
+        self.send_chunks(upload, [0])
+        # The same chunk stored at the same time by another request
+        with mock.patch.object(artifacts_models.FileUploadChunk, 'delete'):
+            with self.assertRaises(files.ChunkedUploadConflict):
+                self.send_chunks(upload, [0])
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'chunks', str(upload.pk)))), 1)
+
+    @override_settings(FILE_STORAGE_DEDUPLICATION=True)
+    def test_chunked_upload_deduplication(self):
+        first = self.upload()
+        upload = self.chunked_upload()
+        self.send_chunks(upload)
+        f = files.finalize_upload(upload)
+        self.assertEqual(f.blob, first.blob)
+        self.assertEqual(artifacts_models.FileBlob.objects.get().reference_count, 2)
+        self.assertEqual(set(f.hashes.values_list('value', flat=True)), self.expected_hashes())
+
+        self.content = os.urandom(70000)
+        upload = self.chunked_upload()
+        self.send_chunks(upload)
+        f = files.finalize_upload(upload)
+        with f.file.open('rb') as content:
+            self.assertEqual(content.read(), self.content)
+        self.assertEqual(f.blob.size, 70000)
+
+
+
+class GarbageCollectorTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        super(GarbageCollectorTestCase, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, FILE_STORAGE_DEDUPLICATION=True)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+        super(GarbageCollectorTestCase, self).tearDown()
+
+    def collect(self, **options):
+        output = StringIO()
+        call_command('artifacts_gc', stdout=output, min_age=1, **options)
+        return output.getvalue()
+
+    def test_collect(self):
+        self.incident_1.refresh_artifacts()
+        linked = set(self.incident_1.artifacts.values_list('pk', flat=True))
+        unlinked = Artifact.objects.create(type='hostname', value='gone.example.com')
+        f = files.handle_uploaded_file(ContentFile(b'kept', name='kept.txt'), "Kept", self.incident_1)
+        orphan = files.handle_uploaded_file(ContentFile(b'orphan', name='orphan.txt'), "Orphan", self.incident_2)
+        incidents_models.File.objects.filter(pk=orphan.pk).update(object_id=999999)
+        orphan_hashes = set(orphan.hashes.values_list('pk', flat=True))
+        # Only held by the orphan file
+        self.incident_2.artifacts.clear()
+        artifacts_models.FileBlob.objects.filter(pk=f.blob_id).update(reference_count=5)
+        unreferenced = artifacts_models.FileBlob.objects.store(ContentFile(b'unreferenced'))
+        artifacts_models.FileBlob.objects.filter(pk=unreferenced.pk).update(reference_count=0)
+        upload = artifacts_models.FileUpload.objects.create(
+            user=self.user, content_object=self.incident_1, filename='old.bin', description="Old", size=10,
+            chunk_size=10)
+        artifacts_models.FileUpload.objects.filter(pk=upload.pk).update(date=timezone.now() - timedelta(days=2),
+                                                                         updated=timezone.now() - timedelta(days=2))
+        artifacts_models.ScannedContent.objects.create(
+            content_type=ContentType.objects.get_for_model(incidents_models.Incident), object_id=999999, digest='0')
+        stray = os.path.join(self.media_root, 'incident_1', 'stray.bin')
+        recent = os.path.join(self.media_root, 'incident_1', 'recent.bin')
+        other = os.path.join(self.media_root, 'static', 'other.bin')
+        for path in [stray, recent, other]:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as stored:
+                stored.write(b'stray')
+        for path in [stray, other, f.blob.content.path]:
+            os.utime(path, (0, 0))
+        orphan_path = orphan.blob.content.path
+
+        output = self.collect(dry_run=True, storage=True)
+        self.assertIn("unlinked artifacts", output)
+        self.assertTrue(Artifact.objects.filter(pk=unlinked.pk).exists())
+        self.assertTrue(incidents_models.File.objects.filter(pk=orphan.pk).exists())
+        self.assertTrue(os.path.exists(stray))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.collect(batch_size=1, storage=True)
+        self.assertFalse(Artifact.objects.filter(pk=unlinked.pk).exists())
+        self.assertFalse(Artifact.objects.filter(pk__in=orphan_hashes - linked).exists())
+        self.assertEqual(set(Artifact.objects.filter(pk__in=linked).values_list('pk', flat=True)), linked)
+        self.assertTrue(f.hashes.exists())
+        self.assertFalse(incidents_models.File.objects.filter(pk=orphan.pk).exists())
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertFalse(artifacts_models.FileBlob.objects.filter(pk=unreferenced.pk).exists())
+        self.assertEqual(artifacts_models.FileBlob.objects.get(pk=f.blob_id).reference_count, 1)
+        self.assertFalse(artifacts_models.FileUpload.objects.exists())
+        self.assertFalse(artifacts_models.ScannedContent.objects.filter(object_id=999999).exists())
+        self.assertTrue(artifacts_models.ScannedContent.objects.exists())
+        self.assertFalse(os.path.exists(stray))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(other))
+        self.assertTrue(os.path.exists(f.blob.content.path))
+
+        report = GarbageCollector().collect()
+        self.assertEqual(sum(report.values()), 0)
+
+    def test_active_upload_kept(self):
+        upload = artifacts_models.FileUpload.objects.create(
+            user=self.user, content_object=self.incident_1, filename='large.bin', description="Large", size=20,
+            chunk_size=10)
+        two_days_ago = timezone.now() - timedelta(days=2)
+        artifacts_models.FileUpload.objects.filter(pk=upload.pk).update(date=two_days_ago, updated=two_days_ago)
+        # Started two days ago, still receiving chunks
+        files.store_chunk(upload, 0, io.BytesIO(b'0123456789'), hashlib.sha256(b'0123456789').hexdigest())
+        GarbageCollector().collect()
+        self.assertTrue(artifacts_models.FileUpload.objects.exists())
+        GarbageCollector(upload_expiry=timedelta(0)).collect()
+        self.assertFalse(artifacts_models.FileUpload.objects.exists())
+
+    def test_artifact_linked_after_selection(self):
+        gone = Artifact.objects.create(type='hostname', value='gone.example.com')
+        relinked = Artifact.objects.create(type='hostname', value='relinked.example.com')
+        batch = Artifact.objects.filter(pk__in=[gone.pk, relinked.pk])
+        self.assertEqual(set(Artifact.objects.unlinked().filter(pk__in=batch.values('pk'))), {gone, relinked})
+        # Linked by a resolve that committed while the batch was waiting for the lock
+        with transaction.atomic():
+            Artifact.objects.link(self.incident_1, Artifact.objects.resolve([('hostname', 'relinked.example.com')]))
+        self.assertEqual(GarbageCollector().delete_artifacts(batch), 1)
+        self.assertFalse(Artifact.objects.filter(pk=gone.pk).exists())
+        self.assertTrue(self.incident_1.artifacts.filter(pk=relinked.pk).exists())
+
+
+class S3StorageTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        super(S3StorageTestCase, self).setUp()
+        self.s3 = InMemoryS3Client()
+        self.storage = S3Storage('evidence', prefix='fir', part_size=S3Storage.min_part_size, client=self.s3)
+        self.patches = [mock.patch.object(field, 'storage', self.storage) for field in [
+            incidents_models.File._meta.get_field('file'), artifacts_models.FileBlob._meta.get_field('content'),
+            artifacts_models.FileUploadChunk._meta.get_field('content')]]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        super(S3StorageTestCase, self).tearDown()
+
+    def test_multipart_upload(self):
+        content = os.urandom(2 * S3Storage.min_part_size + 1000)
+        name = self.storage.save('samples/large.bin', ContentFile(content))
+        self.assertEqual(name, 'samples/large.bin')
+        self.assertEqual(self.s3.calls.count('upload_part'), 3)
+        self.assertIn(('evidence', 'fir/samples/large.bin'), self.s3.objects)
+        self.assertEqual(self.storage.size(name), len(content))
+        with self.storage.open(name) as f:
+            self.assertEqual(f.read(), content)
+
+        self.s3.calls = []
+        with self.storage.open(name) as f:
+            f.seek(S3Storage.min_part_size + 10)
+            self.assertEqual(f.read(100), content[S3Storage.min_part_size + 10:S3Storage.min_part_size + 110])
+            self.assertEqual(f.read(100), content[S3Storage.min_part_size + 110:S3Storage.min_part_size + 210])
+            f.seek(len(content) + 1)
+            self.assertEqual(f.read(), b'')
+        # Sequential reads share a single ranged GET request
+        self.assertEqual(self.s3.calls, ['get_object', 'get_object'])
+
+        self.storage.save('samples/small.bin', ContentFile(b'small'))
+        self.assertIn('put_object', self.s3.calls)
+        self.assertEqual(self.storage.listdir('samples'), ([], ['large.bin', 'small.bin']))
+        self.assertEqual(self.storage.listdir(''), (['samples'], []))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size(name)
+
+    def test_aborted_upload(self):
+        def chunks(chunk_size=None):
+            yield os.urandom(S3Storage.min_part_size)
+            raise IOError("Connection lost")
+
+        content = ContentFile(b'')
+        content.chunks = chunks
+        with self.assertRaises(IOError):
+            self.storage.save('broken.bin', content)
+        self.assertIn('abort_multipart_upload', self.s3.calls)
+        self.assertFalse(self.s3.uploads)
+        self.assertFalse(self.storage.exists('broken.bin'))
+
+    def test_evidence_files(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        content = os.urandom(100000)
+        f = files.handle_uploaded_file(ContentFile(content, name='sample.bin'), "Sample", self.incident_1)
+        self.assertEqual(f.file.name, 'incident_1/sample.bin')
+        self.assertIn(('evidence', 'fir/incident_1/sample.bin'), self.s3.objects)
+        self.assertIn(hashlib.sha256(content).hexdigest(), f.hashes.values_list('value', flat=True))
+
+        for backend in ['python', 'x-sendfile', 'x-accel-redirect']:
+            with self.settings(FILES_DOWNLOAD_BACKEND=backend):
+                response = self.client.get(reverse('artifacts:download_file', args=[f.pk]), HTTP_RANGE='bytes=10-19')
+            # Front-end servers can not send objects of a bucket
+            self.assertNotIn('X-Sendfile', response)
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content[10:20])
+        response = self.client.get(reverse('artifacts:download_file', args=[f.pk]))
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertEqual(b''.join(response.streaming_content), content)
+
+        response = self.client.get(reverse('artifacts:download_archive', args=[
+            ContentType.objects.get_for_model(incidents_models.Incident).pk, self.incident_1.pk]))
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read('sample.bin'), content)
+
+        upload = artifacts_models.FileUpload.objects.create(
+            user=self.user, content_object=self.incident_1, filename='chunked.bin', description="Sample",
+            size=len(content), chunk_size=40000)
+        for index in range(upload.chunk_count):
+            data = content[index * 40000:(index + 1) * 40000]
+            files.store_chunk(upload, index, io.BytesIO(data), hashlib.sha256(data).hexdigest())
+        with self.captureOnCommitCallbacks(execute=True):
+            chunked = files.finalize_upload(upload)
+        with chunked.file.open('rb') as stored:
+            self.assertEqual(stored.read(), content)
+        self.assertFalse([key for bucket, key in self.s3.objects if key.startswith('fir/chunks/')])
+
+
+@override_settings(ARTIFACTS_ASYNC_EXTRACTION=True, ARTIFACTS_ASYNC_CACHE='shared')
+class AsyncExtractionTestCase(IncidentsMixin, TestCase):
+    def setUp(self):
+        from fir_artifacts.tasks import refresh_artifacts
+        super(AsyncExtractionTestCase, self).setUp()
+        self.task = refresh_artifacts
+        # A cache shared between processes, as needed by the celery workers
+        self.cache_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': self.cache_root},
+        })
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_root, ignore_errors=True)
+        super(AsyncExtractionTestCase, self).tearDown()
+
+    def test_queued_after_commit(self):
+        comment = incidents_models.Comments(comment="Seen on new.example.com", incident=self.incident_2,
+                                            opened_by=self.user, action=incidents_models.Label.objects.get(name='Opened'))
+        with mock.patch.object(self.task, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                comment.save()
+                self.incident_2.refresh_artifacts(comment.comment, source=comment)
+                self.incident_2.refresh_artifacts()
+                delay.assert_not_called()
+            self.assertEqual(len(callbacks), 2)
+            # Deduplicated while pending
+            delay.assert_called_once_with(ContentType.objects.get_for_model(self.incident_2).pk, self.incident_2.pk)
+            self.assertTrue(self.incident_2.artifacts_pending)
+        self.assertFalse(self.incident_2.artifacts.exists())
+
+        self.task(*delay.call_args[0])
+        self.assertFalse(self.incident_2.artifacts_pending)
+        self.assertTrue(self.incident_2.artifacts.filter(type='hostname', value='new.example.com').exists())
+
+    def test_requires_shared_cache(self):
+        for alias in (None, 'default'):
+            with self.settings(ARTIFACTS_ASYNC_CACHE=alias):
+                with mock.patch.object(self.task, 'delay') as delay:
+                    with self.assertRaises(ImproperlyConfigured):
+                        self.incident_2.refresh_artifacts()
+                delay.assert_not_called()
+        with self.settings(ARTIFACTS_ASYNC_EXTRACTION=False, ARTIFACTS_ASYNC_CACHE=None):
+            self.assertFalse(self.incident_2.artifacts_pending)
+
+    def test_data_without_source_is_synchronous(self):
+        with mock.patch.object(self.task, 'delay') as delay:
+            self.incident_2.refresh_artifacts("Seen on new.example.com")
+        delay.assert_not_called()
+        self.assertTrue(self.incident_2.artifacts.filter(type='hostname', value='new.example.com').exists())
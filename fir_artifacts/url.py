@@ -6,6 +6,9 @@ from fir_artifacts.artifacts import AbstractArtifact
 class URL(AbstractArtifact):
     key = 'url'
     display_name = 'URLs'
+    regex_flags = re.VERBOSE
+    requires = '/'
+    tokenizable = True
     regex = r"""
         (?P<search>
           ((?P<scheme>[\w]{2,9}):\/\/)?
@@ -27,8 +30,7 @@ class URL(AbstractArtifact):
     @classmethod
     def find(cls, data):
         urls = []
-        _re = re.compile(cls.regex, re.VERBOSE)
-        for i in re.finditer(_re, data):
+        for i in cls.get_regex().finditer(data):
             url = i.group('search')
             if url.find('/') != -1:
                 urls.append(url)
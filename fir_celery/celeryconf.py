@@ -18,6 +18,9 @@ celery_app = Celery(
 
 celery_app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Periodic tasks, run by "celery -A fir_celery.celeryconf beat"
+celery_app.conf.beat_schedule = getattr(settings, 'CELERY_BEAT_SCHEDULE', {})
+
 
 if __name__ == '__main__':
     celery_app.start()
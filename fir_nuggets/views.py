@@ -61,7 +61,7 @@ def new(request, event_id, authorization_target=None):
                 'mode': 'new',
             }
 
-            e.refresh_artifacts(nugget.raw_data)
+            e.refresh_artifacts(nugget.raw_data, source=nugget)
 
             return HttpResponse(dumps(ret), content_type='application/json')
         else:
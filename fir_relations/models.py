@@ -7,6 +7,7 @@ from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
 from fir_plugins.links import registry
+from incidents.authorization import prefetch_permissions
 from incidents.models import Incident, Comments
 
 
@@ -65,7 +66,7 @@ class TemplateRelation(object):
         return self.object._meta.verbose_name
 
     def __str__(self):
-        return self.object
+        return str(self.object)
 
 
 class RelationQuerySet(models.QuerySet):
@@ -92,12 +93,18 @@ class RelationQuerySet(models.QuerySet):
         return relations
 
     def as_template_objects(self, request, relation_type='target'):
-        relations = []
-        for relation in self:
+        relations = list(self.prefetch_related('source', 'target'))
+        # The permission checks of TemplateRelation are then memoized
+        prefetch_permissions(request.user, 'incidents.view_incidents',
+                             [relation.target if relation_type == 'target' else relation.source
+                              for relation in relations])
+        prefetch_permissions(request.user, 'incidents.handle_incidents', [relation.source for relation in relations])
+        template_relations = []
+        for relation in relations:
             template_relation = TemplateRelation(relation, request, relation_type=relation_type)
             if template_relation.can_view:
-                relations.append(template_relation)
-        return relations
+                template_relations.append(template_relation)
+        return template_relations
 
 
 class Relation(models.Model):
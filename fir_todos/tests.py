@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User, Group, Permission
+from django.core.exceptions import PermissionDenied
+from django.test import TestCase, RequestFactory
+
+from incidents import models
+from fir_todos import views
+from fir_todos.models import TodoItem
+
+
+class TodoDeleteTestCase(TestCase):
+    fixtures = ['incidents/fixtures/01_seed_data.json']
+
+    def setUp(self):
+        self.business_line = models.BusinessLine.add_root(name='Root')
+        opener = User.objects.create_user('opener', 'opener@example.com', 'password')
+        self.incident = models.Incident.objects.create(
+            subject='Incident', description='Incident', severity=1, opened_by=opener,
+            category=models.IncidentCategory.objects.first(),
+            detection=models.Label.objects.filter(group__name='detection').first())
+        self.incident.concerned_business_lines.add(self.business_line)
+        self.todo = TodoItem.objects.create(description='Task', incident=self.incident)
+
+    def grant(self, username, codenames):
+        user = User.objects.create_user(username, '{}@example.com'.format(username), 'password')
+        role = Group.objects.create(name=username)
+        role.permissions.set(Permission.objects.filter(content_type__app_label='incidents', codename__in=codenames))
+        models.AccessControlEntry.objects.create(user=user, business_line=self.business_line, role=role)
+        return user
+
+    def delete(self, user):
+        request = RequestFactory().post('/todos/{}/delete/'.format(self.todo.pk))
+        request.user = user
+        return views.delete(request, self.todo.pk)
+
+    def test_handler_can_delete(self):
+        response = self.delete(self.grant('handler', ['view_incidents', 'handle_incidents']))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(TodoItem.objects.filter(pk=self.todo.pk).exists())
+
+    def test_viewer_cannot_delete(self):
+        with self.assertRaises(PermissionDenied):
+            self.delete(self.grant('viewer', ['view_incidents']))
+        self.assertTrue(TodoItem.objects.filter(pk=self.todo.pk).exists())
@@ -9,6 +9,7 @@ from django.http import HttpResponse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models import Q
 
+from incidents.authorization import prefetch_permissions
 from incidents.authorization.decorator import authorization_required
 from incidents.views import is_incident_viewer
 from incidents.models import Incident, model_created, BusinessLine
@@ -61,7 +62,7 @@ def list(request, incident_id, authorization_target=None):
 @login_required
 def delete(request, todo_id):
     todo = get_object_or_404(TodoItem, pk=todo_id)
-    if not request.user.has_perm(todo.incident, 'incidents.handle_incidents'):
+    if not request.user.has_perm('incidents.handle_incidents', obj=todo.incident):
         raise PermissionDenied()
     todo.delete()
 
@@ -107,6 +108,8 @@ def dashboard(request):
     except (PageNotAnInteger, EmptyPage):
         todos = p.page(1)
 
+    # Decides the permission checks of the rows with one query
+    prefetch_permissions(request.user, 'incidents.handle_incidents', [todo.incident for todo in todos])
     return render(request, 'fir_todos/dashboard.html', {'todos': todos})
 
 
@@ -1,4 +1,5 @@
-from .manager import AuthorizationManager
+from .cache import authorization_cache
+from .manager import AuthorizationManager, get_query_mode, prefetch_permissions
 from .backend import ObjectPermissionBackend
 from .decorator import tree_authorization
 from .mixin import AuthorizationModelMixin
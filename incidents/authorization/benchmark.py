@@ -0,0 +1,242 @@
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group, Permission, User
+from django.db import connection, reset_queries
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from incidents import views
+from incidents.authorization.manager import get_query_mode
+from incidents.models import AccessControlEntry, BaleCategory, BusinessLine, BusinessLineClosure, Incident, \
+    IncidentCategory, Label, LabelGroup, Profile
+
+REPORT_VERSION = 1
+QUERY_MODES = ('exists', 'join', 'closure')
+PERMISSION = 'incidents.view_incidents'
+
+
+class AuthorizationBenchmark(object):
+    """
+    Measures incidents.authorization on a synthetic dataset: business line trees of roots trees with depth levels
+    of fanout children under each root, users holding aces access control entries on random nodes, and incidents
+    concerning incident_lines random leaves
+
+    Every operation is measured for sample random users, repeat times, each time with a user object fresh from the
+    database, as in a new request. The report gives the number of queries and the latency of each operation, by
+    query mode. The dataset is created in the current transaction, that the caller may roll back.
+    """
+    def __init__(self, roots=2, depth=3, fanout=5, users=1000, aces=3, incidents=10000, incident_lines=2,
+                 sample=20, repeat=3, objects=50, seed=0, log=None):
+        self.roots = roots
+        self.depth = depth
+        self.fanout = fanout
+        self.users = users
+        self.aces = aces
+        self.incidents = incidents
+        self.incident_lines = incident_lines
+        self.sample = sample
+        self.repeat = repeat
+        self.objects = objects
+        self.seed = seed
+        self.log = log
+        self.random = random.Random(seed)
+        self.dataset = dict()
+
+    def write(self, message):
+        if self.log is not None:
+            self.log(message)
+
+    @property
+    def parameters(self):
+        return dict((name, getattr(self, name)) for name in (
+            'roots', 'depth', 'fanout', 'users', 'aces', 'incidents', 'incident_lines', 'sample', 'repeat',
+            'objects', 'seed'))
+
+    def generate_tree(self):
+        """
+        Creates the business line trees, with bulk inserts of the paths computed level by level
+        """
+        level = [BusinessLine.add_root(name='Benchmark {}'.format(i)) for i in range(self.roots)]
+        nodes = list(level)
+        for depth in range(2, self.depth + 2):
+            children = []
+            for parent in level:
+                for step in range(1, self.fanout + 1):
+                    children.append(BusinessLine(
+                        name='{} {}'.format(parent.name, step), depth=depth, numchild=0,
+                        path=BusinessLine._get_path(parent.path, depth, step)))
+            BusinessLine.objects.bulk_create(children, batch_size=1000)
+            BusinessLine.objects.filter(pk__in=[parent.pk for parent in level]).update(numchild=self.fanout)
+            level = children
+            nodes.extend(children)
+        # bulk_create does not set the primary keys on every database
+        nodes = list(BusinessLine.objects.filter(path__in=[node.path for node in nodes]))
+        self.dataset['business_lines'] = len(nodes)
+        return nodes
+
+    def generate_users(self, nodes):
+        suffix = '{:x}'.format(int(time.time() * 1000))
+        password = make_password(None)
+        User.objects.bulk_create([User(username='benchmark-{}-{}'.format(suffix, i), password=password)
+                                  for i in range(self.users)], batch_size=1000)
+        users = list(User.objects.filter(username__startswith='benchmark-{}-'.format(suffix)).order_by('pk'))
+        Profile.objects.bulk_create([Profile(user=user) for user in users], batch_size=1000)
+
+        viewer = Group.objects.create(name='Benchmark viewer {}'.format(suffix))
+        viewer.permissions.set(Permission.objects.filter(content_type__app_label='incidents',
+                                                         codename='view_incidents'))
+        handler = Group.objects.create(name='Benchmark handler {}'.format(suffix))
+        handler.permissions.set(Permission.objects.filter(content_type__app_label='incidents',
+                                                          codename__in=['view_incidents', 'handle_incidents']))
+        entries = []
+        for user in users:
+            for node in self.random.sample(nodes, min(self.aces, len(nodes))):
+                entries.append(AccessControlEntry(user=user, business_line=node,
+                                                  role=self.random.choice((viewer, handler))))
+        AccessControlEntry.objects.bulk_create(entries, batch_size=1000)
+        self.dataset['users'] = len(users)
+        self.dataset['access_control_entries'] = len(entries)
+        return users
+
+    def generate_incidents(self, nodes):
+        leaves = [node for node in nodes if node.depth == self.depth + 1]
+        opener = User.objects.create(username='benchmark-opener-{:x}'.format(int(time.time() * 1000)),
+                                     password=make_password(None))
+        bale = BaleCategory.objects.create(name='Benchmark', category_number=0)
+        category = IncidentCategory.objects.create(name='Benchmark', bale_subcategory=bale)
+        detection = Label.objects.create(name='Benchmark', group=LabelGroup.objects.get_or_create(
+            name='detection')[0])
+        through = Incident.concerned_business_lines.through
+        tree_nodes = dict(BusinessLine.objects.values_list('path', 'pk'))
+        start = datetime(2015, 1, 1)
+        created = 0
+        while created < self.incidents:
+            batch = range(created, min(created + 1000, self.incidents))
+            incidents = Incident.objects.bulk_create([Incident(
+                subject='Benchmark incident {}'.format(i), description='Benchmark', category=category,
+                detection=detection, severity=self.random.randint(1, 4), status=self.random.choice('OOBC'),
+                opened_by=opener, date=start + timedelta(minutes=i)) for i in batch])
+            if incidents[0].pk is None:
+                incidents = list(Incident.objects.filter(opened_by=opener).order_by('pk')[created:])
+            through.objects.bulk_create([
+                through(incident_id=incident.pk, businessline_id=node.pk) for incident in incidents
+                for node in self.random.sample(leaves, min(self.incident_lines, len(leaves)))])
+            BusinessLineClosure.objects.refresh([incident.pk for incident in incidents], nodes=tree_nodes)
+            created += len(incidents)
+        self.dataset['incidents'] = created
+        return list(Incident.objects.filter(opened_by=opener).values_list('pk', flat=True))
+
+    def generate(self):
+        started = time.time()
+        nodes = self.generate_tree()
+        self.write(u"{} business lines".format(len(nodes)))
+        users = self.generate_users(nodes)
+        self.write(u"{} users, {} access control entries".format(len(users), self.dataset['access_control_entries']))
+        incident_ids = self.generate_incidents(nodes)
+        self.write(u"{} incidents".format(len(incident_ids)))
+        self.dataset['generation_seconds'] = round(time.time() - started, 3)
+        return [user.pk for user in users], incident_ids
+
+    def measure(self, results, name, run):
+        """
+        Runs run() and adds its number of queries and duration to the results of name
+        """
+        # The query log is bounded, a full log would make the count wrong
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            run()
+            duration = time.perf_counter() - started
+        result = results.setdefault(name, {'queries': [], 'seconds': []})
+        result['queries'].append(len(queries.captured_queries))
+        result['seconds'].append(duration)
+
+    def run_user(self, results, user_id, incident_ids):
+        factory = RequestFactory()
+        objects = list(Incident.objects.filter(pk__in=incident_ids))
+
+        def fresh_user():
+            return User.objects.get(pk=user_id)
+
+        user = fresh_user()
+        self.measure(results, 'get_authorization_paths',
+                     lambda: BusinessLine.get_authorization_paths(user, PERMISSION))
+        user = fresh_user()
+        self.measure(results, 'for_user count', lambda: Incident.authorization.for_user(user, PERMISSION).count())
+        user = fresh_user()
+        self.measure(results, 'for_user page', lambda: list(
+            Incident.authorization.for_user(user, PERMISSION).order_by('-date')[:50]))
+        user = fresh_user()
+        self.measure(results, 'has_perm', lambda: [incident.has_perm(user, PERMISSION) for incident in objects])
+        user = fresh_user()
+        self.measure(results, 'permitted_ids',
+                     lambda: Incident.authorization.permitted_ids(user, PERMISSION, incident_ids))
+
+        request = factory.get('/incidents/dashboard/open/')
+        request.user = fresh_user()
+        self.measure(results, 'dashboard view', lambda: views.dashboard_open(request))
+        request = factory.get('/incidents/search/', {'q': 'Benchmark'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        request.user = fresh_user()
+        self.measure(results, 'search view', lambda: views.search(request))
+
+    def summarize(self, result):
+        seconds = sorted(result['seconds'])
+        return {
+            'calls': len(seconds),
+            'queries': {'min': min(result['queries']), 'median': statistics.median(result['queries']),
+                        'max': max(result['queries'])},
+            'seconds': {'min': seconds[0], 'median': statistics.median(seconds),
+                        'p95': seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))], 'max': seconds[-1]},
+        }
+
+    def run(self, user_ids, incident_ids, modes=None):
+        """
+        Measures the operations for each query mode of modes (the AUTHORIZATION_QUERY_MODE setting by default)
+        and returns the report
+        """
+        if not modes:
+            modes = [get_query_mode()]
+        users = self.random.sample(user_ids, min(self.sample, len(user_ids)))
+        report = {
+            'version': REPORT_VERSION,
+            'created': datetime.now().isoformat(),
+            'parameters': self.parameters,
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'authorization_cache': getattr(settings, 'AUTHORIZATION_CACHE', None),
+            },
+            'dataset': self.dataset,
+            'results': dict(),
+        }
+        for mode in modes:
+            results = dict()
+            with override_settings(AUTHORIZATION_QUERY_MODE=mode):
+                for iteration in range(self.repeat):
+                    for user_id in users:
+                        self.run_user(results, user_id, self.random.sample(
+                            incident_ids, min(self.objects, len(incident_ids))))
+            report['results'][mode] = dict((name, self.summarize(result)) for name, result in results.items())
+            self.write(u"{}: {}".format(mode, ', '.join(
+                u"{} {:.1f}ms".format(name, summary['seconds']['median'] * 1000)
+                for name, summary in report['results'][mode].items())))
+        return report
+
+
+def compare(previous, current):
+    """
+    Yields (mode, operation, previous summary, current summary) for the operations of both reports
+    """
+    for mode, results in current['results'].items():
+        for name, summary in results.items():
+            old = previous.get('results', dict()).get(mode, dict()).get(name)
+            if old is not None:
+                yield mode, name, old, summary
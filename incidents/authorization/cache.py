@@ -0,0 +1,134 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class AuthorizationCache(object):
+    """
+    Store of the tree paths granted to users by their access control entries, by permission
+
+    Paths and object permission checks are memoized on the user object, which the authentication
+    middleware loads for each request, so that they are computed once per request. When the
+    AUTHORIZATION_CACHE setting names a Django cache, paths are also kept across requests, in the
+    process and in that cache, under a version that is changed by every change of the access control
+    entries, roles, user groups or business line tree, so that a change invalidates all processes.
+    """
+    version_key = 'incidents:authorization:version'
+    paths_key = 'incidents:authorization:{}:{}:{}:{}'
+    memo_attribute = '_authorization_memo'
+    # Number of paths kept in the process, the copy is cleared when it grows past it
+    local_size = 10000
+
+    def __init__(self):
+        # Changed by each invalidation in this process, expires the memos of the users
+        self._generation = 0
+        self._paths = dict()
+        self._version = None
+
+    @property
+    def shared_cache(self):
+        alias = getattr(settings, 'AUTHORIZATION_CACHE', None)
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'AUTHORIZATION_CACHE_TIMEOUT', 3600)
+
+    def memo(self, user):
+        memo = getattr(user, self.memo_attribute, None)
+        if memo is None or memo['generation'] != self._generation:
+            memo = {'generation': self._generation, 'paths': dict(), 'checks': dict()}
+            setattr(user, self.memo_attribute, memo)
+        return memo
+
+    def get_paths(self, model, user, permissions, load):
+        """
+        Returns the paths of model granted to user for permissions (a sorted tuple, or None for any permission)
+
+        load is called without arguments to read them from the database when they are not cached.
+        """
+        memo = self.memo(user)['paths']
+        key = (model._meta.label_lower, permissions)
+        paths = memo.get(key)
+        if paths is None:
+            paths = self.get_shared_paths(model, user, permissions, load)
+            memo[key] = paths
+        return paths
+
+    def get_shared_paths(self, model, user, permissions, load):
+        cache = self.shared_cache
+        if cache is None:
+            return load()
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        if self._version != version:
+            self._paths = dict()
+            self._version = version
+        key = self.paths_key.format(version, model._meta.label_lower, user.pk,
+                                    ','.join(permissions) if permissions is not None else '*')
+        # The process copy expires with the timeout too, changes sending no signal are only seen after it
+        now = time.monotonic()
+        paths, expires = self._paths.get(key, (None, None))
+        if paths is None or (expires is not None and expires <= now):
+            paths = cache.get(key)
+            if paths is None:
+                paths = load()
+                cache.set(key, paths, self.timeout)
+            if len(self._paths) >= self.local_size:
+                self._paths = dict()
+            timeout = self.timeout
+            self._paths[key] = (paths, now + timeout if timeout is not None else None)
+        return paths
+
+    def check(self, user, obj, permissions, test):
+        """
+        Returns the result of test() for a permission check of user on obj, computed once per request
+        """
+        memo = self.memo(user)['checks']
+        key = (obj._meta.label_lower, obj.pk, permissions)
+        result = memo.get(key)
+        if result is None:
+            result = memo[key] = test()
+        return result
+
+    def set_checks(self, user, model, permissions, results):
+        """
+        Memoizes for the request the results of the checks of user on the objects of model, by primary key
+        """
+        memo = self.memo(user)['checks']
+        label = model._meta.label_lower
+        for pk, result in results.items():
+            memo[(label, pk, permissions)] = result
+
+    def invalidate(self):
+        self._generation += 1
+        self._paths = dict()
+        cache = self.shared_cache
+        if cache is not None:
+            cache.set(self.version_key, uuid.uuid4().hex, None)
+
+    def invalidate_on_commit(self):
+        # Invalidated again once committed, other processes may have cached the previous paths in the meantime
+        self.invalidate()
+        transaction.on_commit(self.invalidate)
+
+
+authorization_cache = AuthorizationCache()
+
+
+def permission_key(permission):
+    """
+    Returns permission, a permission name or a list of them, as a sorted tuple of names, None stays None
+    """
+    if permission is None:
+        return None
+    if isinstance(permission, str):
+        return (permission,)
+    return tuple(sorted(set(permission)))
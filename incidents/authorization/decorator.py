@@ -1,11 +1,10 @@
-import functools
-
 from django.core.exceptions import PermissionDenied
 from django.db import models
 from django.db.models import Q
 from django.apps.registry import apps
 
-from incidents.authorization import AuthorizationManager
+from incidents.authorization import AuthorizationManager, get_query_mode
+from incidents.authorization.cache import authorization_cache, permission_key
 
 
 def get_authorization_filter(cls, user, permission=None, fields=None):
@@ -18,7 +17,15 @@ def get_authorization_filter(cls, user, permission=None, fields=None):
         fields = cls._authorization_meta.fields
     if isinstance(fields, str):
         fields = (fields,)
-    objects = cls._authorization_meta.model.get_authorization_objects_filter(user, fields, permission=permission)
+    mode = get_query_mode()
+    if mode == 'closure' and cls._authorization_meta.closure is not None:
+        objects = cls._authorization_meta.model.get_authorization_closure_filter(
+            user, cls._authorization_meta.closure_model, permission=permission)
+    elif mode != 'join':
+        objects = cls._authorization_meta.model.get_authorization_exists_filter(user, cls, fields,
+                                                                                permission=permission)
+    else:
+        objects = cls._authorization_meta.model.get_authorization_objects_filter(user, fields, permission=permission)
     if cls._authorization_meta.owner_field and cls._authorization_meta.owner_permission and \
                     cls._authorization_meta.owner_permission in permission:
         objects |= Q(**{cls._authorization_meta.owner_field: user.pk})
@@ -28,23 +35,26 @@ def get_authorization_filter(cls, user, permission=None, fields=None):
 def has_perm(self, user, permission):
     if user.is_superuser:
         return True
-    if isinstance(permission, str):
-        permission = [permission, ]
+    permission = permission_key(permission)
     if user.has_perms(permission):
         return True
     if self._authorization_meta.owner_field and self._authorization_meta.owner_permission and \
        self._authorization_meta.owner_permission in permission and \
-       user.pk == getattr(self, self._authorization_meta.owner_field).pk:
+       user.pk == getattr(self, self._meta.get_field(self._authorization_meta.owner_field).attname):
         return True
-    paths = self._authorization_meta.model.get_authorization_paths(user, permission)
-    if not paths.count():
+    return authorization_cache.check(user, self, permission, lambda: has_tree_perm(self, user, permission))
+
+
+def has_tree_perm(self, user, permission):
+    tree_model = self._authorization_meta.model
+    paths = tree_model.get_authorization_paths(user, permission)
+    if not paths:
         return False
     for field in self._authorization_meta.fields:
         f = self._meta.get_field(field)
         relation = getattr(self, field)
         if isinstance(f, models.ManyToManyField):
-            qs_filter = functools.reduce(lambda x, y: x | y, [Q(path__startswith=path) for path in paths])
-            if relation.filter(qs_filter).distinct().exists():
+            if relation.filter(tree_model.get_subtrees_filter(paths)).distinct().exists():
                 return True
         elif isinstance(f, models.ForeignKey):
             if relation is not None and any(relation.path.startswith(p) for p in paths):
@@ -60,7 +70,15 @@ def has_model_perm(cls, user, permission):
     return model_perm
 
 
-def tree_authorization(fields=None, tree_model='incidents.BusinessLine', owner_field=None, owner_permission=None):
+def tree_authorization(fields=None, tree_model='incidents.BusinessLine', owner_field=None, owner_permission=None,
+                       closure=None):
+    """
+    Adds tree based authorization to a model, whose objects are granted through the tree nodes linked by fields
+
+    closure optionally names a model with a foreign key to the decorated model and one to the tree model,
+    that holds a row for each object and each of its nodes and their ancestors. It is used for filters
+    instead of fields with AUTHORIZATION_QUERY_MODE = 'closure'.
+    """
     def set_meta(cls):
         if not hasattr(cls, '_authorization_meta'):
             class AuthorizationMeta:
@@ -68,6 +86,7 @@ def tree_authorization(fields=None, tree_model='incidents.BusinessLine', owner_f
                 owner_permission = None
                 fields = ('business_lines',)
                 tree_model = None
+                closure = None
 
                 @property
                 def model(self):
@@ -75,8 +94,16 @@ def tree_authorization(fields=None, tree_model='incidents.BusinessLine', owner_f
                         self.tree_model = apps.get_model(*self.tree_model.split('.'))
                     return self.tree_model
 
+                @property
+                def closure_model(self):
+                    if isinstance(self.closure, str):
+                        self.closure = apps.get_model(*self.closure.split('.'))
+                    return self.closure
+
             AuthorizationMeta.tree_model = tree_model
             cls._authorization_meta = AuthorizationMeta()
+        if closure is not None:
+            cls._authorization_meta.closure = closure
         if fields is not None:
             if isinstance(fields, (tuple, list)):
                 cls._authorization_meta.fields = fields
@@ -1,7 +1,42 @@
+from django.conf import settings
 from django.db import models
 
+from incidents.authorization.cache import authorization_cache, permission_key
+
+
+def get_query_mode():
+    """
+    Returns how authorization filters look up the tree nodes related to objects (AUTHORIZATION_QUERY_MODE):
+
+    'exists' with EXISTS subqueries on the many-to-many fields, 'join' with joins, that multiply the rows and
+    need a DISTINCT, 'closure' through the closure model of the objects, for the models that declare one.
+    """
+    return getattr(settings, 'AUTHORIZATION_QUERY_MODE', 'exists')
+
+
+def prefetch_permissions(user, permission, objects):
+    """
+    Decides permission on all objects with one query per model, so that their has_perm checks need no query
+
+    Objects whose model has no authorization manager are skipped.
+    """
+    ids = dict()
+    for obj in objects:
+        if obj is not None and isinstance(getattr(type(obj), 'authorization', None), AuthorizationManager):
+            ids.setdefault(type(obj), set()).add(obj.pk)
+    for model, model_ids in ids.items():
+        model.authorization.permitted_ids(user, permission, model_ids)
+
+
 class AuthorizationManager(models.Manager):
     def for_user(self, user, permission=None):
+        """
+        Returns the queryset of the objects user is granted permission on, a permission name or a list of them
+
+        The queryset holds each object once, but only the 'join' query mode makes it DISTINCT: like the querysets
+        of superusers, it returns duplicate rows once filtered across a multi-valued relation (e.g.
+        .filter(comments__comment__icontains=...)), and callers doing so must add .distinct() themselves.
+        """
         if isinstance(permission, str):
             permission = (permission,)
         if user.is_superuser:
@@ -9,4 +44,20 @@ class AuthorizationManager(models.Manager):
         if permission is not None and user.has_perms(permission):
             return self.get_queryset()
         qs_filter = self.model.get_authorization_filter(user, permission)
-        return self.get_queryset().filter(qs_filter).distinct()
+        if get_query_mode() == 'join':
+            return self.get_queryset().filter(qs_filter).distinct()
+        return self.get_queryset().filter(qs_filter)
+
+    def permitted_ids(self, user, permission, ids):
+        """
+        Returns the set of the primary keys in ids of the objects user is granted permission on, with one query
+
+        The decisions are memoized for the request, so that the has_perm checks of these objects need no query.
+        """
+        ids = set(ids)
+        if user.is_superuser or not ids:
+            return ids
+        permission = permission_key(permission)
+        permitted = set(self.for_user(user, permission).filter(pk__in=ids).values_list('pk', flat=True))
+        authorization_cache.set_checks(user, self.model, permission, dict((pk, pk in permitted) for pk in ids))
+        return permitted
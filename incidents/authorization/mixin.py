@@ -4,6 +4,7 @@ from django.contrib.auth.models import Permission
 from django.db import models
 
 from incidents.authorization import AuthorizationManager
+from incidents.authorization.cache import authorization_cache, permission_key
 
 
 class AuthorizationModelMixin(models.Model):
@@ -32,53 +33,144 @@ class AuthorizationModelMixin(models.Model):
         return permissions
 
     @classmethod
-    def get_authorization_paths(cls, user, permission=None):
-        if user.is_superuser:
-            return cls.objects.all()
-        user_obj = user
-        user = user.pk
-        qs_filter = {'acl__user': user}
-        if permission is not None:
-            if not isinstance(permission, (tuple, list)):
-                permission = (permission,)
-            if user_obj.has_perms(permission):
-                return cls.objects.all()
-
-            permissions = cls._get_permission_ids(permission)
-
+    def _load_authorization_paths(cls, user, permissions):
+        qs_filter = {'acl__user': user.pk}
+        if permissions is not None:
+            permissions = cls._get_permission_ids(permissions)
             if len(permissions) == 1:
                 qs_filter['acl__role__permissions'] = permissions[0]
             else:
                 qs_filter['acl__role__permissions__in'] = permissions
-        return cls.objects.filter(**qs_filter).distinct().values_list('path', flat=True)
+        return cls.collapse_paths(cls.objects.filter(**qs_filter).distinct().values_list('path', flat=True))
+
+    @staticmethod
+    def collapse_paths(paths):
+        """
+        Returns the sorted tuple of the paths that are not under another one, which cover the same subtrees
+        """
+        collapsed = []
+        for path in sorted(paths):
+            if not collapsed or not path.startswith(collapsed[-1]):
+                collapsed.append(path)
+        return tuple(collapsed)
+
+    @classmethod
+    def get_path_successor(cls, path):
+        """
+        Returns the smallest path greater than path and than all the paths under it, None when there is none
+        """
+        for i in reversed(range(len(path))):
+            index = cls.alphabet.index(path[i])
+            if index + 1 < len(cls.alphabet):
+                return path[:i] + cls.alphabet[index + 1]
+        return None
+
+    @classmethod
+    def get_subtrees_filter(cls, paths, field=None):
+        """
+        Returns a lookup on the nodes under paths, or on the objects related to them through field
+
+        Each subtree is a range of the path column, so that the lookup can use its index, unlike LIKE lookups.
+        """
+        key = 'path' if field is None else '{field}__path'.format(field=field)
+        lookups = []
+        for path in paths:
+            lookup = models.Q(**{key + '__gte': path})
+            successor = cls.get_path_successor(path)
+            if successor is not None:
+                lookup &= models.Q(**{key + '__lt': successor})
+            lookups.append(lookup)
+        return functools.reduce(lambda x, y: x | y, lookups)
+
+    @classmethod
+    def _load_root_paths(cls):
+        return tuple(cls.get_root_nodes().values_list('path', flat=True))
+
+    @classmethod
+    def get_authorization_paths(cls, user, permission=None):
+        """
+        Returns the paths of the nodes whose subtrees are granted to user for permission, as a collapsed tuple
+
+        Superusers and holders of the model permission are granted every root node. Paths are memoized
+        for the request and may be cached across requests, see AuthorizationCache.
+        """
+        permission = permission_key(permission)
+        if user.is_superuser or (permission is not None and user.has_perms(permission)):
+            return authorization_cache.get_paths(cls, user, ('*',), cls._load_root_paths)
+        if user.pk is None:
+            return ()
+        return authorization_cache.get_paths(cls, user, permission,
+                                             lambda: cls._load_authorization_paths(user, permission))
 
     @classmethod
     def get_authorization_filter(cls, user, permission=None):
-        lookup = models.Q(pk=0)
-        if permission is not None and user.has_perms(permission):
+        if permission is not None and user.has_perms(permission_key(permission)):
             return models.Q()
         paths = cls.get_authorization_paths(user, permission=permission)
-        if not paths.count():
-            return lookup
-        lookup |= functools.reduce(lambda x, y: x | y, [models.Q(**{'path__startswith': path}) for path in paths])
-        return lookup
+        if not paths:
+            return models.Q(pk=0)
+        return cls.get_subtrees_filter(paths)
 
     @classmethod
     def get_authorization_objects_filter(cls, user, fields, permission=None):
         paths = cls.get_authorization_paths(user, permission=permission)
-        lookup = models.Q(pk=0)
-        if not paths.count():
-            return lookup
+        if not paths:
+            return models.Q(pk=0)
+        if isinstance(fields, str):
+            fields = (fields,)
+        return functools.reduce(lambda x, y: x | y, [cls.get_subtrees_filter(paths, field) for field in fields])
+
+    @classmethod
+    def get_authorization_exists_filter(cls, user, model, fields, permission=None):
+        """
+        Returns a lookup on the objects of model linked to the granted nodes through fields, that joins no table
+
+        Many-to-many fields are looked up with a correlated EXISTS subquery on their through table, so that
+        the objects are not repeated for each of their nodes and the queryset needs no DISTINCT.
+        """
+        paths = cls.get_authorization_paths(user, permission=permission)
+        if not paths:
+            return models.Q(pk=0)
         if isinstance(fields, str):
             fields = (fields,)
+        lookups = []
         for field in fields:
-            key = '{field}__path__startswith'.format(field=field)
-            lookup |= functools.reduce(lambda x, y: x | y, [models.Q(**{key: path}) for path in paths])
-        return lookup
+            f = model._meta.get_field(field)
+            if f.many_to_many:
+                links = f.remote_field.through.objects.filter(
+                    cls.get_subtrees_filter(paths, f.m2m_reverse_field_name()),
+                    **{f.m2m_field_name(): models.OuterRef('pk')})
+                lookups.append(models.Q(models.Exists(links)))
+            else:
+                lookups.append(cls.get_subtrees_filter(paths, field))
+        return functools.reduce(lambda x, y: x | y, lookups)
+
+    @classmethod
+    def get_authorization_closure_filter(cls, user, closure, permission=None):
+        """
+        Returns a lookup on the objects linked by the closure model to one of the granted nodes
+
+        The closure holds a row for each object and each of its nodes and their ancestors, so that the granted
+        objects are selected by node, with a semi-join on the closure index.
+        """
+        paths = cls.get_authorization_paths(user, permission=permission)
+        if not paths:
+            return models.Q(pk=0)
+        relations = dict((f.related_model, f.name) for f in closure._meta.fields if f.many_to_one)
+        node_field = relations.pop(cls)
+        object_field = relations.popitem()[1]
+        nodes = cls.objects.filter(path__in=paths).values('pk')
+        return models.Q(pk__in=closure.objects.filter(**{node_field + '__in': nodes}).values(object_field))
 
     def has_perm(self, user, permission):
-        return self.__class__.authorization.for_user(user, permission).filter(pk=self.pk).distinct().exists()
+        if user.is_superuser:
+            return True
+        # Paths of existing nodes, a node is granted when one of them is its own path or an ancestor's
+        return any(self.path.startswith(path) for path in self.get_authorization_paths(user, permission))
 
     @classmethod
     def has_model_perm(cls, user, permission):
-        return cls.authorization.for_user(user, permission).distinct().exists()
+        permission = permission_key(permission)
+        if user.is_superuser or (permission is not None and user.has_perms(permission)):
+            return cls.objects.exists()
+        return bool(cls.get_authorization_paths(user, permission))
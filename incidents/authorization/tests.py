@@ -1,7 +1,14 @@
+import json
+from io import StringIO
+
 from django.contrib.auth.models import User, Group, Permission
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db.models import Q
+from django.test import TestCase, override_settings
 
 from incidents import models
+from incidents.authorization import authorization_cache
 
 
 # Create your tests here.
@@ -177,6 +184,52 @@ class IncidentTestCase(TestCase):
         self.assertTrue(self.user3.has_perm('incidents.view_incidents', obj=self.incident_root_1))
         self.assertFalse(self.user3.has_perm('incidents.delete_incident', obj=self.incident_root_1))
 
+    def test_permitted_ids(self):
+        ids = [self.incident_root_1.pk, self.incident_child_12.pk, self.incident_child_22.pk]
+        self.user1.has_perms(['incidents.add_incident'])
+        models.BusinessLine.get_authorization_paths(self.user1, 'incidents.add_incident')
+        with self.assertNumQueries(1):
+            self.assertEqual(models.Incident.authorization.permitted_ids(self.user1, 'incidents.add_incident', ids),
+                             {self.incident_root_1.pk, self.incident_child_12.pk})
+        with self.assertNumQueries(0):
+            self.assertTrue(self.user1.has_perm('incidents.add_incident', obj=self.incident_child_12))
+            self.assertFalse(self.user1.has_perm('incidents.add_incident', obj=self.incident_child_22))
+        self.assertEqual(models.Incident.authorization.permitted_ids(self.admin, 'incidents.add_incident', ids),
+                         set(ids))
+        self.assertEqual(models.Incident.authorization.permitted_ids(self.user3, 'incidents.view_incidents', ids),
+                         {self.incident_root_1.pk})
+        self.assertEqual(models.Incident.authorization.permitted_ids(self.user4, 'incidents.add_incident', ids),
+                         set())
+
+    def test_query_modes(self):
+        self.incident_root_1.concerned_business_lines.add(self.child11)
+        expected = {self.incident_root_1, self.incident_child_12}
+        incidents = models.Incident.authorization.for_user(self.user1, 'incidents.add_incident')
+        self.assertFalse(incidents.query.distinct)
+        self.assertIn('EXISTS', str(incidents.query))
+        self.assertEqual(incidents.count(), 2)
+        self.assertEqual(set(incidents), expected)
+        with self.settings(AUTHORIZATION_QUERY_MODE='join'):
+            incidents = models.Incident.authorization.for_user(self.user1, 'incidents.add_incident')
+            self.assertTrue(incidents.query.distinct)
+            self.assertEqual(incidents.count(), 2)
+            self.assertEqual(set(incidents), expected)
+
+    def test_multi_valued_filters(self):
+        self.incident_root_1.concerned_business_lines.add(self.child11, self.child12)
+        for comment in ('malware sample', 'malware removed'):
+            models.Comments.objects.create(incident=self.incident_root_1, comment=comment, opened_by=self.user1,
+                                           action=models.Label.objects.filter(group__name='action').first())
+        query = Q(subject__icontains='malware') | Q(comments__comment__icontains='malware')
+        for mode in ('exists', 'join', 'closure'):
+            with self.settings(AUTHORIZATION_QUERY_MODE=mode):
+                incidents = models.Incident.authorization.for_user(self.user1, 'incidents.add_incident')
+                # Several concerned business lines give no duplicate
+                self.assertEqual(list(incidents.order_by('pk')), [self.incident_root_1, self.incident_child_12])
+                # Duplicates of a multi-valued filter are only removed by the 'join' mode, or by the caller
+                self.assertEqual(incidents.filter(query).count(), 1 if mode == 'join' else 2)
+                self.assertEqual(list(incidents.filter(query).distinct()), [self.incident_root_1])
+
 
 class QuerySetBLTestCase(TestCase):
     def setUp(self):
@@ -241,3 +294,248 @@ class QuerySetBLTestCase(TestCase):
         self.assertEqual(models.BusinessLine.authorization.for_user(self.admin).count(), 6)
         self.assertEqual(models.BusinessLine.authorization.for_user(self.user1).count(), 3)
         self.assertEqual(models.BusinessLine.authorization.for_user(self.user2).count(), 4)
+
+
+class AuthorizationCacheMixin(object):
+    def setUp(self):
+        self.root_1 = models.BusinessLine.add_root(name='Root 1')
+        self.child11 = self.root_1.add_child(name='Child 11')
+        self.child12 = self.root_1.add_child(name='Child 12')
+
+        self.root_2 = models.BusinessLine.add_root(name='Root 2')
+        self.child21 = self.root_2.add_child(name='Child 21')
+
+        self.user1 = User.objects.create_user('user1', 'user1@example.com', 'password')
+        self.user2 = User.objects.create_user('user2', 'user2@example.com', 'password')
+
+        self.adder, created = Group.objects.get_or_create(name='Adder')
+        self.add = Permission.objects.get(codename='add_incident', content_type__app_label='incidents')
+        self.adder.permissions.clear()
+        self.adder.permissions.add(self.add)
+
+        models.AccessControlEntry.objects.create(user=self.user1, business_line=self.root_1, role=self.adder)
+        models.AccessControlEntry.objects.create(user=self.user2, business_line=self.child11, role=self.adder)
+        authorization_cache.invalidate()
+
+    def tearDown(self):
+        authorization_cache.invalidate()
+
+    def fresh(self, user):
+        # A new user object, as loaded for each request, with its model permissions loaded
+        user = User.objects.get(pk=user.pk)
+        user.has_perms(['incidents.add_incident'])
+        return user
+
+
+class AuthorizationCacheTestCase(AuthorizationCacheMixin, TestCase):
+    def test_request_memoization(self):
+        user1 = self.fresh(self.user1)
+        with self.assertNumQueries(1):
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=self.child11))
+        with self.assertNumQueries(0):
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=self.root_1))
+            self.assertFalse(user1.has_perm('incidents.add_incident', obj=self.root_2))
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=models.BusinessLine))
+            models.BusinessLine.authorization.for_user(user1, 'incidents.add_incident')
+        with self.assertNumQueries(1):
+            self.assertEqual(models.BusinessLine.authorization.for_user(user1, 'incidents.add_incident').count(), 3)
+        # Without a shared cache, another request reads them again
+        user1 = self.fresh(self.user1)
+        with self.assertNumQueries(1):
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=self.child11))
+
+    def test_acl_invalidation(self):
+        self.assertFalse(self.user2.has_perm('incidents.add_incident', obj=self.root_2))
+        ace = models.AccessControlEntry.objects.create(user=self.user2, business_line=self.root_2, role=self.adder)
+        self.assertTrue(self.user2.has_perm('incidents.add_incident', obj=self.child21))
+        ace.delete()
+        self.assertFalse(self.user2.has_perm('incidents.add_incident', obj=self.child21))
+
+    def test_role_invalidation(self):
+        self.assertTrue(self.user1.has_perm('incidents.add_incident', obj=self.child12))
+        self.adder.permissions.remove(self.add)
+        self.assertFalse(self.user1.has_perm('incidents.add_incident', obj=self.child12))
+
+    def test_move_invalidation(self):
+        self.assertEqual(models.BusinessLine.get_authorization_paths(self.user2, 'incidents.add_incident'),
+                         (self.child11.path,))
+        self.child11.move(self.root_2, pos='last-child')
+        self.child11.refresh_from_db()
+        self.assertTrue(self.child11.path.startswith(self.root_2.path))
+        self.assertEqual(models.BusinessLine.get_authorization_paths(self.user2, 'incidents.add_incident'),
+                         (self.child11.path,))
+
+
+@override_settings(AUTHORIZATION_CACHE='default')
+class SharedAuthorizationCacheTestCase(AuthorizationCacheMixin, TestCase):
+    def test_shared_cache(self):
+        self.assertTrue(self.fresh(self.user1).has_perm('incidents.add_incident', obj=self.child11))
+        user1 = self.fresh(self.user1)
+        with self.assertNumQueries(0):
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=self.child11))
+            self.assertFalse(user1.has_perm('incidents.add_incident', obj=self.root_2))
+        # A change made by another process replaces the version in the shared cache
+        caches['default'].set(authorization_cache.version_key, 'other', None)
+        user1 = self.fresh(self.user1)
+        with self.assertNumQueries(1):
+            self.assertTrue(user1.has_perm('incidents.add_incident', obj=self.child11))
+
+    def test_invalidation(self):
+        self.assertFalse(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.root_2))
+        models.AccessControlEntry.objects.create(user=self.user2, business_line=self.root_2, role=self.adder)
+        self.assertTrue(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.child21))
+        self.adder.permissions.remove(self.add)
+        self.assertFalse(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.child21))
+
+    def test_timeout(self):
+        with self.settings(AUTHORIZATION_CACHE_TIMEOUT=0):
+            self.assertFalse(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.child21))
+            # Queryset updates send no signal, they are seen once the paths expire
+            models.AccessControlEntry.objects.filter(user=self.user2).update(business_line=self.root_2)
+            self.assertTrue(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.child21))
+
+    def test_local_size(self):
+        authorization_cache.local_size = 1
+        try:
+            self.assertTrue(self.fresh(self.user1).has_perm('incidents.add_incident', obj=self.child11))
+            self.assertTrue(self.fresh(self.user2).has_perm('incidents.add_incident', obj=self.child11))
+            self.assertEqual(len(authorization_cache._paths), 1)
+        finally:
+            del authorization_cache.local_size
+
+
+class SubtreesFilterTestCase(TestCase):
+    def setUp(self):
+        self.root_1 = models.BusinessLine.add_root(name='Root 1')
+        self.child11 = self.root_1.add_child(name='Child 11')
+        self.child111 = self.child11.add_child(name='Child 111')
+        self.child12 = self.root_1.add_child(name='Child 12')
+        self.root_2 = models.BusinessLine.add_root(name='Root 2')
+        self.child21 = self.root_2.add_child(name='Child 21')
+
+        self.user = User.objects.create_user('user1', 'user1@example.com', 'password')
+        adder, created = Group.objects.get_or_create(name='Adder')
+        adder.permissions.set([Permission.objects.get(codename='add_incident', content_type__app_label='incidents')])
+        for bl in (self.child11, self.child111, self.child12, self.child21):
+            models.AccessControlEntry.objects.create(user=self.user, business_line=bl, role=adder)
+
+    def test_collapse(self):
+        self.assertEqual(models.BusinessLine.collapse_paths(['00010001', '000100010001', '0001', '00020001']),
+                         ('0001', '00020001'))
+        self.assertEqual(models.BusinessLine.get_authorization_paths(self.user, 'incidents.add_incident'),
+                         (self.child11.path, self.child12.path, self.child21.path))
+
+    def test_successor(self):
+        self.assertEqual(models.BusinessLine.get_path_successor('0001'), '0002')
+        self.assertEqual(models.BusinessLine.get_path_successor('0009'), '000A')
+        self.assertEqual(models.BusinessLine.get_path_successor('000Z'), '001')
+        self.assertEqual(models.BusinessLine.get_path_successor('0001ZZZZ'), '0002')
+        self.assertIsNone(models.BusinessLine.get_path_successor('ZZZZ'))
+
+    def test_range_filter(self):
+        self.assertEqual(set(models.BusinessLine.authorization.for_user(self.user, 'incidents.add_incident')),
+                         {self.child11, self.child111, self.child12, self.child21})
+        query = str(models.BusinessLine.authorization.for_user(self.user, 'incidents.add_incident').query)
+        self.assertNotIn('LIKE', query)
+        self.assertEqual(query.count('"path" >='), 3)
+
+
+class BusinessLineClosureTestCase(TestCase):
+    fixtures = ['incidents/fixtures/01_seed_data.json', ]
+
+    def setUp(self):
+        self.root_1 = models.BusinessLine.add_root(name='Root 1')
+        self.child11 = self.root_1.add_child(name='Child 11')
+        self.child12 = self.root_1.add_child(name='Child 12')
+        self.child121 = self.child12.add_child(name='Child 121')
+        self.root_2 = models.BusinessLine.add_root(name='Root 2')
+        self.child21 = self.root_2.add_child(name='Child 21')
+
+        self.user = User.objects.create_user('user1', 'user1@example.com', 'password')
+        opener = User.objects.create_user('user2', 'user2@example.com', 'password')
+        viewer, created = Group.objects.get_or_create(name='Viewer')
+        viewer.permissions.set([Permission.objects.get(codename='view_incidents',
+                                                       content_type__app_label='incidents')])
+        models.AccessControlEntry.objects.create(user=self.user, business_line=self.root_1, role=viewer)
+
+        category = models.IncidentCategory.objects.first()
+        detection = models.Label.objects.filter(group__name='detection').first()
+        self.incidents = [models.Incident.objects.create(subject="Incident {}".format(i), description="Test",
+                                                         opened_by=opener, category=category,
+                                                         detection=detection, severity=1) for i in range(3)]
+        self.incidents[0].concerned_business_lines.set([self.child121, self.child11])
+        self.incidents[1].concerned_business_lines.set([self.child21])
+        self.child12.incident_set.add(self.incidents[2])
+
+    def closure(self, incident):
+        return set(models.BusinessLineClosure.objects.filter(incident=incident).values_list('business_line',
+                                                                                            flat=True))
+
+    def visible(self):
+        with self.settings(AUTHORIZATION_QUERY_MODE='closure'):
+            incidents = models.Incident.authorization.for_user(self.user, 'incidents.view_incidents')
+            self.assertIn('incidents_businesslineclosure', str(incidents.query))
+            return set(incidents)
+
+    def test_maintained(self):
+        self.assertEqual(self.closure(self.incidents[0]),
+                         {self.root_1.pk, self.child11.pk, self.child12.pk, self.child121.pk})
+        self.assertEqual(self.closure(self.incidents[1]), {self.root_2.pk, self.child21.pk})
+        self.assertEqual(self.closure(self.incidents[2]), {self.root_1.pk, self.child12.pk})
+        self.assertEqual(self.visible(), {self.incidents[0], self.incidents[2]})
+        self.assertEqual(self.visible(),
+                         set(models.Incident.authorization.for_user(self.user, 'incidents.view_incidents')))
+
+        self.incidents[0].concerned_business_lines.remove(self.child121)
+        self.assertEqual(self.closure(self.incidents[0]), {self.root_1.pk, self.child11.pk})
+        self.child12.incident_set.clear()
+        self.assertEqual(self.closure(self.incidents[2]), set())
+        self.assertEqual(self.visible(), {self.incidents[0]})
+
+    def test_tree_changes(self):
+        self.child12.move(self.root_2, pos='first-child')
+        self.assertEqual(self.closure(self.incidents[0]),
+                         {self.root_1.pk, self.child11.pk, self.root_2.pk, self.child12.pk, self.child121.pk})
+        self.assertEqual(self.closure(self.incidents[2]), {self.root_2.pk, self.child12.pk})
+        self.assertEqual(self.closure(self.incidents[1]), {self.root_2.pk, self.child21.pk})
+        self.assertEqual(self.visible(), {self.incidents[0]})
+
+        self.child11.delete()
+        self.assertEqual(self.closure(self.incidents[0]), {self.root_2.pk, self.child12.pk, self.child121.pk})
+        self.assertEqual(self.visible(), set())
+
+    def test_rebuild(self):
+        expected = set(models.BusinessLineClosure.objects.values_list('incident', 'business_line'))
+        models.BusinessLineClosure.objects.all().delete()
+        call_command('rebuild_business_line_closure', batch_size=2, stdout=StringIO())
+        self.assertEqual(set(models.BusinessLineClosure.objects.values_list('incident', 'business_line')), expected)
+
+
+class AuthorizationBenchmarkTestCase(TestCase):
+    fixtures = ['incidents/fixtures/01_seed_data.json']
+    options = dict(roots=2, depth=2, fanout=2, users=4, aces=2, incidents=30, sample=2, repeat=1, objects=5)
+
+    def test_report(self):
+        out = StringIO()
+        call_command('authorization_benchmark', mode=['exists', 'closure'], stdout=out, **self.options)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['dataset']['business_lines'], 14)
+        self.assertEqual(report['dataset']['access_control_entries'], 8)
+        self.assertEqual(set(report['results']), {'exists', 'closure'})
+        for results in report['results'].values():
+            self.assertEqual(set(results), {'get_authorization_paths', 'for_user count', 'for_user page', 'has_perm',
+                                            'permitted_ids', 'dashboard view', 'search view'})
+            self.assertEqual(results['has_perm']['calls'], 2)
+            self.assertGreater(results['for_user count']['queries']['min'], 0)
+        # The generated data is rolled back
+        self.assertFalse(models.BusinessLine.objects.filter(name__startswith='Benchmark').exists())
+        self.assertFalse(models.Incident.objects.filter(subject__startswith='Benchmark').exists())
+
+    def test_keep(self):
+        call_command('authorization_benchmark', keep=True, stdout=StringIO(), **self.options)
+        self.assertEqual(models.BusinessLine.find_problems(), ([], [], [], [], []))
+        root = models.BusinessLine.objects.get(name='Benchmark 0')
+        self.assertEqual(root.get_descendant_count(), 6)
+        self.assertEqual(models.Incident.objects.filter(subject__startswith='Benchmark').count(), 30)
+        self.assertEqual(models.BusinessLineClosure.objects.filter(
+            incident__subject__startswith='Benchmark', business_line__depth=3).count(), 30 * 2)
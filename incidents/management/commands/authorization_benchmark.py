@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from incidents.authorization.benchmark import QUERY_MODES, AuthorizationBenchmark, compare
+
+
+class Command(BaseCommand):
+    help = "Measures the queries and latency of incident authorization on generated business line trees, " \
+           "users and incidents, and writes a JSON report"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--roots', type=int, default=2, help="Number of business line trees")
+        parser.add_argument('--depth', type=int, default=3, help="Number of levels under each root")
+        parser.add_argument('--fanout', type=int, default=5, help="Number of children of each business line")
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--aces', type=int, default=3, help="Number of access control entries of each user")
+        parser.add_argument('--incidents', type=int, default=10000)
+        parser.add_argument('--incident-lines', type=int, default=2,
+                            help="Number of business lines concerned by each incident")
+        parser.add_argument('--sample', type=int, default=20, help="Number of users the operations are measured for")
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--objects', type=int, default=50,
+                            help="Number of incidents checked by has_perm and permitted_ids")
+        parser.add_argument('--mode', action='append', choices=QUERY_MODES, dest='modes',
+                            help="Query mode to measure, may be repeated (default: AUTHORIZATION_QUERY_MODE)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="File the JSON report is written to (default: standard output)")
+        parser.add_argument('--compare', help="JSON report of a previous run to compare the median latencies with")
+        parser.add_argument('--keep', action='store_true',
+                            help="Keep the generated data instead of rolling it back")
+
+    def handle(self, *args, **options):
+        for name in ('roots', 'depth', 'fanout', 'users', 'incidents', 'sample', 'repeat', 'objects'):
+            if options[name] < 1:
+                raise CommandError(u"--{} must be positive".format(name.replace('_', '-')))
+        previous = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    previous = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CommandError(u"Cannot read report '{}': {}".format(options['compare'], e))
+
+        # Progress goes to standard output only when the report does not
+        log = self.stdout.write if options['output'] else None
+        benchmark = AuthorizationBenchmark(
+            roots=options['roots'], depth=options['depth'], fanout=options['fanout'], users=options['users'],
+            aces=options['aces'], incidents=options['incidents'], incident_lines=options['incident_lines'],
+            sample=options['sample'], repeat=options['repeat'], objects=options['objects'], seed=options['seed'],
+            log=log)
+        with transaction.atomic():
+            user_ids, incident_ids = benchmark.generate()
+            report = benchmark.run(user_ids, incident_ids, options['modes'])
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            self.stdout.write(self.style.SUCCESS(u"Report written to {}".format(options['output'])))
+        else:
+            self.stdout.write(data)
+
+        if previous is not None:
+            out = self.stdout if options['output'] else self.stderr
+            for mode, name, old, new in compare(previous, report):
+                old_time, new_time = old['seconds']['median'], new['seconds']['median']
+                out.write(u"{} {}: {:.2f}ms -> {:.2f}ms ({:+.0%}), {} -> {} queries".format(
+                    mode, name, old_time * 1000, new_time * 1000,
+                    (new_time - old_time) / old_time if old_time else 0,
+                    old['queries']['median'], new['queries']['median']))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from incidents.models import BusinessLine, BusinessLineClosure, Incident
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the table linking incidents to their concerned business lines and all their ancestors"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Number of incidents rebuilt per transaction")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError(u"--batch-size must be positive")
+
+        nodes = dict(BusinessLine.objects.values_list('path', 'pk'))
+        incident_count = 0
+        row_count = 0
+        started = time.time()
+        last_id = 0
+        while True:
+            incident_ids = list(Incident.objects.filter(pk__gt=last_id).order_by('pk').values_list(
+                'pk', flat=True)[:batch_size])
+            if not incident_ids:
+                break
+            last_id = incident_ids[-1]
+            with transaction.atomic():
+                row_count += BusinessLineClosure.objects.refresh(incident_ids, nodes=nodes)
+            incident_count += len(incident_ids)
+            elapsed = max(time.time() - started, 1e-6)
+            self.stdout.write(u"{} incidents, {} rows (last id {}): {:.1f} incidents/s".format(
+                incident_count, row_count, last_id, incident_count / elapsed))
+
+        self.stdout.write(self.style.SUCCESS(u"Done: {} incidents, {} rows in {:.1f}s".format(
+            incident_count, row_count, time.time() - started)))
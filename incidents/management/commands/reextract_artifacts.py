@@ -0,0 +1,145 @@
+import json
+import multiprocessing
+import os
+import time
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from fir_artifacts import artifacts
+from fir_artifacts.models import Artifact, ScannedContent, content_digest
+from incidents.models import Incident, Comments
+
+
+def extract_incident(job):
+    # Runs in the worker processes, without database access
+    incident_id, texts = job
+    found = artifacts.extract("\n".join(texts))
+    return incident_id, set((key, value) for key in found for value in found[key])
+
+
+class Command(BaseCommand):
+    help = "Extracts artifacts again from the description, comments and nuggets of all incidents"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Number of incidents read and written at once")
+        parser.add_argument('--processes', type=int, default=None,
+                            help="Number of extraction processes (default: number of CPUs)")
+        parser.add_argument('--checkpoint', help="File storing the last processed incident id, to resume an interrupted run")
+        parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first incident")
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)['last_id']
+        except FileNotFoundError:
+            return 0
+        except (IOError, ValueError, KeyError) as e:
+            raise CommandError(u"Cannot read checkpoint '{}': {}".format(path, e))
+
+    def write_checkpoint(self, path, last_id):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'last_id': last_id}, f)
+        os.replace(temporary, path)
+
+    def chunks(self, start_after, chunk_size):
+        incidents = Incident.objects.filter(pk__gt=start_after).order_by('pk').only('pk', 'description')
+        chunk = []
+        # iterator() streams rows with a server-side cursor where the database supports it
+        for incident in incidents.iterator(chunk_size=chunk_size):
+            chunk.append(incident)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def sources(self, incidents):
+        sources = dict((incident.pk, [(incident, incident.description)]) for incident in incidents)
+        related = [(Comments, 'comment')]
+        if apps.is_installed('fir_nuggets'):
+            related.append((apps.get_model('fir_nuggets', 'Nugget'), 'raw_data'))
+        for model, field in related:
+            for obj in model.objects.filter(incident_id__in=sources).only('pk', 'incident_id', field).order_by('pk'):
+                sources[obj.incident_id].append((obj, getattr(obj, field)))
+        return sources
+
+    def write(self, incidents, sources, found):
+        links = []
+        for incident_id, values in found:
+            links.extend((incident_id, artifact_type, value) for artifact_type, value in values
+                         if value not in artifacts.blacklist.get(artifact_type))
+        with transaction.atomic():
+            resolved = dict(((a.type, a.value), a) for a in
+                            Artifact.objects.resolve((artifact_type, value) for incident_id, artifact_type, value in links))
+            Artifact.objects.link_many(Incident, [(incident_id, resolved[(artifact_type, value)])
+                                                  for incident_id, artifact_type, value in links])
+            for incident_id, artifact_type, value in links:
+                artifacts.after_save(artifact_type, value, incidents[incident_id])
+            ScannedContent.objects.record([(obj, text, content_digest(text))
+                                           for incident_sources in sources.values() for obj, text in incident_sources])
+        return len(links)
+
+    def finish(self, chunk, sources, found):
+        if not isinstance(found, list):
+            found = found.get()
+        incidents = dict((incident.pk, incident) for incident in chunk)
+        self.artifact_count += self.write(incidents, sources, found)
+        self.incident_count += len(chunk)
+        if self.checkpoint:
+            self.write_checkpoint(self.checkpoint, chunk[-1].pk)
+
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.stdout.write(u"{} incidents, {} artifacts (last id {}): {:.1f} incidents/s, {:.1f} artifacts/s".format(
+            self.incident_count, self.artifact_count, chunk[-1].pk,
+            self.incident_count / elapsed, self.artifact_count / elapsed))
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        processes = options['processes'] or os.cpu_count() or 1
+        self.checkpoint = checkpoint = options['checkpoint']
+        if chunk_size < 1 or processes < 1:
+            raise CommandError(u"--chunk-size and --processes must be positive")
+
+        start_after = 0
+        if checkpoint and not options['restart']:
+            start_after = self.read_checkpoint(checkpoint)
+            if start_after:
+                self.stdout.write(u"Resuming after incident {}".format(start_after))
+
+        pool = None
+        if processes > 1:
+            # Workers must not inherit open database connections
+            connections.close_all()
+            pool = multiprocessing.Pool(processes, initializer=django.setup)
+
+        self.incident_count = 0
+        self.artifact_count = 0
+        self.started = time.time()
+        pending = None
+        try:
+            for chunk in self.chunks(start_after, chunk_size):
+                sources = self.sources(chunk)
+                jobs = [(incident_id, [text for obj, text in incident_sources])
+                        for incident_id, incident_sources in sources.items()]
+                if pool is None:
+                    found = [extract_incident(job) for job in jobs]
+                else:
+                    # The next chunk is extracted while the previous one is written
+                    found = pool.map_async(extract_incident, jobs, chunksize=max(1, len(jobs) // (processes * 4)))
+                if pending is not None:
+                    self.finish(*pending)
+                pending = (chunk, sources, found)
+            if pending is not None:
+                self.finish(*pending)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = time.time() - self.started
+        self.stdout.write(self.style.SUCCESS(u"Done: {} incidents, {} artifacts in {:.1f}s".format(
+            self.incident_count, self.artifact_count, elapsed)))
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('incidents', '0012_profile_ms_home_account_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BusinessLineClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('business_line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='incidents.businessline')),
+                ('incident', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='business_line_closure', to='incidents.incident')),
+            ],
+            options={
+                'unique_together': {('business_line', 'incident')},
+            },
+        ),
+    ]
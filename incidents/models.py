@@ -1,19 +1,19 @@
 # -*- coding: utf-8 -*-
 import datetime
 
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import Signal, receiver
-from django.db import models
-from django.contrib.auth.models import User
+from django.db import models, transaction
+from django.contrib.auth.models import Group, User
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
 
 from treebeard.mp_tree import MP_Node
 
 from fir_artifacts import artifacts
-from fir_artifacts.models import Artifact, File
+from fir_artifacts.models import Artifact, File, ScannedContent
 from fir_plugins.models import link_to
-from incidents.authorization import tree_authorization, AuthorizationModelMixin
+from incidents.authorization import authorization_cache, tree_authorization, AuthorizationModelMixin
 
 STATUS_CHOICES = (
     ("O", _("Open")),
@@ -117,6 +117,13 @@ class BusinessLine(MP_Node, AuthorizationModelMixin):
     class Meta:
         verbose_name = _('business line')
 
+    def move(self, target, pos=None):
+        # Moves change the paths of the subtree with queryset updates, that send no signal
+        super(BusinessLine, self).move(target, pos=pos)
+        self.refresh_from_db(fields=['path', 'depth'])
+        BusinessLineClosure.objects.refresh_subtree(self.path)
+        authorization_cache.invalidate_on_commit()
+
     def get_incident_count(self, query):
         incident_count = self.incident_set.filter(query).distinct().count()
         incident_count += Incident.objects.filter(query).filter(
@@ -168,7 +175,8 @@ class IncidentCategory(models.Model):
 # Core models ================================================================
 
 @tree_authorization(fields=['concerned_business_lines', ], tree_model='incidents.BusinessLine',
-                    owner_field='opened_by', owner_permission=settings.INCIDENT_CREATOR_PERMISSION)
+                    owner_field='opened_by', owner_permission=settings.INCIDENT_CREATOR_PERMISSION,
+                    closure='incidents.BusinessLineClosure')
 @link_to(File)
 @link_to(Artifact)
 class Incident(FIRModel, models.Model):
@@ -238,41 +246,59 @@ class Incident(FIRModel, models.Model):
             mainbls.add(bl.get_root())
         self.main_business_lines.set(list(mainbls))
 
-    def refresh_artifacts(self, data=""):
-        if data == "":
-            coms = self.comments_set.all()
-
-            data = self.description
-            for c in coms:
-                data += "\n" + c.comment
+    @property
+    def artifacts_pending(self):
+        return artifacts.refresh_queue.pending(self)
 
-        found_artifacts = artifacts.find(data)
+    def refresh_artifacts(self, data="", source=None, asynchronous=None):
+        """
+        Links the artifacts found in data to the incident
 
-        artifact_list = []
-        for key in found_artifacts:
-            for a in found_artifacts[key]:
-                artifact_list.append((key, a))
+        When source (the object data comes from) is given, data is only scanned if it changed since
+        the last scan of that source. Without data, the description, comments and nuggets of the
+        incident are scanned, skipping the ones that did not change.
 
-        db_artifacts = Artifact.objects.filter(value__in=[a[1] for a in artifact_list])
+        With ARTIFACTS_ASYNC_EXTRACTION, refreshes of known sources are queued as a fir_celery task
+        instead, unless asynchronous is False.
+        """
+        if asynchronous is None:
+            asynchronous = artifacts.refresh_queue.enabled
+        if asynchronous and (data == "" or source is not None):
+            artifacts.refresh_queue.schedule(self)
+            return
 
-        exist = []
+        sources = None
+        if data == "":
+            sources = [(self, self.description)]
+            sources.extend((c, c.comment) for c in self.comments_set.all())
+            if hasattr(self, 'nugget_set'):
+                sources.extend((n, n.raw_data) for n in self.nugget_set.all())
+        elif source is not None:
+            sources = [(source, data)]
+
+        if sources is not None:
+            sources = ScannedContent.objects.changed(sources)
+            if not sources:
+                return
+            data = "\n".join(text for obj, text, digest in sources)
 
-        for a in db_artifacts:
-            exist.append((a.type, a.value))
-            if self not in a.incidents.all():
-                a.incidents.add(self)
+        found_artifacts = artifacts.find(data)
 
-        new_artifacts = list(set(artifact_list) - set(exist))
-        all_artifacts = list(set(artifact_list))
+        artifact_list = set()
+        for key in found_artifacts:
+            for a in found_artifacts[key]:
+                artifact_list.add((key, a))
 
-        for a in new_artifacts:
-            new = Artifact(type=a[0], value=a[1])
-            new.save()
-            new.incidents.add(self)
+        # The resolved artifacts stay locked until linked, the garbage collector cannot delete them in between
+        with transaction.atomic(savepoint=False):
+            Artifact.objects.link(self, Artifact.objects.resolve(artifact_list))
 
-        for a in all_artifacts:
+        for a in artifact_list:
             artifacts.after_save(a[0], a[1], self)
 
+        if sources is not None:
+            ScannedContent.objects.record(sources)
+
     class Meta:
         permissions = (
             ('handle_incidents', 'Can handle incidents'),
@@ -282,6 +308,56 @@ class Incident(FIRModel, models.Model):
         )
 
 
+class BusinessLineClosureManager(models.Manager):
+    def refresh(self, incident_ids, nodes=None):
+        """
+        Replaces the rows of the given incidents by their concerned business lines and all their ancestors
+
+        nodes maps business line paths to ids, the paths missing from it are read from the database.
+        """
+        incident_ids = list(incident_ids)
+        if not incident_ids:
+            return 0
+        steplen = BusinessLine.steplen
+        closure = set()
+        for incident_id, path in Incident.concerned_business_lines.through.objects.filter(
+                incident_id__in=incident_ids).values_list('incident_id', 'businessline__path'):
+            closure.update((incident_id, path[:end]) for end in range(steplen, len(path) + 1, steplen))
+        missing = set(path for incident_id, path in closure).difference(nodes or ())
+        if missing:
+            nodes = dict(nodes or ())
+            nodes.update(BusinessLine.objects.filter(path__in=missing).values_list('path', 'pk'))
+        self.filter(incident_id__in=incident_ids).delete()
+        self.bulk_create([self.model(incident_id=incident_id, business_line_id=nodes[path])
+                          for incident_id, path in closure])
+        return len(closure)
+
+    def refresh_subtree(self, path):
+        """
+        Refreshes the rows of the incidents concerned by the business lines under path
+        """
+        incident_ids = Incident.concerned_business_lines.through.objects.filter(
+            businessline__path__startswith=path).values_list('incident_id', flat=True).distinct()
+        self.refresh(incident_ids)
+
+
+class BusinessLineClosure(models.Model):
+    """
+    Links each incident to its concerned business lines and to all their ancestors
+
+    Rows are maintained by signal receivers and rebuilt by the rebuild_business_line_closure command. With
+    AUTHORIZATION_QUERY_MODE = 'closure', the incidents under the granted business lines are selected from
+    this table, without looking at the paths of their business lines.
+    """
+    incident = models.ForeignKey(Incident, on_delete=models.CASCADE, related_name='business_line_closure')
+    business_line = models.ForeignKey(BusinessLine, on_delete=models.CASCADE, related_name='+')
+
+    objects = BusinessLineClosureManager()
+
+    class Meta:
+        unique_together = ('business_line', 'incident')
+
+
 class Comments(models.Model):
     date = models.DateTimeField(default=datetime.datetime.now, blank=True)
     comment = models.TextField()
@@ -384,10 +460,45 @@ class IncidentTemplate(models.Model):
 #
 
 
+@receiver(post_save, sender=AccessControlEntry)
+@receiver(post_delete, sender=AccessControlEntry)
+@receiver(post_save, sender=BusinessLine)
+@receiver(post_delete, sender=BusinessLine)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_authorizations(sender, action=None, **kwargs):
+    if action is None or action.startswith('post_'):
+        authorization_cache.invalidate_on_commit()
+
+
+@receiver(m2m_changed, sender=Incident.concerned_business_lines.through)
+def refresh_business_line_closure(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # The incidents of a cleared business line are only known before
+        instance._closure_incidents = list(instance.incident_set.values_list('pk', flat=True))
+    elif action == 'post_clear' and reverse:
+        BusinessLineClosure.objects.refresh(instance.__dict__.pop('_closure_incidents', []))
+    elif action.startswith('post_'):
+        BusinessLineClosure.objects.refresh(pk_set if reverse else [instance.pk])
+
+
+@receiver(pre_delete, sender=BusinessLine)
+def collect_business_line_closure(sender, instance, **kwargs):
+    # Rows linking incidents to the business line are deleted with it, along with the incident links
+    instance._closure_incidents = list(BusinessLineClosure.objects.filter(
+        business_line=instance).values_list('incident_id', flat=True))
+
+
+@receiver(post_delete, sender=BusinessLine)
+def refresh_deleted_business_line_closure(sender, instance, **kwargs):
+    BusinessLineClosure.objects.refresh(instance.__dict__.pop('_closure_incidents', []))
+
+
 @receiver(model_created, sender=Incident)
 @receiver(model_updated, sender=Incident)
 def refresh_incident(sender, instance, **kwargs):
-    instance.refresh_artifacts(instance.description)
+    instance.refresh_artifacts(instance.description, source=instance)
 
 
 # Automatically create comments
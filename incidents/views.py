@@ -13,6 +13,7 @@ from incidents.models import Label, Log, BaleCategory
 from incidents.models import Attribute, ValidAttribute, IncidentTemplate, Profile
 from incidents.forms import IncidentForm, CommentForm
 
+from incidents.authorization import prefetch_permissions
 from incidents.authorization.decorator import authorization_required
 from fir.config.base import INSTALLED_APPS, ENFORCE_2FA, TF_INSTALLED, MS_OAUTH2_INSTALLED
 import importlib
@@ -98,6 +99,12 @@ def can_view_statistics(user):
     return user.has_perm('incidents.view_statistics', obj=Incident)
 
 
+def prefetch_incident_permissions(user, incidents):
+    # Decides the per-row permission checks of events/table.html with one query per permission
+    prefetch_permissions(user, 'incidents.view_incidents', incidents)
+    prefetch_permissions(user, 'incidents.handle_incidents', incidents)
+
+
 comment_permissions = ['incidents.handle_incidents']
 if getattr(settings, 'INCIDENT_VIEWER_CAN_COMMENT', False):
     comment_permissions.append('incidents.view_incidents')
@@ -616,7 +623,7 @@ def update_comment(request, comment_id):
                     c.incident.save()
                     model_status_changed.send(sender=Incident, instance=c.incident, previous_status=previous_status)
 
-            i.refresh_artifacts(c.comment)
+            i.refresh_artifacts(c.comment, source=c)
 
             return render(request, 'events/_comment.html', {'comment': c, 'event': i})
         else:
@@ -723,7 +730,7 @@ def search(request):
             artifacts = re.search("art:(\S+)", query_string)
             if artifacts:
                 artifacts = artifacts.group(1)
-                q = q & Q(id__in=[i.id for i in libartifacts.incs_for_art(artifacts)])
+                q = q & Q(id__in=libartifacts.incs_for_art(artifacts))
                 query_string = query_string.replace('art:' + artifacts, '')
 
             if query_string.count('starred') > 0:
@@ -814,6 +821,7 @@ def search(request):
             except EmptyPage:
                 found_entries = p.page(1)
 
+            prefetch_incident_permissions(request.user, found_entries)
             return render(request, 'events/table.html',
                           {'incident_list': found_entries, 'order_param': order_param, 'asc': asc})
         else:
@@ -872,7 +880,7 @@ def comment(request, incident_id, authorization_target=None):
             com.opened_by = request.user
             com.save()
             log("Comment created: %s" % (com.comment[:20] + "..."), request.user, incident=com.incident)
-            i.refresh_artifacts(com.comment)
+            i.refresh_artifacts(com.comment, source=com)
 
             if com.action.name in ['Closed', 'Opened', 'Blocked'] and com.incident.status != com.action.name[0]:
                 previous_status = com.incident.status
@@ -2234,6 +2242,7 @@ def incident_display(request, filter, incident_view=True, paginated=True):
         except (PageNotAnInteger, EmptyPage):
             incident_list = p.page(1)
 
+    prefetch_incident_permissions(request.user, incident_list)
     return render(request, 'events/table.html', {
         'incident_list': incident_list,
         'incident_view': incident_view,
@@ -2276,6 +2285,7 @@ def dashboard_old(request):
         Max('comments__date')).order_by('comments__date__max')[
                     :20]
 
+    prefetch_incident_permissions(request.user, incident_list)
     return render(request, 'events/table.html', {
         'incident_list': incident_list,
         'incident_view': True,